@@ -1,8 +1,7 @@
 import sys
 
-from cnn_utils import image_utils
+from cnn_utils import constant_utils
 
-import cv2
 import keras.backend as K
 from keras.layers import Layer
 import numpy as np
@@ -82,101 +81,186 @@ def randflow_model(img_shape,
 	return Model(inputs=[x_in], outputs=model_outputs, name=model_name)
 
 
-class Blur_Downsample(Layer):
-    def __init__(self, n_chans=3, n_dims=2, do_blur=True, **kwargs):
-        super(Blur_Downsample, self).__init__(**kwargs)
-        scale_factor = 0.5  # we only support halving right now
-
-        if do_blur:
-            # according to scikit-image.transform.rescale documentation
-            blur_sigma = (1. - scale_factor) / 2
-
-            blur_kernel = image_utils.create_gaussian_kernel(blur_sigma, n_dims=n_dims, n_sigmas_per_side=4)
-            #			if n_dims==2:
-            #				blur_kernel = np.tile(np.reshape(blur_kernel, blur_kernel.shape + (1, 1)), tuple([1] * n_dims) + (n_chans, 1))
-            #			else:
-            blur_kernel = np.reshape(blur_kernel, blur_kernel.shape + (1, 1))
-            self.blur_kernel = tf.constant(blur_kernel, dtype=tf.float32)
-        else:
-            self.blur_kernel = tf.constant(np.ones([1] * n_dims + [1, 1]), dtype=tf.float32)
+def gaussian_blur(x, blur_sigma, n_dims, n_sigmas_per_side=8, strides=1, separable=True):
+    '''
+    Blurs each channel of x (sized [batch_size, *vol_shape, n_chans]) with a gaussian, with 'SAME' padding.
+    The channels are folded into the batch so that every channel goes through the same single-channel convs.
+
+    :param strides: int, e.g. 2 to blur and downsample
+    :param separable: convolve with a 1D kernel along each dim in turn, which costs O(n_dims * k) per voxel
+        rather than O(k^n_dims), and gives the same result as the full kernel
+    '''
+    in_shape = x.get_shape().as_list()
+    n_chans = in_shape[-1]
+    x_shape = tf.shape(x)
+
+    x = tf.transpose(x, [0, n_dims + 1] + list(range(1, n_dims + 1)))
+    x = tf.expand_dims(tf.reshape(x, tf.concat([[-1], tf.shape(x)[2:]], axis=0)), axis=-1)
+    if separable:
+        for d in range(n_dims):
+            kernel = constant_utils.get_constant(
+                'gaussian_kernel_1d', sigma=blur_sigma, axis=d, n_dims=n_dims, n_sigmas_per_side=n_sigmas_per_side)
+            # downsampling commutes with the other dims' 1D passes, so we can stride each dim in its own pass
+            d_strides = [1] * n_dims
+            d_strides[d] = strides
+            x = tf.nn.convolution(x, kernel, padding='SAME', strides=d_strides)
+    else:
+        kernel = constant_utils.get_constant(
+            'gaussian_kernel', sigma=blur_sigma, n_dims=n_dims, n_sigmas_per_side=n_sigmas_per_side)
+        x = tf.nn.convolution(x, kernel, padding='SAME', strides=[strides] * n_dims)
+
+    # and back to [batch_size, *vol_shape, n_chans]
+    x = tf.reshape(x, tf.concat([x_shape[:1], x_shape[-1:], tf.shape(x)[1:-1]], axis=0))
+    x = tf.transpose(x, [0] + list(range(2, n_dims + 2)) + [1])
+    x.set_shape([in_shape[0]] + [int(np.ceil(s / float(strides))) if s is not None else None
+                                 for s in in_shape[1:-1]] + [n_chans])
+    return x
+
+
+class GaussianBlur(Layer):
+    def __init__(self, blur_sigma, n_dims=2, n_sigmas_per_side=8, strides=1, separable=True, **kwargs):
+        '''
+        Blurs (and optionally downsamples) each channel of the input, see gaussian_blur.
+        '''
+        super(GaussianBlur, self).__init__(**kwargs)
+        self.blur_sigma = blur_sigma
         self.n_dims = n_dims
-        self.n_chans = n_chans
+        self.n_sigmas_per_side = n_sigmas_per_side
+        self.strides = strides
+        self.separable = separable
 
     def build(self, input_shape):
         self.built = True
 
     def call(self, inputs):
-        self.n_chans = inputs[0].get_shape().as_list()[-1]
-        #		if self.n_dims == 2:
-        #			blurred = tf.nn.depthwise_conv2d(inputs, self.blur_kernel,
-        #											   padding='SAME', strides=[1, 2, 2, 1])
-        if self.n_dims == 2:
-            strides = [1, 2, 2, 1]
-            conv_fn = tf.nn.conv2d
-        elif self.n_dims == 3:
-            strides = [1, 2, 2, 2, 1]
-            conv_fn = tf.nn.conv3d
-
-        chans_list = tf.unstack(inputs, num=self.n_chans, axis=-1)
-        blurred_chans = []
-        for c in range(self.n_chans):
-            blurred_chan = conv_fn(tf.expand_dims(chans_list[c], axis=-1), self.blur_kernel,
-                                   strides=strides, padding='SAME')
-            # get rid of last dimension (size 1)
-            blurred_chans.append(tf.gather(blurred_chan, 0, axis=-1))
-        blurred = tf.stack(blurred_chans, axis=-1)
-        return blurred
+        return gaussian_blur(inputs, self.blur_sigma, self.n_dims, n_sigmas_per_side=self.n_sigmas_per_side,
+                             strides=self.strides, separable=self.separable)
 
     def compute_output_shape(self, input_shape):
-        return tuple([input_shape[0]] + [int(np.ceil(s / 2)) for s in input_shape[1:-1]] + [self.n_chans])
+        return tuple([input_shape[0]]
+                     + [int(np.ceil(s / float(self.strides))) if s is not None else None for s in input_shape[1:-1]]
+                     + [input_shape[-1]])
+
+
+class Blur_Downsample(GaussianBlur):
+    def __init__(self, n_chans=3, n_dims=2, do_blur=True, **kwargs):
+        scale_factor = 0.5  # we only support halving right now
+        # according to scikit-image.transform.rescale documentation
+        blur_sigma = (1. - scale_factor) / 2
+        super(Blur_Downsample, self).__init__(
+            blur_sigma=blur_sigma, n_dims=n_dims, n_sigmas_per_side=4, strides=2, **kwargs)
+        self.do_blur = do_blur
+        self.n_chans = n_chans
+
+    def call(self, inputs):
+        if not self.do_blur:
+            # a 1x1 kernel with 'SAME' padding just takes every other voxel
+            return inputs[(slice(None),) + (slice(None, None, 2),) * self.n_dims]
+        return super(Blur_Downsample, self).call(inputs)
+
+
+def upsample_separable(x, factor, out_shape, interp='linear'):
+    '''
+    Upsamples x (sized [batch_size, *vol_shape, n_chans], with a known vol_shape) by an integer factor, one
+    spatial dim at a time. Output voxel i samples the input at i / factor.
+
+    :param out_shape: spatial shape of the output, at most vol_shape * factor
+    :param interp: 'linear' or 'bspline' (cubic)
+    '''
+    n_dims = len(out_shape)
+    for d in range(n_dims):
+        axis = d + 1
+        taps_params = dict(n_in=x.get_shape().as_list()[axis], n_out=out_shape[d], factor=factor, interp=interp)
+        idxs = constant_utils.get_constant('upsample_idxs', dtype='int32', **taps_params)
+        weights = constant_utils.get_constant('upsample_weights', **taps_params)
+        n_taps = constant_utils.get_array('upsample_idxs', **taps_params).shape[0]
+
+        weights_shape = [1] * (n_dims + 2)
+        weights_shape[axis] = out_shape[d]
+        x = tf.add_n([tf.gather(x, idxs[t], axis=axis) * tf.reshape(weights[t], weights_shape)
+                      for t in range(n_taps)])
+    return x
+
+
+def default_coarse_factor(blur_sigma):
+    # keep the blur at least 2 voxels wide on the coarse grid, so that it is smooth enough to interpolate
+    return max(1, int(blur_sigma / 2.))
+
+
+def random_flow(batch_size, flow_shape, blur_sigma, noise='normal', flow_amp=1., n_sigmas_per_side=8,
+                coarse_factor=None, interp='linear'):
+    '''
+    Smooth random flow: noise blurred by a gaussian. Most of the detail in full resolution noise is removed by the
+    blur, so we sample the noise on a grid that is coarse_factor times coarser, blur it with blur_sigma / coarse_factor,
+    and upsample it. The result has the same per-voxel std and about the same spatial correlation as blurring full
+    resolution noise, for ~1 / coarse_factor^n_dims of the compute and memory.
+
+    :param batch_size: int or scalar tensor
+    :param flow_shape: (*vol_shape, n_dims)
+    :param noise: 'normal' (with std 1) or 'uniform' (in [-flow_amp, flow_amp])
+    :param coarse_factor: int, defaults to default_coarse_factor(blur_sigma). Use 1 to blur full resolution noise
+    :return: [batch_size, *flow_shape]
+    '''
+    vol_shape = list(flow_shape[:-1])
+    n_dims = len(vol_shape)
+    if coarse_factor is None:
+        coarse_factor = default_coarse_factor(blur_sigma) if blur_sigma > 0 else 1
+
+    coarse_shape = [int(np.ceil(s / float(coarse_factor))) for s in vol_shape]
+    noise_shape = tf.stack([batch_size] + coarse_shape + [flow_shape[-1]])
+    if noise == 'uniform':
+        rand_flow = K.random_uniform(shape=noise_shape, minval=-flow_amp, maxval=flow_amp, dtype='float32')
+    else:
+        rand_flow = K.random_normal(shape=noise_shape, mean=0., stddev=1., dtype='float32')
+    rand_flow.set_shape([None] + coarse_shape + [flow_shape[-1]])
+
+    if blur_sigma > 0:
+        rand_flow = gaussian_blur(rand_flow, blur_sigma / float(coarse_factor), n_dims,
+                                  n_sigmas_per_side=n_sigmas_per_side)
+
+    if coarse_factor > 1:
+        # blurring noise with a gaussian that is coarse_factor times narrower leaves coarse_factor^(n_dims / 2)
+        # times the std
+        rand_flow = rand_flow * coarse_factor ** (-n_dims / 2.)
+        rand_flow = upsample_separable(rand_flow, coarse_factor, vol_shape, interp=interp)
+    return rand_flow
+
+
+def _flow_shape_like(inputs, default_flow_shape):
+    # random_flow needs a static shape. Follow the spatial shape of the inputs if it is known, so that layers made
+    # for one img_shape still work on e.g. resized inputs, and fall back to the shape that the layer was made for
+    vol_shape = inputs.get_shape().as_list()[1:-1]
+    if len(vol_shape) != len(default_flow_shape) - 1 or None in vol_shape:
+        vol_shape = default_flow_shape[:-1]
+    return tuple(vol_shape) + (default_flow_shape[-1],)
 
 
 class RandFlow_Uniform(Layer):
-    def __init__(self, img_shape, blur_sigma, flow_amp, **kwargs):
+    def __init__(self, img_shape, blur_sigma, flow_amp, coarse_factor=None, interp='linear', **kwargs):
+        '''
+        :param coarse_factor: how much coarser to sample the noise, see random_flow
+        '''
         super(RandFlow_Uniform, self).__init__(**kwargs)
         n_dims = len(img_shape) - 1
 
         self.flow_shape = img_shape[:-1] + (n_dims,)
 
-        blur_kernel = image_utils.create_gaussian_kernel(blur_sigma, n_dims=n_dims, n_sigmas_per_side=4)
-        # TODO: make this work for 3D
-        if n_dims == 2:
-            blur_kernel = np.tile(np.reshape(blur_kernel, blur_kernel.shape + (1, 1)),
-                                  tuple([1] * n_dims) + (n_dims, 1))
-        else:
-            blur_kernel = np.reshape(blur_kernel, blur_kernel.shape + (1, 1))
-        self.blur_kernel = tf.constant(blur_kernel, dtype=tf.float32)
+        self.blur_sigma = blur_sigma
         self.flow_amp = flow_amp
         self.n_dims = n_dims
+        self.coarse_factor = coarse_factor
+        self.interp = interp
 
     def build(self, input_shape):
         self.built = True
 
     def call(self, inputs):
-        if self.n_dims == 2:
-            rand_flow = K.random_uniform(
-                shape=tf.convert_to_tensor(
-                    [tf.shape(inputs)[0], tf.shape(inputs)[1], tf.shape(inputs)[2], self.n_dims]),
-                minval=-self.flow_amp,
-                maxval=self.flow_amp, dtype='float32')
-            rand_flow = tf.nn.depthwise_conv2d(rand_flow, self.blur_kernel, strides=[1] * (self.n_dims + 2),
-                                               padding='SAME')
-        elif self.n_dims == 3:
-            rand_flow = K.random_uniform(
-                shape=tf.convert_to_tensor(
-                    [tf.shape(inputs)[0], tf.shape(inputs)[1], tf.shape(inputs)[2], tf.shape(inputs)[3], self.n_dims]),
-                minval=-self.flow_amp,
-                maxval=self.flow_amp, dtype='float32')
-
-            # blur it here, then again later?
-            rand_flow_list = tf.unstack(rand_flow, num=self.n_dims, axis=-1)
-            flow_chans = []
-            for c in range(self.n_dims):
-                flow_chan = tf.nn.conv3d(tf.expand_dims(rand_flow_list[c], axis=-1), self.blur_kernel,
-                                         strides=[1] * (self.n_dims + 2), padding='SAME')
-                flow_chans.append(flow_chan[:, :, :, :, 0])
-            rand_flow = tf.stack(flow_chans, axis=-1)
-        rand_flow = tf.reshape(rand_flow, [-1] + list(self.flow_shape))
+        # blur it here, then again later?
+        flow_shape = _flow_shape_like(inputs, self.flow_shape)
+        rand_flow = random_flow(
+            tf.shape(inputs)[0], flow_shape, self.blur_sigma, noise='uniform', flow_amp=self.flow_amp,
+            n_sigmas_per_side=4, coarse_factor=self.coarse_factor, interp=self.interp)
+        rand_flow = tf.reshape(rand_flow, [-1] + list(flow_shape))
         return rand_flow
 
     def compute_output_shape(self, input_shape):
@@ -190,90 +274,42 @@ class BlurFlow(Layer):
 
         self.flow_shape = tuple(img_shape[:-1]) + (n_dims,)
 
-        blur_kernel = image_utils.create_gaussian_kernel(blur_sigma, n_dims=n_dims, n_sigmas_per_side=2)
-        # TODO: make this work for 3D
-        if n_dims == 2:
-            blur_kernel = np.tile(np.reshape(blur_kernel, blur_kernel.shape + (1, 1)),
-                                  tuple([1] * n_dims) + (n_dims, 1))
-        else:
-            blur_kernel = np.reshape(blur_kernel, blur_kernel.shape + (1, 1))
-        self.blur_kernel = tf.constant(blur_kernel, dtype=tf.float32)
+        self.blur_sigma = blur_sigma
         self.n_dims = n_dims
 
     def build(self, input_shape):
         self.built = True
 
     def call(self, inputs):
-        # squeeze chanenls into batch so we can do a single conv
-        flow_flat = tf.transpose(inputs, [0, 4, 1, 2, 3])
-        flow_flat = tf.reshape(flow_flat, [-1] + list(self.flow_shape[:-1]))
-        # convolve with blurring filter
-        flow_blurred = tf.nn.conv3d(tf.expand_dims(flow_flat, axis=-1), self.blur_kernel,
-                                    strides=[1] * (self.n_dims + 2), padding='SAME')
-        # get rid of extra channels
-        flow_blurred = flow_blurred[:, :, :, :, 0]
-
-        flow_out = tf.reshape(flow_blurred, [-1, self.n_dims] + list(self.flow_shape[:-1]))
-        flow_out = tf.transpose(flow_out, [0, 2, 3, 4, 1])
-
-        '''
-        rand_flow_list = tf.unstack(inputs, num=self.n_dims, axis=-1)
-        flow_chans = []
-        for c in range(self.n_dims):
-            flow_chan = tf.nn.conv3d(tf.expand_dims(rand_flow_list[c], axis=-1), self.blur_kernel,
-                                     strides=[1] * (self.n_dims + 2), padding='SAME')
-            flow_chans.append(flow_chan[:, :, :, :, 0])
-        rand_flow = tf.stack(flow_chans, axis=-1)
-        '''
-        return flow_out
+        flow_out = gaussian_blur(inputs, self.blur_sigma, self.n_dims, n_sigmas_per_side=2)
+        return tf.reshape(flow_out, [-1] + list(self.flow_shape))
 
 
 class RandFlow(Layer):
-    def __init__(self, img_shape, blur_sigma, flow_sigma, normalize_max=False, **kwargs):
+    def __init__(self, img_shape, blur_sigma, flow_sigma, normalize_max=False, coarse_factor=None, interp='linear',
+                 **kwargs):
+        '''
+        :param coarse_factor: how much coarser to sample the noise, see random_flow
+        '''
         super(RandFlow, self).__init__(**kwargs)
         n_dims = len(img_shape) - 1
 
         self.flow_shape = img_shape[:-1] + (n_dims,)
 
-        if blur_sigma > 0:
-            blur_kernel = image_utils.create_gaussian_kernel(blur_sigma, n_dims=n_dims)
-            # TODO: make this work for 3D
-            if n_dims == 2:
-                blur_kernel = np.tile(np.reshape(blur_kernel, blur_kernel.shape + (1, 1)),
-                                      tuple([1] * n_dims) + (n_dims, 1))
-            else:
-                blur_kernel = np.reshape(blur_kernel, blur_kernel.shape + (1, 1))
-            self.blur_kernel = tf.constant(blur_kernel, dtype=tf.float32)
-        else:
-            self.blur_kernel = None
+        self.blur_sigma = blur_sigma
         self.flow_sigma = flow_sigma
         self.normalize_max = normalize_max
         self.n_dims = n_dims
+        self.coarse_factor = coarse_factor
+        self.interp = interp
         print('Randflow dims: {}'.format(self.n_dims))
 
     def build(self, input_shape):
         self.built = True
 
     def call(self, inputs):
-        if self.n_dims == 2:
-            rand_flow = K.random_normal(shape=tf.convert_to_tensor(
-                [tf.shape(inputs)[0], tf.shape(inputs)[1], tf.shape(inputs)[2], self.n_dims]), mean=0., stddev=1.,
-                                        dtype='float32')
-            rand_flow = tf.nn.depthwise_conv2d(rand_flow, self.blur_kernel, strides=[1] * (self.n_dims + 2),
-                                               padding='SAME')
-        elif self.n_dims == 3:
-            rand_flow = K.random_normal(
-                shape=tf.convert_to_tensor(
-                    [tf.shape(inputs)[0], tf.shape(inputs)[1], tf.shape(inputs)[2], tf.shape(inputs)[3], self.n_dims]),
-                mean=0., stddev=1., dtype='float32')
-            if self.blur_kernel is not None:
-                rand_flow_list = tf.unstack(rand_flow, num=3, axis=-1)
-                flow_chans = []
-                for c in range(self.n_dims):
-                    flow_chan = tf.nn.conv3d(tf.expand_dims(rand_flow_list[c], axis=-1), self.blur_kernel,
-                                             strides=[1] * (self.n_dims + 2), padding='SAME')
-                    flow_chans.append(flow_chan[:, :, :, :, 0])
-                rand_flow = tf.stack(flow_chans, axis=-1)
+        rand_flow = random_flow(tf.shape(inputs)[0], _flow_shape_like(inputs, self.flow_shape), self.blur_sigma,
+                                coarse_factor=self.coarse_factor, interp=self.interp)
 
         #		rand_flow = K.cast(rand_flow / tf.reduce_max(tf.abs(rand_flow)) * self.flow_sigma, dtype='float32')
         if self.normalize_max:
@@ -295,16 +331,11 @@ class DilateAndBlur(Layer):
 
         self.flow_shape = img_shape[:-1] + (n_dims,)
 
-        dilate_kernel = np.reshape(
-            cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_kernel_size, dilate_kernel_size)),
-            (dilate_kernel_size, dilate_kernel_size, 1, 1))
-        self.dilate_kernel = tf.constant(dilate_kernel, dtype=tf.float32)
-
-        blur_kernel = image_utils.create_gaussian_kernel(blur_sigma, n_dims=n_dims)
-        blur_kernel = np.reshape(blur_kernel, blur_kernel.shape + (1, 1))
-        blur_kernel = blur_kernel / np.max(blur_kernel)  # normalize by max instead of by sum
+        self.dilate_kernel = constant_utils.get_constant('ellipse_structuring_element', size=dilate_kernel_size)
 
-        self.blur_kernel = tf.constant(blur_kernel, dtype=tf.float32)
+        # normalize by max instead of by sum
+        self.blur_kernel = constant_utils.get_constant(
+            'gaussian_kernel', sigma=blur_sigma, n_dims=n_dims, normalize='max')
         self.flow_sigma = flow_sigma
 
     def build(self, input_shape):
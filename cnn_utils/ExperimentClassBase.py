@@ -1,12 +1,12 @@
+import copy
 import json
 import logging
 import os
 import sys
 
 import numpy as np
-from keras.utils import plot_model
 
-from cnn_utils import file_utils
+from cnn_utils import build_cache_utils, file_utils, grad_accum_utils, progressive_utils
 
 
 class Experiment(object):
@@ -59,6 +59,26 @@ class Experiment(object):
         # initialize a buffer in case we want to do early stopping based on validation loss
         self.validation_losses_buffer = []
 
+        # set this to snapshot the results of load_data (see data_cache_utils.cached_load_data)
+        self.data_cache_dir = None
+        # set this to cache model configs, summaries and diagrams (see build_cache_utils)
+        self.build_cache_dir = None
+
+        # positions of our batch generators, e.g. pass self.data_state.setdefault('train', {}) to gen_batch
+        self.data_state = {}
+
+        # when training data-parallel (see parallel_utils), each worker should only train on its own shard,
+        # e.g. by passing shard_idx=self.data_rank, n_shards=self.data_world_size to gen_batch
+        self.data_rank = 0
+        self.data_world_size = 1
+
+        # split each training batch into this many micro-batches and accumulate their gradients (see grad_accum_utils)
+        self.n_micro_batches = 1
+
+        # fraction of the full input resolution that we are training at (see progressive_utils)
+        self.input_scale = 1.
+        self._full_res_trainer = None
+
         # point loggers at correct log files and stdout
         self._init_logger()
 
@@ -141,6 +161,72 @@ class Experiment(object):
     def create_generators(self, batch_size):
         print('create_generators not implemented')
 
+    def accumulate_gradients(self, model):
+        '''
+        Makes model train on self.n_micro_batches micro-batches at a time. Call this on any model that
+        we train with train_on_batch, after compiling it
+        '''
+        if self.n_micro_batches > 1 \
+                and not isinstance(getattr(model, 'train_function', None), grad_accum_utils.GradientAccumulator):
+            accumulator = grad_accum_utils.GradientAccumulator(model, self.n_micro_batches)
+            accumulator.micro_batch_callbacks += [l.feed_micro_batch for l in self._feature_cached_losses()]
+        return model
+
+    def _feature_cached_losses(self):
+        # losses that compare against cached target features (e.g. metrics.VggFeatLoss with a feature_cache), and
+        # so need the features of each batch fed in before its step
+        candidates = list(vars(self).values()) \
+            + [getattr(f, '__self__', None) for f in (getattr(self, 'loss_functions', None) or [])]
+        losses = []
+        for c in candidates:
+            if getattr(c, 'feature_cache', None) is not None and hasattr(c, 'feed_target_features') \
+                    and not any([c is l for l in losses]):
+                losses.append(c)
+        return losses
+
+    def check_resolution_schedule(self, schedule):
+        '''
+        Called before training with a progressive_utils resolution schedule. set_resolution reuses trainer_model's
+        losses at lower resolutions, so by default this raises if any of them is built for a fixed input shape
+        (see progressive_utils.fixed_resolution_losses). Experiments that override set_resolution to rebuild
+        those losses should override this too.
+        '''
+        if all([scale == 1 for _, scale in schedule]):
+            return
+        losses = progressive_utils.fixed_resolution_losses(self.trainer_model)
+        # losses with cached target features only have them at the full resolution, even if they aren't in
+        # trainer_model's losses
+        losses += [l for l in self._feature_cached_losses() if not any([l is fl for fl in losses])]
+        if len(losses) > 0:
+            raise ValueError('Cannot train {} at lower resolutions, since these losses are built for its full '
+                             'resolution: {}. Override set_resolution to rebuild them'.format(
+                                 self.trainer_model.name, ', '.join([type(l).__name__ for l in losses])))
+
+    def set_resolution(self, scale):
+        '''
+        Switches training to a fraction of the full input resolution. By default, this calls self.trainer_model
+        on downsampled inputs (sharing its weights), compiles that with the same losses and its own copy of the
+        optimizer, and downsamples the batches from self.train_gen. Experiments whose losses refer to tensors inside
+        trainer_model or are built for a fixed input shape (see check_resolution_schedule), or which need a
+        different data pipeline (e.g. a progressive_utils.ImagePyramid), should override this.
+        '''
+        if self._full_res_trainer is None:
+            self._full_res_trainer = {'trainer_model': self.trainer_model, 'train_gen': self.train_gen}
+        full_res_model = self._full_res_trainer['trainer_model']
+
+        if scale == 1:
+            self.trainer_model = full_res_model
+            self.train_gen = self._full_res_trainer['train_gen']
+        else:
+            self.trainer_model = progressive_utils.compile_like(
+                progressive_utils.resize_model(full_res_model, scale), full_res_model)
+            self.accumulate_gradients(self.trainer_model)
+
+            full_res_shape = [x for x in full_res_model.inputs if len(x.get_shape()) >= 4][0].get_shape()[1:-1]
+            self.train_gen = progressive_utils.gen_resized_batches(
+                self._full_res_trainer['train_gen'], scale, full_res_shape=[int(d) for d in full_res_shape])
+        self.input_scale = scale
+
     def compile_models(self):
         self.logger.debug('Compiling generator with losses {}, names {} and weights {}'.format(
             self.loss_functions, self.loss_names, self.loss_weights))
@@ -158,17 +244,9 @@ class Experiment(object):
             models_to_print = self.models
 
         for m in models_to_print:
-            if do_display:
-                print(m.name)
-                m.summary(line_length=120)
-
-            if save_figs:
-                plot_model(
-                    m,
-                    to_file=os.path.join(figs_dir, m.name + '.jpg'),
-                    show_shapes=True)
-                with open(os.path.join(figs_dir, m.name + '.txt'), 'w') as fh:
-                    m.summary(print_fn=lambda x: fh.write(x + '\n'), line_length=120)
+            # skips plot_model if we have already drawn an identical model
+            build_cache_utils.save_model_figs(
+                m, figs_dir, cache_dir=self.build_cache_dir, do_display=do_display, save_figs=save_figs)
 
     def save_models(self, epoch, iter_count=None):
         for m in self.models:
@@ -233,6 +311,21 @@ class Experiment(object):
             lfh = logging.FileHandler(filename=os.path.join(self.exp_dir, 'profiler.log'))
             self.profiler_logger.handlers[0] = lfh
 
+    def _flush_log_files(self):
+        # write any buffered log messages to disk, without closing the log files
+        for logger in [self.logger, self.profiler_logger]:
+            if logger is not None:
+                for h in logger.handlers:
+                    h.flush()
+
+    def get_data_state(self):
+        return copy.deepcopy(self.data_state)
+
+    def set_data_state(self, data_state):
+        # update in place, since our generators hold references to these dicts
+        for k, v in data_state.items():
+            self.data_state.setdefault(k, {}).update(v)
+
     def make_results_im(self):
         return np.zeros((8, 8, 3))
 
@@ -3,7 +3,9 @@ import sys
 
 import cv2
 import numpy as np
-import scipy.ndimage as spnd
+
+from cnn_utils.lazy_utils import LazyModule
+spnd = LazyModule('scipy.ndimage')
 
 sys.path.append('../evolving_wilds')
 from cnn_utils import image_utils
@@ -1,9 +1,9 @@
 import numpy as np
 import cv2
 import math
-import scipy.io as sio
-from scipy.interpolate import RegularGridInterpolator, interp2d, RectBivariateSpline
-from scipy.ndimage import map_coordinates
+
+from cnn_utils.lazy_utils import LazyModule
+spnd = LazyModule('scipy.ndimage')
 
 
 def augScale(I, points=None, scale_rand=None, obj_scale=1.0, target_scale=1.0, pad_value=None, border_color=(0, 0, 0)):
@@ -312,8 +312,8 @@ def augProjective(I, max_theta=[15., 15., 15.], scale=1., max_shear=0.2):
     for c in range(I.shape[-1]):
         # image is currently centered at (0, 0), let's move it back to the center of the frame
         center_adjustment = np.tile(np.asarray([[w / 2.], [h / 2.]]), (1, xy_im.shape[-1]))
-        Vq = map_coordinates(I_in[:, :, c].transpose(),
-                             xy_im[:2] + center_adjustment, cval=1.)
+        Vq = spnd.map_coordinates(I_in[:, :, c].transpose(),
+                                  xy_im[:2] + center_adjustment, cval=1.)
         I_out[:, :, c] = np.reshape(Vq, img_shape[:-1])
     return I_out, theta
 
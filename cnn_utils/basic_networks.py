@@ -12,6 +12,8 @@ import keras.backend as K
 import numpy as np
 import tensorflow as tf
 
+from cnn_utils import recompute_utils
+
 def autoencoder(img_shape, latent_dim=10,
                 conv_chans = None,
                 n_convs_per_stage=1,
@@ -104,7 +106,12 @@ def encoder(x, img_shape,
             prefix='',
             ks=3,
             return_skips=False, use_residuals=False, use_maxpool=False, use_batchnorm=False,
-            kernel_initializer=None, bias_initializer=None):
+            kernel_initializer=None, bias_initializer=None,
+            checkpoint_stages=False):
+    '''
+    :param checkpoint_stages: mark the output of each stage as a checkpoint, so that the activations inside
+        each stage can be recomputed during backprop instead of stored (see recompute_utils)
+    '''
     skip_layers = []
     concat_skip_sizes = []
     n_dims = len(img_shape) - 1  # assume img_shape includes spatial dims, followed by channels
@@ -141,6 +148,9 @@ def encoder(x, img_shape,
                 x = BatchNormalization()(x)
             x = LeakyReLU(0.2, name='{}_enc_leakyrelu_{}_{}'.format(prefix, i, ci + 1))(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_enc_checkpoint_{}'.format(prefix, i))
+
         if return_skips:
             skip_layers.append(x)
             concat_skip_sizes.append(np.asarray(x.get_shape().as_list()[1:-1]))
@@ -195,7 +205,8 @@ def encoder_model(img_shape,
                 min_h = 5, min_c = None,
                 prefix = '',
                 ks = 3,
-             return_skips=False, use_residuals=False, use_maxpool=False):
+             return_skips=False, use_residuals=False, use_maxpool=False,
+                  checkpoint_stages=False):
     x = Input(img_shape, name='{}_enc_input'.format(prefix))
     y = encoder(x, img_shape=img_shape,
                 conv_chans=conv_chans,
@@ -203,7 +214,8 @@ def encoder_model(img_shape,
                 prefix=prefix, ks=ks,
                 return_skips=return_skips,
                 use_residuals=use_residuals,
-                use_maxpool=use_maxpool
+                use_maxpool=use_maxpool,
+                checkpoint_stages=checkpoint_stages,
                 )
     if dense_size is not None:
         y = Flatten()(y)
@@ -225,7 +237,8 @@ def encoder3D(x, img_shape,
             prefix='vte',
             ks=3,
             return_skips=False, use_residuals=False, use_maxpool=False,
-            max_time_downsample=None):
+            max_time_downsample=None,
+            checkpoint_stages=False):
     skip_layers = []
     concat_skip_sizes = []
 
@@ -253,6 +266,9 @@ def encoder3D(x, img_shape,
 
                 x = LeakyReLU(0.2, name='{}_enc_leakyrelu_{}_{}'.format(prefix, i, ci + 1))(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_enc_checkpoint_{}'.format(prefix, i))
+
         if return_skips:
             skip_layers.append(x)
             concat_skip_sizes.append(x.get_shape().as_list()[1:-1])
@@ -355,6 +371,7 @@ def decoder(x,
             target_vol_sizes=None,
             n_samples=1,
             kernel_initializer=None, bias_initializer=None,
+            checkpoint_stages=False,
             ):
     n_dims = len(output_shape) - 1
     if conv_chans is None:
@@ -459,6 +476,9 @@ def decoder(x,
             x = LeakyReLU(0.2,
                           name='{}_leakyrelu_{}_{}'.format(prefix, i, ci + 1))(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_checkpoint_{}'.format(prefix, i))
+
         if include_dropout and i < 2:
             x = Dropout(0.3)(x)
 
@@ -577,6 +597,7 @@ def unet2D(x_in,
            concat_at_stages=None,
            do_last_conv=True,
            ks=3,
+           checkpoint_stages=False,
            ):
 
     reg_params = {}
@@ -610,6 +631,9 @@ def unet2D(x_in,
                 x = Add()([residual_input, x])
             x = LeakyReLU(0.2)(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_enc_checkpoint_{}'.format(layer_prefix, i))
+
         if i < len(nf_enc) - 1:
             encodings.append(x)
             if use_maxpool:
@@ -651,6 +675,9 @@ def unet2D(x_in,
                 x = Add()([residual_input, x])
             x = LeakyReLU(0.2)(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_dec_checkpoint_{}'.format(layer_prefix, i))
+
     #x = Concatenate()([x, encodings[0]])
     '''
     for j in range(n_convs_per_stage - 1):
@@ -766,7 +793,12 @@ def unet3D(x_in,
            use_dropout=False,
            do_unpool=False,
             do_last_conv=True,
+           checkpoint_stages=False,
         ):
+    '''
+    :param checkpoint_stages: mark the output of each stage as a checkpoint, so that the activations inside
+        each stage can be recomputed during backprop instead of stored (see recompute_utils)
+    '''
     ks = 3
     if max_time_downsample is None:
         max_time_downsample = len(nf_enc)  # downsample in time all the way down
@@ -817,6 +849,9 @@ def unet3D(x_in,
 
             x = LeakyReLU(0.2)(x)
 
+        if checkpoint_stages:
+            x = recompute_utils.checkpoint(x, name='{}_enc_checkpoint_{}'.format(layer_prefix, i))
+
         encodings.append(x)
         encoding_im_sizes.append(np.asarray(x.get_shape().as_list()[1:-1]))
 
@@ -881,6 +916,8 @@ def unet3D(x_in,
                     x = Add()([residual_input, x])
                 x = LeakyReLU(0.2)(x)
 
+            if checkpoint_stages:
+                x = recompute_utils.checkpoint(x, name='{}_dec{}_checkpoint_{}'.format(layer_prefix, ti, i))
 
         if do_last_conv:
             y = Conv3D(out_im_chans, kernel_size=1, padding='same', kernel_regularizer=reg,
@@ -114,7 +114,8 @@ def gen_batch(ims_data, labels_data,
               convert_onehot=False, labels_to_onehot_mapping=None,
               aug_model=None, aug_params=None,
               yield_aug_params=False, yield_idxs=False,
-              random_seed=None):
+              random_seed=None, state=None,
+              shard_idx=0, n_shards=1):
     '''
 
     :param ims_data: list of images, or an image.
@@ -136,6 +137,11 @@ def gen_batch(ims_data, labels_data,
     :param yield_aug_params: include the random augmentation params used on the batch in the return values
     :param yield_idxs: include the indices that comprise this batch in the return values
     :param random_seed:
+    :param state: optional dict that we keep updated with our position in the data, so that it can be saved
+        and restored (see state_utils). If it already holds a position, we continue from there
+    :param shard_idx: only draw examples i where i % n_shards == shard_idx, e.g. for data-parallel workers
+        (see parallel_utils). Yielded idxs still index into the full ims_data
+    :param n_shards:
     :return:
     '''
     if random_seed:
@@ -177,8 +183,14 @@ def gen_batch(ims_data, labels_data,
         else:
             assert len(convert_onehot) == len(labels_data)
 
+    if n_shards > 1:
+        ims_data = [im_data[shard_idx::n_shards] for im_data in ims_data]
+        if labels_data is not None:
+            labels_data = [Y[shard_idx::n_shards] if Y is not None else None for Y in labels_data]
 
     idxs = [-1]
+    if state is not None and 'last_idx' in state:
+        idxs = [state['last_idx']]
 
     n_ims = ims_data[0].shape[0]
     h = ims_data[0].shape[1]
@@ -242,15 +254,22 @@ def gen_batch(ims_data, labels_data,
         else:
             labels_batches = None
 
+        # idxs into the full dataset rather than into our shard
+        out_idxs = idxs if n_shards == 1 else shard_idx + idxs * n_shards
+
         if not randomize and restart_idxs:
             idxs[-1] = -1
 
+        if state is not None:
+            state['last_idx'] = int(idxs[-1])
+            state['n_batches'] = state.get('n_batches', 0) + 1
+
         if yield_aug_params and yield_idxs:
-            yield tuple(ims_batches) +  tuple(labels_batches) + (out_aug_params, idxs)
+            yield tuple(ims_batches) +  tuple(labels_batches) + (out_aug_params, out_idxs)
         elif yield_aug_params:
             yield tuple(ims_batches) + tuple(labels_batches) + (out_aug_params, )
         elif yield_idxs:
-            yield tuple(ims_batches) + tuple(labels_batches) + (idxs, )
+            yield tuple(ims_batches) + tuple(labels_batches) + (out_idxs, )
         elif labels_data is not None:
             yield tuple(ims_batches) + tuple(labels_batches)
         else:
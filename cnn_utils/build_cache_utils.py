@@ -0,0 +1,174 @@
+'''
+Caches for the slow parts of building models at startup.
+
+- build_model caches the config of a model returned by a builder function (e.g. basic_networks.encoder_model
+  or cvae_modules.transformer_concat_model), keyed by the builder name, a hash of its module's source and a hash of
+  its arguments. Later launches rebuild the model from its config with model_from_json instead of calling the
+  builder. In an experiment's create_models, call e.g.
+  build_cache_utils.build_model(basic_networks.encoder_model, img_shape, cache_dir=self.build_cache_dir, ...)
+- save_model_figs caches the summary text and the plot_model diagram of a model, keyed by a hash of its config,
+  so that Experiment._print_models can skip graphviz if the architecture hasn't changed.
+
+Builders whose arguments can't be hashed (e.g. they take other models or tensors) are always called directly, and
+models with custom layers that don't implement get_config are never cached, since model_from_json would rebuild
+those layers with their default arguments.
+'''
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+
+def _hash_str(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def builder_key(builder_fn, args, kwargs):
+    '''
+    :return: cache key for calling builder_fn(*args, **kwargs), or None if the args can't be hashed
+    '''
+    import keras
+
+    def _no_objects(o):
+        # shapes are often tuples, numpy ints, etc. Anything else (models, tensors, layers) makes the call uncacheable
+        if hasattr(o, 'tolist'):
+            return o.tolist()
+        raise TypeError('Cannot hash {}'.format(type(o)))
+
+    try:
+        args_str = json.dumps({'args': args, 'kwargs': kwargs}, sort_keys=True, default=_no_objects)
+    except (TypeError, ValueError):
+        return None
+    return '{}.{}_{}'.format(
+        builder_fn.__module__, builder_fn.__name__,
+        _hash_str('{}_{}_{}'.format(keras.__version__, get_module_version(builder_fn), args_str))[:16])
+
+
+def get_module_version(fn):
+    # hash the source of the module that fn is defined in, so that editing a builder invalidates its cached configs
+    try:
+        src = inspect.getsource(inspect.getmodule(fn))
+    except (OSError, TypeError):
+        src = fn.__module__
+    return _hash_str(src)[:12]
+
+
+def _iter_layers(model):
+    for layer in model.layers:
+        yield layer
+        if hasattr(layer, 'layers'):  # nested model
+            yield from _iter_layers(layer)
+
+
+def config_round_trips(model, custom_objects=None):
+    '''
+    :return: True if model_from_json can rebuild every layer of model from its config, i.e. each layer is either a
+        keras layer, or a custom layer in custom_objects that implements its own get_config
+    '''
+    from keras.layers import Layer
+    custom_objects = custom_objects or {}
+
+    for layer in _iter_layers(model):
+        layer_cls = type(layer)
+        if layer_cls.__module__.startswith('keras.'):
+            continue
+        if layer_cls.__name__ not in custom_objects or layer_cls.get_config is Layer.get_config:
+            return False
+    return True
+
+
+def build_model(builder_fn, *args, cache_dir=None, custom_objects=None, **kwargs):
+    '''
+    Calls builder_fn(*args, **kwargs), or rebuilds its model from a cached config.
+
+    :param cache_dir: directory to cache model configs in. If None, the builder is always called
+    :param custom_objects: custom layers used in the model, for model_from_json
+    '''
+    if cache_dir is None:
+        return builder_fn(*args, **kwargs)
+
+    key = builder_key(builder_fn, args, kwargs)
+    if key is None:
+        return builder_fn(*args, **kwargs)
+
+    from keras.models import model_from_json
+
+    config_file = os.path.join(cache_dir, key + '.json')
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as f:
+            model_json = f.read()
+        try:
+            return model_from_json(model_json, custom_objects=custom_objects)
+        except Exception:
+            # e.g. a custom layer that isn't in custom_objects. Just build it the slow way
+            pass
+
+    model = builder_fn(*args, **kwargs)
+    if not config_round_trips(model, custom_objects):
+        return model
+    try:
+        model_json = model.to_json()
+    except Exception:
+        return model
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = config_file + '.tmp{}'.format(os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(model_json)
+    os.replace(tmp_file, config_file)
+    return model
+
+
+def model_config_hash(model):
+    try:
+        return _hash_str(model.to_json())[:16]
+    except Exception:
+        return None
+
+
+def save_model_figs(model, figs_dir, cache_dir=None, do_display=True, save_figs=True):
+    '''
+    Writes <model name>.txt (summary) and <model name>.jpg (diagram) to figs_dir, copying them from the cache
+    if we have already made them for an identical model.
+    '''
+    summary_file = os.path.join(figs_dir, model.name + '.txt')
+    diagram_file = os.path.join(figs_dir, model.name + '.jpg')
+
+    config_hash = model_config_hash(model) if cache_dir is not None else None
+    if config_hash is not None:
+        cached_summary_file = os.path.join(cache_dir, '{}_{}.txt'.format(model.name, config_hash))
+        cached_diagram_file = os.path.join(cache_dir, '{}_{}.jpg'.format(model.name, config_hash))
+
+        if os.path.isfile(cached_summary_file) and (os.path.isfile(cached_diagram_file) or not save_figs):
+            if do_display:
+                print(model.name)
+                with open(cached_summary_file, 'r') as f:
+                    print(f.read())
+            if save_figs:
+                shutil.copyfile(cached_summary_file, summary_file)
+                shutil.copyfile(cached_diagram_file, diagram_file)
+            return
+
+    if do_display:
+        print(model.name)
+        model.summary(line_length=120)
+
+    summary_lines = []
+    model.summary(print_fn=lambda x: summary_lines.append(x), line_length=120)
+    summary_str = '\n'.join(summary_lines) + '\n'
+
+    if save_figs:
+        from keras.utils import plot_model
+        plot_model(model, to_file=diagram_file, show_shapes=True)
+        with open(summary_file, 'w') as fh:
+            fh.write(summary_str)
+
+    if config_hash is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(cached_summary_file, 'w') as f:
+            f.write(summary_str)
+        if save_figs:
+            shutil.copyfile(diagram_file, cached_diagram_file)
@@ -0,0 +1,201 @@
+'''
+Registry of precomputed constants (blur kernels, structuring elements, degree maps, coordinate grids) for
+layers and losses.
+
+Each constant is computed in numpy once per (kind, params, dtype), and added to each graph once, so every layer,
+loss and model in the graph that asks for the same constant shares a single tensor:
+
+    blur_kernel = constant_utils.get_constant('gaussian_kernel', sigma=2., n_dims=2, n_in_chans=2)
+
+Constants that only depend on shapes (e.g. the degree matrix of a grid) are computed here in numpy rather than
+with ops that tf would have to evaluate at run time.
+'''
+import numpy as np
+
+from cnn_utils.lazy_utils import LazyModule
+tf = LazyModule('tensorflow')
+
+# kind: function of params that returns a numpy array
+_builders = {}
+
+# (kind, params) -> numpy array
+_arrays = {}
+
+# graph -> {(kind, params, dtype): tensor}
+_tensors = {}
+
+
+def register_constant(kind):
+    '''
+    Decorator that registers a numpy function as the builder for a kind of constant.
+    '''
+    def _register(fn):
+        _builders[kind] = fn
+        return fn
+    return _register
+
+
+def _freeze(v):
+    # make params hashable so that we can use them as keys
+    if isinstance(v, (list, tuple, np.ndarray)):
+        return tuple([_freeze(x) for x in v])
+    elif isinstance(v, dict):
+        return tuple(sorted([(k, _freeze(x)) for k, x in v.items()]))
+    return v
+
+
+def get_array(kind, **params):
+    '''
+    :return: the numpy array for this kind of constant and params. Don't modify it, since it is shared
+    '''
+    if kind not in _builders:
+        raise ValueError('Unknown constant kind {}, expected one of {}'.format(kind, sorted(_builders.keys())))
+
+    key = (kind, _freeze(params))
+    if key not in _arrays:
+        _arrays[key] = _builders[kind](**params)
+    return _arrays[key]
+
+
+def get_constant(kind, dtype='float32', **params):
+    '''
+    :return: a constant tensor in the default graph for this kind of constant and params
+    '''
+    graph = tf.get_default_graph()
+    if graph not in _tensors:
+        _tensors.clear()  # we only ever build in one graph at a time, so don't hold on to old ones
+        _tensors[graph] = {}
+
+    key = (kind, _freeze(params), dtype)
+    graph_tensors = _tensors[graph]
+    if key not in graph_tensors:
+        # the tensor is shared by every later caller, so don't pick up the control dependencies (e.g. from a
+        # tf.control_dependencies block in a loss) or while loop context of whoever happens to ask first
+        with graph.as_default(), tf.control_dependencies(None), tf.name_scope('constants/'):
+            graph_tensors[key] = tf.constant(get_array(kind, **params), dtype=dtype, name=kind)
+    return graph_tensors[key]
+
+
+@register_constant('gaussian_kernel')
+def gaussian_kernel(sigma, n_dims=2, n_sigmas_per_side=8, n_in_chans=1, normalize='sum'):
+    '''
+    Gaussian kernel shaped for tf convolutions, i.e. [*kernel_shape, n_in_chans, 1]. Use n_in_chans > 1 for
+    depthwise convolutions.
+
+    :param normalize: 'sum' to sum to 1, or 'max' to have a max of 1
+    '''
+    from cnn_utils import image_utils
+    kernel = image_utils.create_gaussian_kernel(sigma, n_dims=n_dims, n_sigmas_per_side=n_sigmas_per_side)
+    if normalize == 'max':
+        kernel = kernel / np.max(kernel)
+    return np.tile(np.reshape(kernel, kernel.shape + (1, 1)), (1,) * n_dims + (n_in_chans, 1))
+
+
+@register_constant('gaussian_kernel_1d')
+def gaussian_kernel_1d(sigma, axis, n_dims=2, n_sigmas_per_side=8):
+    '''
+    1D gaussian kernel along axis, shaped for a single channel tf convolution, e.g. [1, k, 1, 1] for axis=1
+    in 2D. Convolving with this along each axis is the same as convolving with gaussian_kernel.
+    '''
+    from cnn_utils import image_utils
+    kernel = image_utils.create_gaussian_kernel_1d(sigma, n_sigmas_per_side=n_sigmas_per_side)
+    kernel_shape = [1] * n_dims + [1, 1]
+    kernel_shape[axis] = kernel.shape[0]
+    return np.reshape(kernel, kernel_shape)
+
+
+def _upsample_taps(n_in, n_out, factor, interp='linear'):
+    # output voxel i samples the input at i / factor. Returns the input idxs and weights of each tap,
+    # both [n_taps, n_out]
+    p = np.arange(n_out) / float(factor)
+    lo = np.floor(p).astype(int)
+    t = p - lo
+    if interp == 'linear':
+        offsets = [0, 1]
+        weights = [1. - t, t]
+    elif interp == 'bspline':
+        # cubic b-spline basis. This approximates rather than interpolates, so it smooths a little more
+        offsets = [-1, 0, 1, 2]
+        weights = [(1. - t) ** 3 / 6.,
+                   (3. * t ** 3 - 6. * t ** 2 + 4.) / 6.,
+                   (-3. * t ** 3 + 3. * t ** 2 + 3. * t + 1.) / 6.,
+                   t ** 3 / 6.]
+    else:
+        raise ValueError('Unknown interpolation {}'.format(interp))
+    idxs = np.clip(lo[np.newaxis] + np.reshape(offsets, (-1, 1)), 0, n_in - 1)
+    return idxs, np.stack(weights, axis=0)
+
+
+@register_constant('upsample_idxs')
+def upsample_idxs(n_in, n_out, factor, interp='linear'):
+    return _upsample_taps(n_in, n_out, factor, interp)[0]
+
+
+@register_constant('upsample_weights')
+def upsample_weights(n_in, n_out, factor, interp='linear'):
+    return _upsample_taps(n_in, n_out, factor, interp)[1]
+
+
+@register_constant('ellipse_structuring_element')
+def ellipse_structuring_element(size):
+    # [size, size, 1, 1] filter for dilating a single channel image
+    import cv2
+    return np.reshape(cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)), (size, size, 1, 1))
+
+
+@register_constant('laplacian_kernel')
+def laplacian_kernel():
+    # [3, 3, 1, 1] filter
+    return np.reshape(np.asarray([[0, -1, 0],
+                                  [-1, 4, -1],
+                                  [0, -1, 0]], dtype=np.float32), (3, 3, 1, 1))
+
+
+@register_constant('degree_map')
+def degree_map(shape):
+    '''
+    Number of 4-connected neighbors of each pixel of an image, i.e. the diagonal of the degree matrix of the
+    pixel grid. This is the same as convolving an image of ones with a neighbors filter with 'SAME' padding.
+
+    :param shape: (h, w, n_chans)
+    :return: [1, 1, h, w, n_chans]
+    '''
+    h, w, n_chans = shape
+    n_neighbors_y = 2 - (np.arange(h) == 0).astype(int) - (np.arange(h) == h - 1).astype(int)
+    n_neighbors_x = 2 - (np.arange(w) == 0).astype(int) - (np.arange(w) == w - 1).astype(int)
+    D = n_neighbors_y[:, np.newaxis] + n_neighbors_x[np.newaxis, :]
+    return np.tile(np.reshape(D, (1, 1, h, w, 1)), (1, 1, 1, 1, n_chans))
+
+
+@register_constant('coordinate_grid')
+def coordinate_grid(shape):
+    '''
+    Pixel coordinates of an image, in x, y order.
+
+    :param shape: (h, w)
+    :return: [1, h, w, 2]
+    '''
+    h, w = shape
+    xs, ys = np.meshgrid(np.arange(w), np.arange(h))
+    return np.stack([xs, ys], axis=-1)[np.newaxis]
+
+
+def _test_degree_map():
+    shape = (5, 7, 2)
+    D = degree_map(shape)
+
+    # brute force: count the neighbors that are inside the image
+    D_true = np.zeros(shape)
+    for y in range(shape[0]):
+        for x in range(shape[1]):
+            for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+                if 0 <= y + dy < shape[0] and 0 <= x + dx < shape[1]:
+                    D_true[y, x] += 1
+    assert D.shape == (1, 1) + shape
+    assert np.all(D[0, 0] == D_true)
+    assert get_array('degree_map', shape=list(shape)) is get_array('degree_map', shape=shape)
+    print('degree_map test: PASSED')
+
+
+if __name__ == '__main__':
+    _test_degree_map()
@@ -0,0 +1,331 @@
+'''
+Disk-backed snapshots of loaded datasets.
+
+The first time an experiment calls load_data with a given data_params (and version of the experiment code),
+the numpy arrays that load_data creates are written to a snapshot directory as .npy files. Later launches with
+the same params memory map them instead of rereading and preprocessing the raw images. Snapshots are evicted
+least-recently-used first when the cache grows past its size limit.
+
+Usage, in an Experiment subclass:
+    @data_cache_utils.cached_load_data
+    def load_data(self, load_n=None):
+        ...
+and set exp.data_cache_dir (e.g. from run_args.data_cache_dir) to turn it on.
+'''
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+SNAPSHOT_META_FILE = 'snapshot.json'
+
+
+def get_code_version(cls):
+    # hash the source of the experiment class and the classes it inherits from, so that changing how data is
+    # loaded (including in a base class's loader) invalidates old snapshots
+    srcs = []
+    for c in inspect.getmro(cls):
+        if c is object:
+            continue
+        try:
+            srcs.append(inspect.getsource(c))
+        except (OSError, TypeError):
+            srcs.append(c.__name__)
+    return hashlib.sha1('\n'.join(srcs).encode('utf-8')).hexdigest()[:12]
+
+
+def data_params_hash(data_params, code_version='', load_n=None):
+    canonical = json.dumps({'data_params': data_params, 'code_version': code_version, 'load_n': load_n},
+                           sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _dir_size(d):
+    return sum([os.path.getsize(os.path.join(d, f)) for f in os.listdir(d) if os.path.isfile(os.path.join(d, f))])
+
+
+class DatasetSnapshotCache(object):
+    def __init__(self, cache_dir, max_total_gb=50.):
+        self.cache_dir = cache_dir
+        self.max_total_bytes = max_total_gb * 2 ** 30
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _snapshot_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key):
+        # the meta file is written last, so its presence means the snapshot is complete
+        return os.path.isfile(os.path.join(self._snapshot_dir(key), SNAPSHOT_META_FILE))
+
+    def load(self, key):
+        '''
+        :return: dict of attribute name to value, with arrays memory mapped copy-on-write,
+            or None if there is no snapshot for this key
+        '''
+        if not self.has(key):
+            return None
+        snapshot_dir = self._snapshot_dir(key)
+        try:
+            with open(os.path.join(snapshot_dir, SNAPSHOT_META_FILE), 'r') as f:
+                meta = json.load(f)
+
+            # mark as recently used, for eviction
+            os.utime(os.path.join(snapshot_dir, SNAPSHOT_META_FILE))
+
+            attrs = {}
+            for name in meta['arrays']:
+                attrs[name] = np.load(os.path.join(snapshot_dir, name + '.npy'), mmap_mode='c')
+            if meta['has_others']:
+                with open(os.path.join(snapshot_dir, 'others.pkl'), 'rb') as f:
+                    attrs.update(pickle.load(f))
+        except OSError:
+            # another process evicted the snapshot after we checked for it. Clear out whatever is left, so
+            # that it can be saved again
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            return None
+        return attrs
+
+    def save(self, key, attrs, description=None):
+        '''
+        Writes a snapshot of attrs (dict of name to value). Arrays are saved as .npy files, everything else
+        is pickled. Safe to call from concurrent processes: the first one to finish wins.
+        '''
+        if self.has(key):
+            return
+
+        arrays = {k: v for k, v in attrs.items() if isinstance(v, np.ndarray) and v.dtype != object}
+        others = {k: v for k, v in attrs.items() if k not in arrays}
+
+        # write to a temporary dir and then move it into place, so that readers never see a partial snapshot
+        tmp_dir = os.path.join(self.cache_dir, '.tmp_{}_{}'.format(key, uuid.uuid4().hex))
+        os.makedirs(tmp_dir)
+        try:
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+            if len(others) > 0:
+                with open(os.path.join(tmp_dir, 'others.pkl'), 'wb') as f:
+                    pickle.dump(others, f)
+            with open(os.path.join(tmp_dir, SNAPSHOT_META_FILE), 'w') as f:
+                json.dump({'arrays': sorted(arrays.keys()), 'has_others': len(others) > 0,
+                           'description': description, 'created': time.time()}, f, default=str)
+            os.rename(tmp_dir, self._snapshot_dir(key))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self.has(key):
+                raise
+            # otherwise, another process beat us to it
+
+        self.evict(keep_keys=[key])
+
+    def evict(self, keep_keys=()):
+        '''
+        Removes the least recently used snapshots until the cache fits in max_total_bytes
+        '''
+        snapshots = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.') or not self.has(key):
+                continue
+            snapshot_dir = self._snapshot_dir(key)
+            last_used = os.path.getmtime(os.path.join(snapshot_dir, SNAPSHOT_META_FILE))
+            snapshots.append((last_used, key, _dir_size(snapshot_dir)))
+
+        total_bytes = sum([s[2] for s in snapshots])
+        for last_used, key, n_bytes in sorted(snapshots):
+            if total_bytes <= self.max_total_bytes:
+                break
+            if key in keep_keys:
+                continue
+            # existing memory maps stay valid after the files are removed
+            shutil.rmtree(self._snapshot_dir(key), ignore_errors=True)
+            total_bytes -= n_bytes
+
+
+def cached_load_data(load_data_fn):
+    '''
+    Decorator for Experiment.load_data. Snapshots all attributes that load_data sets on the experiment,
+    keyed by data_params, load_n and the source of the experiment class.
+    '''
+    @functools.wraps(load_data_fn)
+    def wrapper(self, *args, **kwargs):
+        cache_dir = getattr(self, 'data_cache_dir', None)
+        if cache_dir is None:
+            return load_data_fn(self, *args, **kwargs)
+
+        cache = DatasetSnapshotCache(cache_dir, max_total_gb=getattr(self, 'data_cache_max_gb', 50.))
+        load_n = kwargs.get('load_n', args[0] if len(args) > 0 else None)
+        key = data_params_hash(self.data_params, get_code_version(self.__class__), load_n)
+
+        attrs = cache.load(key)
+        if attrs is not None:
+            self.__dict__.update(attrs)
+            if getattr(self, 'logger', None) is not None:
+                self.logger.debug('Loaded data snapshot {} from {}'.format(key, cache_dir))
+            return attrs.get('_load_data_return')
+
+        attrs_before = dict(self.__dict__)
+        ret = load_data_fn(self, *args, **kwargs)
+
+        new_attrs = {k: v for k, v in self.__dict__.items()
+                     if k not in attrs_before or attrs_before[k] is not v}
+        new_attrs['_load_data_return'] = ret
+        try:
+            cache.save(key, new_attrs, description=self.data_params)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # some attributes (e.g. generators or open files) can't be snapshotted. Just don't cache
+            if getattr(self, 'logger', None) is not None:
+                self.logger.debug('Could not snapshot loaded data: {}'.format(e))
+        return ret
+    return wrapper
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir, n_examples, dtype=np.float32):
+        '''
+        Memory-mapped store of per-example features (e.g. the VGG activations of each target image), indexed by
+        the example's index in the dataset (e.g. from gen_batch with yield_idxs=True).
+
+        :param cache_dir: directory for one .npy file per feature, plus a mask of which examples are filled in.
+            Use a different directory for each dataset and feature network
+        :param n_examples: number of examples in the dataset
+        '''
+        self.cache_dir = cache_dir
+        self.n_examples = n_examples
+        self.dtype = dtype
+        self.features = None
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        mask_file = os.path.join(cache_dir, 'filled.npy')
+        if os.path.isfile(mask_file):
+            self.filled = np.lib.format.open_memmap(mask_file, mode='r+')
+            assert self.filled.shape[0] == n_examples
+            self._open_features()
+        else:
+            self.filled = np.lib.format.open_memmap(mask_file, mode='w+', dtype=bool, shape=(n_examples,))
+
+    def _feature_file(self, fi):
+        return os.path.join(self.cache_dir, 'feature{}.npy'.format(fi))
+
+    def _open_features(self, feature_shapes=None):
+        if feature_shapes is None:
+            n_features = len([f for f in os.listdir(self.cache_dir) if f.startswith('feature')])
+            self.features = [np.lib.format.open_memmap(self._feature_file(fi), mode='r+')
+                             for fi in range(n_features)]
+        else:
+            self.features = [np.lib.format.open_memmap(
+                self._feature_file(fi), mode='w+', dtype=self.dtype, shape=(self.n_examples,) + tuple(shape))
+                for fi, shape in enumerate(feature_shapes)]
+
+    def is_filled(self, idxs=None):
+        return bool(np.all(self.filled[idxs] if idxs is not None else self.filled))
+
+    def fill(self, X, compute_fn, batch_size=16):
+        '''
+        Computes the features of any examples that aren't in the cache yet.
+
+        :param X: array of all examples in the dataset, e.g. exp.X_train
+        :param compute_fn: function that maps a batch of examples to a list of feature arrays, e.g. feat_net.predict
+        '''
+        missing_idxs = np.where(~np.asarray(self.filled))[0]
+        for bi in range(0, len(missing_idxs), batch_size):
+            idxs = missing_idxs[bi:bi + batch_size]
+            feats = compute_fn(X[idxs])
+            if not isinstance(feats, list):
+                feats = [feats]
+            if self.features is None:
+                self._open_features([f.shape[1:] for f in feats])
+            for fi, f in enumerate(feats):
+                self.features[fi][idxs] = f
+            self.filled[idxs] = True
+
+        for f in (self.features or []):
+            f.flush()
+        self.filled.flush()
+
+    def get(self, idxs):
+        '''
+        :return: list of feature arrays for the examples at idxs
+        '''
+        if not self.is_filled(idxs):
+            raise KeyError('Features of examples {} are not cached'.format(
+                [int(i) for i in np.asarray(idxs)[~self.filled[idxs]]]))
+        return [f[idxs] for f in self.features]
+
+
+def _test_snapshot_cache():
+    import tempfile
+    n_loads = [0]
+
+    class FakeExp(object):
+        def __init__(self, cache_dir):
+            self.data_params = {'dataset': 'fake', 'img_shape': [4, 4, 3]}
+            self.data_cache_dir = cache_dir
+
+        @cached_load_data
+        def load_data(self, load_n=None):
+            n_loads[0] += 1
+            self.X_train = np.random.rand(load_n or 10, 4, 4, 3).astype(np.float32)
+            self.frame_ids = ['frame_{}'.format(i) for i in range(self.X_train.shape[0])]
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        exp = FakeExp(cache_dir)
+        exp.load_data(load_n=5)
+        exp2 = FakeExp(cache_dir)
+        exp2.load_data(load_n=5)
+        assert n_loads[0] == 1  # loaded from the snapshot
+        assert np.all(exp2.X_train == exp.X_train) and exp2.frame_ids == exp.frame_ids
+        assert isinstance(exp2.X_train, np.memmap)
+
+        exp2.load_data(load_n=6)  # different params should not hit the cache
+        assert n_loads[0] == 2
+
+        # a snapshot that is evicted while we load it falls back to load_data
+        key = data_params_hash(exp.data_params, get_code_version(FakeExp), 5)
+        os.remove(os.path.join(cache_dir, key, 'X_train.npy'))
+        FakeExp(cache_dir).load_data(load_n=5)
+        assert n_loads[0] == 3
+        FakeExp(cache_dir).load_data(load_n=5)  # and snapshots it again
+        assert n_loads[0] == 3
+
+        cache = DatasetSnapshotCache(cache_dir, max_total_gb=0)
+        cache.evict()
+        assert len(os.listdir(cache_dir)) == 0
+        print('DatasetSnapshotCache test: PASSED')
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def _test_feature_cache():
+    import tempfile
+    X = np.random.rand(10, 4, 4, 3).astype(np.float32)
+    compute_fn = lambda x: [x * 2, np.mean(x, axis=(1, 2))]
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = FeatureCache(cache_dir, n_examples=10)
+        assert not cache.is_filled()
+        cache.fill(X, compute_fn, batch_size=3)
+
+        # reopen from disk
+        cache = FeatureCache(cache_dir, n_examples=10)
+        assert cache.is_filled()
+        feats = cache.get([7, 2])
+        assert np.allclose(feats[0], X[[7, 2]] * 2) and np.allclose(feats[1], np.mean(X[[7, 2]], axis=(1, 2)))
+        print('FeatureCache test: PASSED')
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    _test_snapshot_cache()
+    _test_feature_cache()
@@ -0,0 +1,185 @@
+'''
+Evaluates checkpoints in a separate process so that the training loop does not have to stop for test_joint.
+
+The trainer saves a checkpoint and submits its epoch to an EvalScheduler. A worker process with its own copy of
+the experiment (loaded with experiment_engine.load_experiment_from_dir) loads the checkpoint, runs test_joint and
+make_test_results_im, and sends the results back. Results are also appended to eval_results.jsonl in the experiment
+dir. The trainer polls for results, e.g. to do early stopping.
+'''
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+
+
+def _to_builtin(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    elif isinstance(x, (list, tuple)):
+        return [_to_builtin(xi) for xi in x]
+    elif isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def _eval_worker(exp_dir, exp_class, job_queue, result_queue,
+                 load_n=None, batch_size=8, gpus=None):
+    # import tensorflow-related modules in the worker only, so that it gets its own session
+    import cv2
+    from cnn_utils import experiment_engine
+
+    # evaluate on the cpu by default, to leave the gpu to the trainer
+    experiment_engine.configure_gpus(gpus if gpus is not None else [])
+
+    exp, _ = experiment_engine.load_experiment_from_dir(
+        exp_dir, exp_class,
+        load_n=load_n,
+        do_load_models=False,
+        prompt_update_name=False,
+        verbose=False,
+    )
+    exp.compile_models()
+    exp.create_generators(batch_size=batch_size)
+
+    logger = logging.getLogger(__name__)
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+
+        # if we have fallen behind, skip straight to the most recent checkpoint
+        n_skipped = 0
+        while True:
+            try:
+                next_job = job_queue.get_nowait()
+            except queue.Empty:
+                break
+            if next_job is None:
+                job_queue.put(None)  # make sure we still stop after this job
+                break
+            result_queue.put({'epoch': job[0], 'iter_count': job[1], 'skipped': True})
+            job = next_job
+            n_skipped += 1
+        if n_skipped > 0:
+            logger.warning('Eval worker skipped {} checkpoints'.format(n_skipped))
+
+        epoch, iter_count = job
+        result = {'epoch': epoch, 'iter_count': iter_count}
+        try:
+            exp.load_models(epoch)
+            test_loss, test_loss_names = exp.test_joint()
+            if not isinstance(test_loss, list):
+                test_loss = [test_loss]
+            result['loss_names'] = list(test_loss_names)
+            result['losses'] = _to_builtin(test_loss)
+            result['validation_losses_buffer'] = _to_builtin(exp.validation_losses_buffer)
+
+            results_im = exp.make_test_results_im(epoch)
+            if results_im is not None:
+                cv2.imwrite(os.path.join(exp.figures_dir, 'test_epoch{}_iter{}.jpg'.format(epoch, iter_count)),
+                            results_im)
+        except Exception as e:
+            result['error'] = repr(e)
+
+        with open(os.path.join(exp_dir, 'eval_results.jsonl'), 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        result_queue.put(result)
+
+
+class EvalScheduler(object):
+    def __init__(self, exp_dir, exp_class, load_n=None, batch_size=8, gpus=None):
+        '''
+        :param exp_dir: experiment dir that the trainer is saving checkpoints to
+        :param exp_class: experiment class to load checkpoints into. Must be importable by the worker
+        :param gpus: gpus for the worker to use. Evaluates on the cpu if None
+        '''
+        # spawn rather than fork, since the parent already has a tensorflow session
+        ctx = multiprocessing.get_context('spawn')
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self.n_pending = 0
+        # results that close() took off the queue before joining the worker
+        self._drained = []
+        self._final_exitcode = None
+
+        self._worker = ctx.Process(
+            target=_eval_worker,
+            args=(exp_dir, exp_class, self._jobs, self._results),
+            kwargs={'load_n': load_n, 'batch_size': batch_size, 'gpus': gpus},
+            name='eval_worker')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, epoch, iter_count):
+        # the checkpoint for this epoch must already be saved
+        self._jobs.put((epoch, iter_count))
+        self.n_pending += 1
+
+    def _get_result(self, block=False, timeout=None):
+        if len(self._drained) > 0:
+            return self._drained.pop(0)
+        return self._results.get(block=block, timeout=timeout)
+
+    def poll(self, block=False, timeout=None):
+        '''
+        If the worker has died, gives up on the pending results and logs an error. Check is_alive() to find
+        out whether to fall back to testing synchronously.
+
+        :return: list of result dicts that have finished since the last poll
+        '''
+        deadline = time.time() + timeout if block and timeout is not None else None
+        results = []
+        while self.n_pending > 0:
+            try:
+                # wake up every so often while blocking, so that we notice if the worker dies
+                wait = 1. if deadline is None else max(0., min(1., deadline - time.time()))
+                result = self._get_result(block=block, timeout=wait)
+            except queue.Empty:
+                if not self.is_alive() and self._results.empty():
+                    logging.getLogger(__name__).error(
+                        'Eval worker exited with code {}, dropping {} pending evaluations'.format(
+                            self._exitcode, self.n_pending))
+                    self.n_pending = 0
+                    break
+                if not block or (deadline is not None and time.time() >= deadline):
+                    break
+                continue
+            results.append(result)
+            self.n_pending -= 1
+        return results
+
+    @property
+    def _exitcode(self):
+        return self._worker.exitcode if self._worker is not None else self._final_exitcode
+
+    def is_alive(self):
+        return self._worker is not None and self._worker.is_alive()
+
+    def close(self, wait_for_pending=True):
+        if self._worker is None:
+            return
+        if not wait_for_pending:
+            # drop jobs that haven't started yet
+            while True:
+                try:
+                    self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                self.n_pending -= 1
+        self._jobs.put(None)
+
+        # a process that has put things on a queue doesn't exit until they are taken off, so take the results
+        # off before joining
+        while self._worker.is_alive() or not self._results.empty():
+            try:
+                self._drained.append(self._results.get(timeout=1.))
+            except queue.Empty:
+                continue
+        self._worker.join()
+        self._final_exitcode = self._worker.exitcode
+        self._worker = None
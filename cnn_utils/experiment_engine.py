@@ -5,25 +5,168 @@ import sys
 import time
 
 import cv2
-import keras.backend as K
 import numpy as np
-import tensorflow as tf
-from keras.utils import generic_utils
-from tensorflow.python.client import timeline
 
-from cnn_utils import my_callbacks
+from cnn_utils import eval_utils, parallel_utils, profiling_utils, progressive_utils, state_utils, telemetry_utils, timing_utils
+from cnn_utils.lazy_utils import LazyModule
+
+# tensorflow and keras are only loaded once we configure a session or start training
+K = LazyModule('keras.backend')
+tf = LazyModule('tensorflow')
+generic_utils = LazyModule('keras.utils.generic_utils')
+my_callbacks = LazyModule('cnn_utils.my_callbacks')
+recompute_utils = LazyModule('cnn_utils.recompute_utils')
+metrics = LazyModule('cnn_utils.metrics')
 import json
 
 
-def configure_gpus(gpus):
+def configure_gpus(gpus, config=None):
     # set gpu id and tf settings
     os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(g) for g in gpus])
-    config = tf.ConfigProto(allow_soft_placement=True)
+    if config is None:  # e.g. from configure_cpus
+        config = tf.ConfigProto(allow_soft_placement=True)
     config.gpu_options.allow_growth = True
 
     K.tensorflow_backend.set_session(tf.Session(config=config))
 
 
+def parse_core_list(cores):
+    # '0-3,8' -> [0, 1, 2, 3, 8]
+    if cores is None or isinstance(cores, list):
+        return cores
+    core_list = []
+    for r in str(cores).split(','):
+        if '-' in r:
+            start, end = r.split('-')
+            core_list += list(range(int(start), int(end) + 1))
+        elif len(r.strip()) > 0:
+            core_list.append(int(r))
+    return core_list
+
+
+def partition_cores(cores, timings_file):
+    '''
+    Splits cores between the model and the data pipeline, in proportion to the time that a previous run
+    spent in each (from the phase_timings.json saved by timing_utils.PhaseTimer.save)
+    '''
+    with open(timings_file, 'r') as f:
+        group_fractions = json.load(f)['group_fractions']
+    data_frac = group_fractions.get('data', 0.)
+    compute_frac = group_fractions.get('compute', 0.)
+    if data_frac + compute_frac == 0:
+        loader_share = 0.5
+    else:
+        loader_share = data_frac / (data_frac + compute_frac)
+
+    n_loader_cores = int(np.clip(np.round(len(cores) * loader_share), 1, len(cores) - 1))
+    return cores[n_loader_cores:], cores[:n_loader_cores]
+
+
+def configure_cpus(intra_op_threads=None, inter_op_threads=None,
+                   model_cores=None, loader_cores=None,
+                   auto_timings_file=None,
+                   set_session=True):
+    '''
+    Sets tf thread pool sizes, pins the tf session and the data pipeline to separate cores, and sets up
+    the MKL/OpenMP environment to match. Call this before any tf session is created. If you also need
+    configure_gpus, call this with set_session=False and pass the returned config to configure_gpus.
+
+    :param intra_op_threads, inter_op_threads: tf thread pool sizes. 0 or None lets tf decide,
+        unless model_cores is set, in which case we use one intra-op thread per model core
+    :param model_cores: list of cores (or a string like '0-5,12') for the tf session
+    :param loader_cores: cores for the python thread that runs the data pipeline, and any threads it starts
+    :param auto_timings_file: phase_timings.json from a previous run. If specified, all available cores are
+        partitioned between the model and the data pipeline according to where that run spent its time
+    :return: tf.ConfigProto, model cores, loader cores
+    '''
+    model_cores = parse_core_list(model_cores)
+    loader_cores = parse_core_list(loader_cores)
+
+    can_pin = hasattr(os, 'sched_setaffinity')
+    if can_pin:
+        available_cores = sorted(os.sched_getaffinity(0))
+    else:
+        available_cores = list(range(os.cpu_count()))
+
+    if auto_timings_file is not None and os.path.isfile(auto_timings_file) and len(available_cores) > 1:
+        model_cores, loader_cores = partition_cores(available_cores, auto_timings_file)
+    elif model_cores is not None and loader_cores is None:
+        loader_cores = [c for c in available_cores if c not in model_cores] or model_cores
+
+    if model_cores is not None and not intra_op_threads:
+        intra_op_threads = len(model_cores)
+    if model_cores is not None and not inter_op_threads:
+        inter_op_threads = min(2, len(model_cores))
+
+    # MKL and OpenMP read these when they initialize, so they need to be set before tf starts up.
+    # Don't override anything that the user has set explicitly
+    if intra_op_threads:
+        os.environ.setdefault('OMP_NUM_THREADS', str(intra_op_threads))
+        os.environ.setdefault('MKL_NUM_THREADS', str(intra_op_threads))
+    if model_cores is not None:
+        os.environ.setdefault('KMP_BLOCKTIME', '1')
+        os.environ.setdefault('KMP_AFFINITY', 'granularity=fine,compact,1,0')
+
+    # opencv has its own thread pool, keep it on the loader cores
+    if loader_cores is not None:
+        cv2.setNumThreads(len(loader_cores))
+
+    config = tf.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=intra_op_threads or 0,
+        inter_op_parallelism_threads=inter_op_threads or 0)
+
+    if set_session:
+        # tf's thread pools are created with the session and inherit the affinity of this thread.
+        # Once they exist, we move this thread (which runs the data pipeline) onto the loader cores
+        if can_pin and model_cores is not None:
+            os.sched_setaffinity(0, model_cores)
+        K.tensorflow_backend.set_session(tf.Session(config=config))
+        if can_pin and loader_cores is not None:
+            os.sched_setaffinity(0, loader_cores)
+
+    return config, model_cores, loader_cores
+
+
+def add_cpu_args(ap):
+    # run_args flags for configure_cpus_from_args
+    ap.add_argument('--intra_op_threads', type=int, default=None, help='TF intra-op thread pool size')
+    ap.add_argument('--inter_op_threads', type=int, default=None, help='TF inter-op thread pool size')
+    ap.add_argument('--model_cores', type=str, default=None, help='Cores for the TF session, e.g. 0-5,12')
+    ap.add_argument('--loader_cores', type=str, default=None, help='Cores for the data pipeline, e.g. 6-11')
+    ap.add_argument('--cpu_auto', type=str, default=None,
+                    help='phase_timings.json from a previous run, to partition cores automatically')
+    return ap
+
+
+def add_snapshot_args(ap):
+    # run_args flags for state_utils.TrainingStateSnapshotter
+    ap.add_argument('--snapshot_every', type=float, default=None,
+                    help='Snapshot the full training state every this many seconds, and at the end of each epoch')
+    ap.add_argument('--resume_state', action='store_true', default=False,
+                    help='Restore the optimizer, rngs and data order from the last snapshot in the experiment dir')
+    return ap
+
+
+def configure_cpus_from_args(run_args, gpus=None):
+    config, model_cores, loader_cores = configure_cpus(
+        intra_op_threads=run_args.intra_op_threads,
+        inter_op_threads=run_args.inter_op_threads,
+        model_cores=run_args.model_cores,
+        loader_cores=run_args.loader_cores,
+        auto_timings_file=run_args.cpu_auto,
+        set_session=gpus is None)
+
+    if gpus is not None:
+        # same as in configure_cpus, but the session is created by configure_gpus
+        if hasattr(os, 'sched_setaffinity') and model_cores is not None:
+            os.sched_setaffinity(0, model_cores)
+        configure_gpus(gpus, config=config)
+        if hasattr(os, 'sched_setaffinity') and loader_cores is not None:
+            os.sched_setaffinity(0, loader_cores)
+    return config
+
+
 # loads a saved experiment using the saved parameters.
 # runs all initialization steps so that we can use the models right away
 def load_experiment_from_dir(from_dir, exp_class,
@@ -33,6 +176,7 @@ def load_experiment_from_dir(from_dir, exp_class,
                              do_load_models=True,
                              prompt_update_name=True,
                              verbose=True,
+                             do_load_data=True,  # set this to False if run_experiment will do it anyway
                              ):
     with open(os.path.join(from_dir, 'arch_params.json'), 'r') as f:
         fromdir_arch_params = json.load(f)
@@ -47,6 +191,9 @@ def load_experiment_from_dir(from_dir, exp_class,
         prompt_update_name=prompt_update_name, # in case the experiment was renamed
         do_logging=do_logging)
 
+    if not do_load_data:
+        return exp, None
+
     exp.load_data(load_n=load_n)
     exp.create_models(verbose=verbose)
 
@@ -87,11 +234,14 @@ def run_experiment(exp, run_args,
 
     exp_dir, figures_dir, logs_dir, models_dir = exp.get_dirs()
 
+    # when training data-parallel (see parallel_utils), only the first worker writes checkpoints, images and logs
+    is_chief = getattr(run_args, 'rank', 0) == 0
+
     # log to the newly created experiments dir
     formatter = logging.Formatter(
         '[%(asctime)s] %(message)s', "%Y-%m-%d %H:%M:%S")
     lfh = logging.FileHandler(
-        filename=os.path.join(exp_dir, 'training.log'))
+        filename=os.path.join(exp_dir, 'training.log' if is_chief else 'training_rank{}.log'.format(run_args.rank)))
     lsh = logging.StreamHandler(sys.stdout)
     lfh.setFormatter(formatter)
     lsh.setFormatter(formatter)
@@ -107,32 +257,109 @@ def run_experiment(exp, run_args,
     file_logger.setLevel(logging.DEBUG)
     file_logger.addHandler(lfh)
 
+    # keep track of where launch time goes
+    startup_timer = timing_utils.PhaseTimer()
+
     # load the dataset. load fewer if debugging
-    exp.load_data(load_n=run_args.loadn)
+    if getattr(run_args, 'data_cache_dir', None) is not None:
+        exp.data_cache_dir = run_args.data_cache_dir
+    with startup_timer.phase('load_data'):
+        exp.load_data(load_n=run_args.loadn)
 
     # create models and load existing ones if necessary
-    exp.create_models()
+    if getattr(run_args, 'build_cache_dir', None) is not None:
+        exp.build_cache_dir = run_args.build_cache_dir
+    with startup_timer.phase('create_models'):
+        exp.create_models()
 
-    start_epoch = exp.load_models(run_args.epoch,
-        stop_on_missing=not run_args.ignore_missing,
-        init_layers=run_args.init_weights)
+    with startup_timer.phase('load_models'):
+        start_epoch = exp.load_models(run_args.epoch,
+            stop_on_missing=not run_args.ignore_missing,
+            init_layers=run_args.init_weights)
 
     # compile models for training
-    if run_args.do_profile:
-        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-        run_metadata = tf.RunMetadata()
+    if run_args.do_profile and is_chief:
+        # only trace one in every profile_every steps, since a full trace slows down every step
+        op_profiler = profiling_utils.SampledOpProfiler(
+            exp_dir, sample_every_n_steps=getattr(run_args, 'profile_every', 100))
+        run_options = op_profiler.run_options
+        run_metadata = op_profiler.run_metadata
     else:
+        op_profiler = None
         run_options = None
         run_metadata = None
 
-    exp.compile_models(run_options=run_options, run_metadata=run_metadata)
+    # bound activation memory by training on micro-batches, while still taking one step per batch
+    exp.n_micro_batches = getattr(run_args, 'micro_batches', None) or exp.n_micro_batches
+    with startup_timer.phase('compile_models'):
+        exp.compile_models(run_options=run_options, run_metadata=run_metadata)
+        # builders called with checkpoint_stages=True mark stage outputs that we can recompute from
+        if hasattr(exp, 'trainer_model') and recompute_utils.has_checkpoints(exp.trainer_model):
+            try:
+                mem = recompute_utils.estimate_activation_memory(
+                    exp.trainer_model, batch_size=max(1, run_args.batch_size // exp.n_micro_batches))
+                file_stdout_logger.debug(
+                    'Estimated activation memory for {}: {:.2f} GB, {:.2f} GB with recomputation from {} '
+                    'checkpoints'.format(exp.trainer_model.name, mem['full'] / 1e9, mem['recompute'] / 1e9,
+                                         mem['n_checkpoints']))
+            except AttributeError:
+                # layers that are called more than once don't have a single output_shape
+                file_stdout_logger.debug(
+                    'Could not estimate activation memory for {}'.format(exp.trainer_model.name))
+            if getattr(run_args, 'recompute', True):
+                recompute_utils.use_recompute_gradients(exp.trainer_model)
+
+        if hasattr(exp, 'trainer_model'):
+            exp.accumulate_gradients(exp.trainer_model)
+
+    if getattr(run_args, 'allreducer', None) is not None:
+        if exp.n_micro_batches > 1 and getattr(run_args, 'sync_every', 1) == 1:
+            raise ValueError('Micro-batches are only supported with data-parallel training if sync_every > 1')
+        if getattr(run_args, 'res_schedule', None):
+            raise ValueError('Progressive resolution is not supported with data-parallel training')
+        # average the trainer model's gradients with the other workers
+        parallel_utils.DataParallelTrainer(
+            exp.trainer_model, run_args.allreducer, sync_every_n_steps=getattr(run_args, 'sync_every', 1))
+
+    if op_profiler is not None:
+        op_profiler.watch_models([m for m in vars(exp).values() if hasattr(m, 'train_function')])
 
     if run_args.init_from:
-        exp.init_model_weights(run_args.init_from)
+        with startup_timer.phase('init_weights'):
+            exp.init_model_weights(run_args.init_from)
+
+    with startup_timer.phase('create_generators'):
+        exp.create_generators(batch_size=run_args.batch_size)
+
+    startup_timer.report(file_stdout_logger, title='Startup timings')
+    if is_chief:
+        startup_timer.save(os.path.join(exp_dir, 'startup_timings.json'))
+
+    if getattr(run_args, 'eval_async', False) and is_chief:
+        # test checkpoints in a separate process instead of pausing training
+        eval_scheduler = eval_utils.EvalScheduler(
+            exp_dir, exp.__class__,
+            load_n=run_args.loadn, batch_size=run_args.batch_size,
+            gpus=getattr(run_args, 'eval_gpus', None))
+    else:
+        eval_scheduler = None
+
+    # periodically snapshot the full training state, so that we can resume exactly where we left off.
+    # When training data-parallel, every worker restores the chief's snapshot so that they all resume from the
+    # same weights, optimizer slots and counters, but only the chief writes snapshots
+    snapshot_every = getattr(run_args, 'snapshot_every', None)
+    if snapshot_every or getattr(run_args, 'resume_state', False):
+        state_snapshotter = state_utils.TrainingStateSnapshotter(
+            exp, save_every_n_seconds=snapshot_every if is_chief else None)
+    else:
+        state_snapshotter = None
 
-    exp.create_generators(batch_size=run_args.batch_size)
+    tbw = tf.summary.FileWriter(logs_dir) if is_chief else None
+    telemetry = telemetry_utils.ScalarTelemetry(
+        tbw,
+        flush_every_n_seconds=getattr(run_args, 'telemetry_flush_every', 10.),
+        progbar_max_hz=getattr(run_args, 'progbar_max_hz', 4.))
 
-    tbw = tf.summary.FileWriter(logs_dir)
     if run_args.fit:
         train_using_fit_generator(
             exp=exp, batch_size=run_args.batch_size,
@@ -141,7 +368,11 @@ def run_experiment(exp, run_args,
             test_every_n_epochs=test_every_n_epochs,
             tbw=tbw, file_stdout_logger=file_stdout_logger, file_logger=file_logger,
             run_args=run_args,
-            early_stopping_eps=early_stopping_eps
+            early_stopping_eps=early_stopping_eps,
+            telemetry=telemetry,
+            op_profiler=op_profiler,
+            eval_scheduler=eval_scheduler,
+            state_snapshotter=state_snapshotter,
         )
     else:
         train_batch_by_batch(
@@ -152,9 +383,13 @@ def run_experiment(exp, run_args,
             tbw=tbw, file_stdout_logger=file_stdout_logger, file_logger=file_logger,
             run_args=run_args,
             early_stopping_eps=early_stopping_eps,
-            run_metadata=run_metadata,
+            telemetry=telemetry,
+            op_profiler=op_profiler,
+            eval_scheduler=eval_scheduler,
+            state_snapshotter=state_snapshotter,
         )
 
+    telemetry.close()
     return exp_dir
 
 
@@ -162,34 +397,57 @@ def train_using_fit_generator(
         exp, batch_size,
         start_epoch, end_epoch,
         tbw, file_stdout_logger, file_logger,
-        run_args, save_every_n_epochs, test_every_n_epochs
+        run_args, save_every_n_epochs, test_every_n_epochs,
+        early_stopping_eps=None,
+        telemetry=None,
+        op_profiler=None,
+        eval_scheduler=None,
+        state_snapshotter=None,
 ):
-    def refresh_logs(epoch=None):  # arg is purely for EveryNEpochs callback
-        file_stdout_logger.handlers[0].close()  # flush our .log file
-        lfh = logging.FileHandler(filename=os.path.join(exp_dir, 'training.log'))
-        formatter = logging.Formatter('[%(asctime)s] %(message)s', "%Y-%m-%d %H:%M:%S")
-        lfh.setFormatter(formatter)
-        lfh.setLevel(logging.DEBUG)
-        file_stdout_logger.handlers[0] = lfh
+    if telemetry is None:
+        telemetry = telemetry_utils.ScalarTelemetry(tbw)
 
-        if exp.logger is not None:
-            exp._reopen_log_file()
+    if len(exp._feature_cached_losses()) > 0:
+        # fit_generator draws batches ahead of the step that trains on them
+        raise ValueError('Losses with cached target features are only supported by train_batch_by_batch')
 
-        tbw.close()  # save to disk and then open a new file so that we can read into tensorboard more easily
-        tbw.reopen()
+    phase_timer = timing_utils.PhaseTimer()
+
+    def refresh_logs(epoch=None):  # arg is purely for EveryNEpochs callback
+        # flush our .log files and tensorboard events so we can look at them during training
+        telemetry_utils.flush_logger(file_stdout_logger)
+        exp._flush_log_files()
+        telemetry.flush()
+
+        phase_timer.report(file_logger)
+        phase_timer.export_chrome_trace(os.path.join(exp_dir, 'phase_timings.ctf.json'))
+        phase_timer.save(os.path.join(exp_dir, 'phase_timings.json'))
 
     def log_test_losses(iter_count):
+        nonlocal eval_scheduler
+        eval_scheduler = check_eval_worker(exp, eval_scheduler, telemetry, file_stdout_logger)
+        if eval_scheduler is not None:
+            # checkpoint and let the eval worker test it while we keep training
+            exp.save_models(exp.epoch_count, iter_count=iter_count)
+            eval_scheduler.submit(exp.epoch_count, iter_count)
+            handle_eval_results(exp, eval_scheduler.poll(), telemetry, file_stdout_logger)
+            return
+
         test_losses, test_loss_names = exp.test_joint()
-        network_utils.log_losses(
-            progressBar=None, tensorBoardWriter=tbw, logger=file_stdout_logger,
+        telemetry.log_losses(
+            progressBar=None, logger=file_stdout_logger,
             loss_names=test_loss_names, loss_vals=test_losses, iter_count=iter_count)
 
+    exp_dir, figures_dir, logs_dir, models_dir = exp.get_dirs()
     n_batch_per_epoch = min(run_args.mbpe, int(np.ceil(exp.get_n_train() / float(batch_size))))
 
     # initialize all callbacks here so they maintain their own epoch counts
     callbacks = [
+        # keep this first so that the other callbacks are timed as part of the time between batches
+        my_callbacks.PhaseTiming(phase_timer, telemetry=telemetry, start_iter=start_epoch * n_batch_per_epoch),
         my_callbacks.ProgbarWrapper(loss_names=exp.loss_names, n_batch_per_epoch=n_batch_per_epoch,
                                     model_name=exp.get_model_name(), start_epoch=start_epoch, end_epoch=end_epoch,
+                                    telemetry=telemetry,
                                     ),
         # keras_callbacks.ProgbarLogger(),
         my_callbacks.PrintResults(save_every_n_seconds=run_args.print_every,
@@ -241,14 +499,15 @@ def train_using_fit_generator(
         # write training losses to and training.log file every epoch
         my_callbacks.LogLosses(
             print_fn=functools.partial(
-                network_utils.log_losses,
-                progressBar=None, tensorBoardWriter=tbw, logger=file_logger),
+                telemetry.log_losses,
+                progressBar=None, logger=file_logger),
             loss_names=['train_' + ln for ln in exp.loss_names],  # + ['val_' + ln for ln in exp.loss_names],
             start_epoch=start_epoch,
             log_every_n_epochs=1,
         ),
         my_callbacks.TensorBoard_ScalarLosses(
             tbw,
+            telemetry=telemetry,
             loss_names=['train_' + ln for ln in exp.loss_names],  # \
             #                 + ['val_' + ln for ln in exp.loss_names],
             start_iter=start_epoch * n_batch_per_epoch,
@@ -256,10 +515,25 @@ def train_using_fit_generator(
         # TODO: early stopping
     ]
 
+    if op_profiler is not None:
+        callbacks.append(my_callbacks.OpProfiling(
+            op_profiler, start_iter=start_epoch * n_batch_per_epoch, logger=exp.profiler_logger))
+
+    if state_snapshotter is not None:
+        # fit_generator can only start at the beginning of an epoch, so we only snapshot at the end of each one
+        tracked_callbacks = list(callbacks)
+        if getattr(run_args, 'resume_state', False):
+            trainer_state = state_snapshotter.restore(callbacks=tracked_callbacks)
+            if trainer_state is not None:
+                start_epoch = trainer_state['epoch']
+                file_stdout_logger.debug('Resumed training state from {} at epoch {}'.format(
+                    state_snapshotter.state_file, start_epoch))
+        callbacks.append(my_callbacks.TrainingStateSnapshot(state_snapshotter, tracked_callbacks))
+
     while exp.epoch_count < end_epoch:  # we might need to call fit_generator on different models throughout training
         # assumes that each experiment has a main trainer_model
         exp.trainer_model.fit_generator(
-            exp.train_gen,
+            phase_timer.wrap_generator(exp.train_gen, 'data_fetch'),
             steps_per_epoch=n_batch_per_epoch,
             epochs=end_epoch,
             verbose=0,
@@ -275,6 +549,10 @@ def train_using_fit_generator(
             elif hasattr(c, 'loss_names'):
                 c.loss_names = exp.loss_names
 
+    if eval_scheduler is not None:
+        eval_scheduler.close()
+        handle_eval_results(exp, eval_scheduler.poll(block=True, timeout=60), telemetry, file_stdout_logger)
+
 
 def train_batch_by_batch(
         exp,
@@ -283,10 +561,33 @@ def train_batch_by_batch(
         tbw, file_stdout_logger, file_logger,
         run_args,
         early_stopping_eps,
-        run_metadata=None
+        telemetry=None,
+        phase_timer=None,
+        op_profiler=None,
+        eval_scheduler=None,
+        state_snapshotter=None,
 ):
+    if telemetry is None:
+        telemetry = telemetry_utils.ScalarTelemetry(tbw)
+
+    if phase_timer is None:
+        phase_timer = timing_utils.PhaseTimer()
+
+    # time each batch that our experiment pulls from its training generator
+    if hasattr(exp, 'train_gen'):
+        exp.train_gen = phase_timer.wrap_generator(exp.train_gen, 'data_fetch')
+
+        # losses that compare against cached target features need the features of each batch before its step
+        feature_cached_losses = exp._feature_cached_losses()
+        if len(feature_cached_losses) > 0:
+            exp.train_gen = metrics.gen_feeding_target_features(exp.train_gen, feature_cached_losses)
+
+    is_chief = getattr(run_args, 'rank', 0) == 0
+
     max_n_batch_per_epoch = 1000  # limits each epoch to batch_size * 1000 examples. i think this is ok.
-    n_batch_per_epoch_train = min(max_n_batch_per_epoch, int(np.ceil(exp.get_n_train() / float(batch_size))))
+    # when training data-parallel, each worker only goes through its own shard of the training set
+    n_train = int(np.ceil(exp.get_n_train() / float(getattr(exp, 'data_world_size', 1))))
+    n_batch_per_epoch_train = min(max_n_batch_per_epoch, int(np.ceil(n_train / float(batch_size))))
 
     max_printed_examples = 8
     print_every = 100000  # set this to be really high at  first
@@ -308,10 +609,34 @@ def train_batch_by_batch(
     #    print_every = int(np.floor(
     #                    ((n_batch_per_epoch_train-1) / print_n_batches_per_epoch) / 2)) * 2 + 1  # make this odd so we can print augmentations
 
+    # pick up exactly where a previous run left off, instead of just from its last saved models
+    start_bi = 0
+    intervals_measured = False
+    if state_snapshotter is not None and getattr(run_args, 'resume_state', False):
+        trainer_state = state_snapshotter.restore()
+        if trainer_state is not None:
+            start_epoch = trainer_state['epoch']
+            start_bi = min(trainer_state['next_bi'], n_batch_per_epoch_train - 1)
+            print_every = trainer_state['print_every']
+            auto_save_every_n_epochs = trainer_state['auto_save_every_n_epochs']
+            intervals_measured = True
+            file_stdout_logger.debug('Resumed training state from {} at epoch {}, batch {}'.format(
+                state_snapshotter.state_file, start_epoch, start_bi))
+
+    # train the first epochs at lower resolutions, e.g. '0:0.25,10:0.5,30:1'
+    res_schedule = progressive_utils.parse_resolution_schedule(getattr(run_args, 'res_schedule', None))
+    if res_schedule is not None:
+        # fail now rather than at the first switch
+        exp.check_resolution_schedule(res_schedule)
+
+    def get_trainer_state(epoch, next_bi):
+        return {'epoch': epoch, 'next_bi': next_bi,
+                'print_every': print_every, 'auto_save_every_n_epochs': auto_save_every_n_epochs}
+
     start_time = time.time()
 
     # do this once here to flush any setup information to the file
-    exp._reopen_log_file()
+    exp._flush_log_files()
 
     for e in range(start_epoch, end_epoch + 1):
         file_stdout_logger.debug('{} training epoch {}/{}'.format(exp.model_name, e, end_epoch + 1))
@@ -319,25 +644,45 @@ def train_batch_by_batch(
         if e < end_epoch:
             exp.update_epoch_count(e)
 
+        if res_schedule is not None:
+            scale = progressive_utils.scale_at_epoch(res_schedule, e)
+            if scale != exp.input_scale:
+                file_stdout_logger.debug('Training at {}x resolution from epoch {}'.format(scale, e))
+                with phase_timer.phase('set_resolution'):
+                    exp.set_resolution(scale)
+
         pb = generic_utils.Progbar(n_batch_per_epoch_train)
         printed_count = 0
-        for bi in range(n_batch_per_epoch_train):
-            disc_loss, disc_loss_names = exp.train_discriminator()
-            joint_loss, joint_loss_names = exp.train_joint()
+        for bi in range(start_bi if e == start_epoch else 0, n_batch_per_epoch_train):
             batch_count = e * n_batch_per_epoch_train + bi
+            if op_profiler is not None:
+                op_profiler.before_step(batch_count)
+
+            with phase_timer.phase('train_discriminator'):
+                disc_loss, disc_loss_names = exp.train_discriminator()
+            if op_profiler is not None:
+                op_profiler.collect(batch_count, 'train_discriminator')
+
+            with phase_timer.phase('train_joint'):
+                joint_loss, joint_loss_names = exp.train_joint()
+            if op_profiler is not None:
+                op_profiler.collect(batch_count, 'train_joint')
+                op_profiler.after_step(batch_count)
 
             # only log to file on the last batch of training, otherwise we'll have too many messages
             training_logger = None
             if bi == n_batch_per_epoch_train - 1:
                 training_logger = file_logger
 
-            log_losses(pb, tbw, training_logger,
+            with phase_timer.phase('log_losses'):
+                telemetry.log_losses(pb, training_logger,
                                      disc_loss_names + joint_loss_names,
                                      disc_loss + joint_loss,
                                      batch_count)
 
             # time how long it takes to do 5 batches
-            if batch_count - start_epoch * n_batch_per_epoch_train == 5:
+            if not intervals_measured and batch_count - start_epoch * n_batch_per_epoch_train - start_bi == 5:
+                intervals_measured = True
                 s_per_batch = (time.time() - start_time) / 5.
 
                 # make this an odd integer in case our experiment is doing
@@ -352,15 +697,20 @@ def train_batch_by_batch(
 
 
             if ((batch_count % print_every == 0 or batch_count % print_atleast_every == 0)) \
-                    and printed_count < print_atmost:
-                results_im = exp.make_train_results_im()
-                cv2.imwrite(
-                    os.path.join(exp.figures_dir,
-                                 'train_epoch{}_batch{}.jpg'.format(e, bi)
-                                 ),
-                    results_im)
+                    and printed_count < print_atmost and is_chief:
+                with phase_timer.phase('render_results'):
+                    results_im = exp.make_train_results_im()
+                    cv2.imwrite(
+                        os.path.join(exp.figures_dir,
+                                     'train_epoch{}_batch{}.jpg'.format(e, bi)
+                                     ),
+                        results_im)
                 printed_count += 1
 
+            # the end of the epoch is snapshotted along with the checkpoint below
+            if state_snapshotter is not None and bi < n_batch_per_epoch_train - 1:
+                state_snapshotter.maybe_save(get_trainer_state(e, bi + 1))
+
         if batch_count >= 10:  # TODO: make this only print once?
             file_stdout_logger.debug('Printing every {} batches, '
                                      'saving every {} and {} epochs, '
@@ -370,53 +720,115 @@ def train_batch_by_batch(
                                                                test_every_n_epochs,
                                                                ))
 
-        if run_args.do_profile:
-            trace = timeline.Timeline(step_stats=run_metadata.step_stats)
-            with open(os.path.join(exp.exp_dir, 'tf_timeline.ctf.json'), 'w') as f:
-                f.write(trace.generate_chrome_trace_format())
-
-        if (e > 0 and e % auto_save_every_n_epochs == 0 and e > start_epoch) or e == end_epoch or (
-                            e > 0 and e % save_every_n_epochs == 0 and e > start_epoch):
-            exp.save_models(e, iter_count=e * n_batch_per_epoch_train)
-            # TODO: figure out how to flush log file without closing
-            file_stdout_logger.handlers[0].close()  # flush our .log file
-            lfh = logging.FileHandler(filename=os.path.join(exp.exp_dir, 'training.log'))
-            file_stdout_logger.handlers[0] = lfh
-
-            if exp.logger is not None:
-                exp.logger.handlers[0].close()
-                exp._reopen_log_file()
-
-            tbw.close()  # save to disk and then open a new file so that we can read into tensorboard more easily
-            tbw.reopen()
-
-        if (e % auto_test_every_n_epochs == 0 or e % test_every_n_epochs == 0):
+        # report where the time went this epoch
+        phase_timer.report(file_logger)
+        timing_names, timing_vals = phase_timer.scalars()
+        telemetry.add_scalars(timing_names, timing_vals, batch_count)
+
+        if op_profiler is not None:
+            op_report = op_profiler.write_report()
+            if op_report is not None and exp.profiler_logger is not None:
+                exp.profiler_logger.debug(op_report)
+
+        is_test_epoch = (e % auto_test_every_n_epochs == 0 or e % test_every_n_epochs == 0) and is_chief
+        if is_chief and ((e > 0 and e % auto_save_every_n_epochs == 0 and e > start_epoch) or e == end_epoch or (
+                            e > 0 and e % save_every_n_epochs == 0 and e > start_epoch) \
+                or (eval_scheduler is not None and is_test_epoch)):  # the eval worker needs a checkpoint to test
+            with phase_timer.phase('checkpoint'):
+                exp.save_models(e, iter_count=e * n_batch_per_epoch_train)
+                if state_snapshotter is not None:
+                    state_snapshotter.save(get_trainer_state(e + 1, 0))
+
+                # flush our .log files and tensorboard events so we can look at them during training
+                telemetry_utils.flush_logger(file_stdout_logger)
+                exp._flush_log_files()
+                telemetry.flush()
+
+            phase_timer.export_chrome_trace(os.path.join(exp.exp_dir, 'phase_timings.ctf.json'))
+            phase_timer.save(os.path.join(exp.exp_dir, 'phase_timings.json'))
+
+        if eval_scheduler is not None:
+            if is_test_epoch:
+                eval_scheduler.submit(e, e * n_batch_per_epoch_train)
+            # pick up whatever the eval worker has finished in the meantime
+            handle_eval_results(exp, eval_scheduler.poll(), telemetry, file_stdout_logger)
+            eval_scheduler = check_eval_worker(exp, eval_scheduler, telemetry, file_stdout_logger)
+            if eval_scheduler is None and is_test_epoch:
+                # the worker won't test this checkpoint, so we need to
+                with phase_timer.phase('test_joint'):
+                    test_loss, test_loss_names = exp.test_joint()
+                telemetry.log_losses(None, file_logger, test_loss_names, test_loss, e * n_batch_per_epoch_train + bi)
+        elif is_test_epoch:
             file_stdout_logger.debug('{} testing'.format(exp.model_name))
             pbt = generic_utils.Progbar(1)
 
-            test_loss, test_loss_names = exp.test_joint()
+            with phase_timer.phase('test_joint'):
+                test_loss, test_loss_names = exp.test_joint()
 
-            log_losses(pbt, None, file_logger,
-                                     test_loss_names, test_loss,
-                                     e * n_batch_per_epoch_train + bi)
+            telemetry.log_losses(pbt, file_logger,
+                                 test_loss_names, test_loss,
+                                 e * n_batch_per_epoch_train + bi,
+                                 write_tensorboard=False)
 
-            results_im = exp.make_test_results_im(e)
-            if results_im is not None:
-                cv2.imwrite(os.path.join(exp.figures_dir, 'test_epoch{}_batch{}.jpg'.format(e, bi)), results_im)
+            with phase_timer.phase('render_results'):
+                results_im = exp.make_test_results_im(e)
+                if results_im is not None:
+                    cv2.imwrite(os.path.join(exp.figures_dir, 'test_epoch{}_batch{}.jpg'.format(e, bi)), results_im)
 
-            log_losses(None, tbw, file_logger,
-                                     test_loss_names, test_loss,
-                                     e * n_batch_per_epoch_train + bi)
-
-            if run_args.early_stopping:
-                if not np.any(np.isnan(exp.validation_losses_buffer)) \
-                        and len(exp.validation_losses_buffer) > 0 \
-                        and np.all(exp.validation_losses_buffer[1:] - exp.validation_losses_buffer[
-                            0] < early_stopping_eps):
-                    file_stdout_logger.debug('Validation losses {}, stopping!'.format(exp.validation_losses_buffer))
-                    sys.exit()
+            telemetry.log_losses(None, file_logger,
+                                 test_loss_names, test_loss,
+                                 e * n_batch_per_epoch_train + bi)
             print('\n\n')
 
+        if is_test_epoch or eval_scheduler is not None:
+            if run_args.early_stopping and should_stop_early(exp.validation_losses_buffer, early_stopping_eps):
+                file_stdout_logger.debug('Validation losses {}, stopping!'.format(exp.validation_losses_buffer))
+                if eval_scheduler is not None:
+                    eval_scheduler.close(wait_for_pending=False)
+                telemetry.close()
+                sys.exit()
+
+    if eval_scheduler is not None:
+        # wait for the last checkpoints to be evaluated
+        eval_scheduler.close()
+        handle_eval_results(exp, eval_scheduler.poll(block=True, timeout=60), telemetry, file_stdout_logger)
+
+
+def should_stop_early(validation_losses_buffer, early_stopping_eps):
+    validation_losses_buffer = np.asarray(validation_losses_buffer)
+    return not np.any(np.isnan(validation_losses_buffer)) \
+        and len(validation_losses_buffer) > 0 \
+        and np.all(validation_losses_buffer[1:] - validation_losses_buffer[0] < early_stopping_eps)
+
+
+def check_eval_worker(exp, eval_scheduler, telemetry, logger):
+    '''
+    :return: eval_scheduler, or None if its worker has died, in which case the caller should test synchronously
+    '''
+    if eval_scheduler is not None and not eval_scheduler.is_alive():
+        logger.debug('Eval worker is no longer running, testing in the training process from now on')
+        eval_scheduler.close(wait_for_pending=False)
+        handle_eval_results(exp, eval_scheduler.poll(), telemetry, logger)
+        return None
+    return eval_scheduler
+
+
+def handle_eval_results(exp, eval_results, telemetry, logger):
+    '''
+    Logs results from an eval_utils.EvalScheduler, and updates the experiment's validation losses
+    so that we can do early stopping.
+    '''
+    for result in eval_results:
+        if result.get('skipped'):
+            continue
+        elif 'error' in result:
+            logger.debug('Evaluating epoch {} failed: {}'.format(result['epoch'], result['error']))
+            continue
+
+        logger.debug('{} test results for epoch {}'.format(exp.model_name, result['epoch']))
+        telemetry.log_losses(None, logger, result['loss_names'], result['losses'], result['iter_count'])
+        exp.validation_losses_buffer = result['validation_losses_buffer']
+
 
 def log_losses(progressBar, tensorBoardWriter, logger, loss_names, loss_vals, iter_count):
     if not isinstance(loss_vals, list):  # occurs when model only has one loss
@@ -0,0 +1,81 @@
+'''
+Finite differences along the spatial dims of [batch_size, *vol_shape, n_chans] tensors, for smoothness losses.
+
+Differences are taken with static slices (strided_slice ops), which tf can fuse, rather than by gathering
+tf.range indices. spatial_diffs caches its results per tensor, so several losses on the same output (e.g. a
+gradient loss and an intensity-weighted smoothness loss on the same flow) share one set of difference ops.
+'''
+from cnn_utils.lazy_utils import LazyModule
+tf = LazyModule('tensorflow')
+
+# differences that we have already computed, keyed by (tensor, axis). Reset whenever the graph changes
+_diff_cache = {}
+_diff_cache_graph = [None]
+
+
+def _slice_along(x, axis, start=None, stop=None):
+    return x[(slice(None),) * axis + (slice(start, stop),)]
+
+
+def trim(x, axis, start=1, stop=None):
+    '''
+    Crops x along axis to line it up with a difference, e.g. trim(mask, axis) matches forward_diff(x, axis)
+    at the second element of each pair.
+    '''
+    return _slice_along(x, axis, start, stop)
+
+
+def _pad_along(x, axis, before, after):
+    paddings = [[0, 0]] * len(x.get_shape().as_list())
+    paddings[axis] = [before, after]
+    return tf.pad(x, paddings)
+
+
+def forward_diff(x, axis, padding='valid'):
+    '''
+    x[i + 1] - x[i] along axis.
+
+    :param padding: 'valid' returns one less element along axis. 'same' pads the last element with 0
+    '''
+    d = _slice_along(x, axis, 1, None) - _slice_along(x, axis, None, -1)
+    if padding == 'same':
+        d = _pad_along(d, axis, 0, 1)
+    return d
+
+
+def backward_diff(x, axis, padding='valid'):
+    '''
+    x[i] - x[i - 1] along axis. With 'valid' padding, this has the same values as forward_diff. 'same' pads
+    the first element with 0
+    '''
+    d = forward_diff(x, axis)
+    if padding == 'same':
+        d = _pad_along(d, axis, 1, 0)
+    return d
+
+
+def spatial_diffs(x, n_dims=None, reuse=True):
+    '''
+    Forward differences (with 'valid' padding) along each spatial dim of x.
+
+    :param n_dims: number of spatial dims. Defaults to all dims between the batch and channels
+    :param reuse: return the same difference tensors if we have already computed them for x
+    :return: list of n_dims tensors
+    '''
+    if n_dims is None:
+        n_dims = len(x.get_shape().as_list()) - 2
+
+    if not reuse:
+        return [forward_diff(x, axis=d + 1) for d in range(n_dims)]
+
+    if _diff_cache_graph[0] is not tf.get_default_graph():
+        _diff_cache.clear()
+        _diff_cache_graph[0] = tf.get_default_graph()
+
+    diffs = []
+    for d in range(n_dims):
+        key = (x, d + 1)
+        if key not in _diff_cache:
+            _diff_cache[key] = forward_diff(x, axis=d + 1)
+        diffs.append(_diff_cache[key])
+    return diffs
@@ -0,0 +1,121 @@
+'''
+Gradient accumulation, so that we can train with batches that don't fit in memory.
+
+GradientAccumulator replaces a compiled model's train function with one that splits each batch into micro-batches,
+adds each micro-batch's gradients into accumulator variables in the graph, and then applies the accumulated
+gradients with the model's optimizer once. Since train_on_batch and fit_generator both go through the train
+function, experiments don't need to change how they train.
+
+Peak activation memory is that of a single micro-batch. The gradients, loss and metrics match those of the full
+batch for losses that are means over examples. Layers that compute batch statistics (e.g. batchnorm) only see
+one micro-batch at a time.
+'''
+import numpy as np
+
+
+def make_apply_gradients_function(model, weights, grads, inputs=None, function_kwargs=None):
+    '''
+    Builds the optimizer's update ops for the given gradients instead of the gradients of model.total_loss.
+
+    :param weights: list of variables to update
+    :param grads: list of tensors (e.g. placeholders or accumulator variables) to use as the gradients of weights
+    :param inputs: placeholders to feed when calling the function, e.g. if grads are placeholders
+    :return: a keras function that applies one optimizer step
+    '''
+    import keras.backend as K
+
+    optimizer = model.optimizer
+    orig_get_gradients = optimizer.get_gradients
+    optimizer.get_gradients = lambda loss, params: grads
+    try:
+        with K.name_scope('training'):
+            updates = optimizer.get_updates(loss=model.total_loss, params=weights)
+    finally:
+        optimizer.get_gradients = orig_get_gradients
+
+    return K.function(inputs if inputs is not None else [], [], updates=updates, **(function_kwargs or {}))
+
+
+def split_batch_idxs(batch_size, n_micro_batches):
+    # start and end of each micro-batch. The last ones are smaller if the batch doesn't divide evenly
+    bounds = np.linspace(0, batch_size, min(n_micro_batches, batch_size) + 1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class GradientAccumulator(object):
+    def __init__(self, model, n_micro_batches):
+        '''
+        :param model: compiled keras model, e.g. exp.trainer_model
+        :param n_micro_batches: number of pieces to split each batch into
+        '''
+        import keras.backend as K
+
+        self.model = model
+        self.n_micro_batches = n_micro_batches
+
+        self.weights = model._collected_trainable_weights if hasattr(model, '_collected_trainable_weights') \
+            else model.trainable_weights
+        function_kwargs = getattr(model, '_function_kwargs', {})
+
+        inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+        self.n_batch_inputs = len(inputs)
+        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            inputs += [K.learning_phase()]
+
+        # fraction of the full batch in the current micro-batch, so that the accumulated gradient is the
+        # gradient of the full batch's mean loss
+        self.micro_batch_frac = K.placeholder(shape=(), name='micro_batch_frac')
+
+        self.accumulators = [K.zeros(K.int_shape(w), dtype=K.dtype(w)) for w in self.weights]
+        grads = model.optimizer.get_gradients(model.total_loss, self.weights)
+        accum_updates = [K.update_add(a, self.micro_batch_frac * g) for a, g in zip(self.accumulators, grads)]
+
+        # layer updates (e.g. batchnorm statistics) and stateful metrics are updated for every micro-batch
+        updates = accum_updates + model.updates + getattr(model, 'metrics_updates', [])
+        self.accum_fn = K.function(
+            inputs + [self.micro_batch_frac],
+            [model.total_loss] + list(getattr(model, 'metrics_tensors', [])),
+            updates=updates, name='accum_function', **function_kwargs)
+
+        self.apply_fn = make_apply_gradients_function(
+            model, self.weights, self.accumulators, function_kwargs=function_kwargs)
+        self.reset_fn = K.function([], [], updates=[K.update(a, K.zeros_like(a)) for a in self.accumulators])
+
+        # functions of (start, end) to call before each micro-batch, e.g. metrics.VggFeatLoss.feed_micro_batch
+        self.micro_batch_callbacks = []
+
+        # train_on_batch and fit_generator only build a train function if the model doesn't have one yet
+        model.train_function = self
+
+    @property
+    def _callable_fn(self):
+        return getattr(self.accum_fn, '_callable_fn', None)
+
+    @_callable_fn.setter
+    def _callable_fn(self, callable_fn):
+        # lets profiling_utils reset our session callables when it changes the trace level
+        for fn in [self.accum_fn, self.apply_fn]:
+            if hasattr(fn, '_callable_fn'):
+                fn._callable_fn = callable_fn
+
+    def __call__(self, ins):
+        batch_ins = ins[:self.n_batch_inputs]
+        other_ins = ins[self.n_batch_inputs:]  # the learning phase, if any
+
+        batch_size = batch_ins[0].shape[0]
+        outs = None
+        for start, end in split_batch_idxs(batch_size, self.n_micro_batches):
+            frac = (end - start) / float(batch_size)
+            for callback in self.micro_batch_callbacks:
+                callback(start, end)
+            micro_outs = self.accum_fn([x[start:end] for x in batch_ins] + other_ins + [frac])
+
+            # report losses and metrics as if we had run the full batch
+            if outs is None:
+                outs = [frac * o for o in micro_outs]
+            else:
+                outs = [o + frac * mo for o, mo in zip(outs, micro_outs)]
+
+        self.apply_fn([])
+        self.reset_fn([])
+        return outs
@@ -99,9 +99,15 @@ def get_segmentation_mask(I, mask_color=(1., 1., 1.)):
     return mask
 
 
-def create_gaussian_kernel(sigma, n_sigmas_per_side=8, n_dims=2):
+def create_gaussian_kernel_1d(sigma, n_sigmas_per_side=8):
+    # normalized so that it sums to 1. The n-D kernel from create_gaussian_kernel is the outer product of these
     t = np.linspace(-sigma * n_sigmas_per_side / 2, sigma * n_sigmas_per_side / 2, int(sigma * n_sigmas_per_side + 1))
     gauss_kernel_1d = np.exp(-0.5 * (t / sigma) ** 2)
+    return gauss_kernel_1d / np.sum(gauss_kernel_1d)
+
+
+def create_gaussian_kernel(sigma, n_sigmas_per_side=8, n_dims=2):
+    gauss_kernel_1d = create_gaussian_kernel_1d(sigma, n_sigmas_per_side)
 
     if n_dims == 2:
         gauss_kernel_2d = gauss_kernel_1d[:, np.newaxis] * gauss_kernel_1d[np.newaxis, :]
@@ -0,0 +1,51 @@
+'''
+Module-level lazy imports, so that scripts which only need e.g. image_utils don't pay for importing
+tensorflow, keras, matplotlib or scipy.
+
+    tf = lazy_utils.LazyModule('tensorflow')
+
+imports tensorflow the first time an attribute of tf is accessed.
+'''
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name, before_import=None):
+        '''
+        :param name: full name of the module, e.g. 'keras.backend'
+        :param before_import: optional function to call right before the module is imported,
+            e.g. to set the matplotlib backend
+        '''
+        super(LazyModule, self).__init__(name)
+        self._lazy_before_import = before_import
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            if self._lazy_before_import is not None:
+                self._lazy_before_import()
+            self._lazy_module = importlib.import_module(self.__name__)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        # only called for attributes that aren't set on the proxy itself
+        if attr.startswith('_lazy_'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module {}{}>'.format(self.__name__, '' if self._lazy_module is None else ' (loaded)')
+
+
+def _use_agg_backend():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def lazy_pyplot():
+    # matplotlib.pyplot with the non-interactive backend that we use for saving figures
+    return LazyModule('matplotlib.pyplot', before_import=_use_agg_backend)
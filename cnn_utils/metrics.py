@@ -2,75 +2,125 @@ import os
 import sys
 
 sys.path.append('../evolving_wilds')
+from cnn_utils import constant_utils
+from cnn_utils import finite_diff_utils
 from cnn_utils import image_utils
 
-import keras.backend as K
 import numpy as np
-import tensorflow as tf
-from scipy.signal import convolve2d
+
+from cnn_utils.lazy_utils import LazyModule
+K = LazyModule('keras.backend')
+tf = LazyModule('tensorflow')
+
+def box_sum(x, win, method='cumsum'):
+    """
+    Sums of x over a sliding window, with 'VALID' padding, for all channels at once.
+
+    :param x: tensor sized [batch_size, *vol_shape, n_chans]
+    :param win: window size along each spatial dim, e.g. [9, 9]
+    :param method: 'cumsum' takes differences of cumulative sums, so its cost doesn't depend on the window size.
+        'separable' convolves with a 1D box filter along each dim in turn, so its cost grows with sum(win)
+        rather than prod(win)
+    """
+    ndims = len(win)
+    if method == 'cumsum':
+        for d, w in enumerate(win):
+            axis = d + 1
+            # pad with a zero so that the sum over [i, i + w) is cs[i + w] - cs[i]
+            paddings = [[0, 0]] * (ndims + 2)
+            paddings[axis] = [1, 0]
+            cs = tf.pad(tf.cumsum(x, axis=axis), paddings)
+            before_axis = (slice(None),) * axis
+            x = cs[before_axis + (slice(w, None),)] - cs[before_axis + (slice(None, -w),)]
+        return x
+    elif method == 'separable':
+        # move channels into the batch so that each 1D filter only has one input and output channel
+        x_shape = tf.shape(x)
+        perm = [0, ndims + 1] + list(range(1, ndims + 1))
+        x = tf.transpose(x, perm)
+        x = tf.expand_dims(tf.reshape(x, tf.concat([[-1], tf.shape(x)[2:]], axis=0)), axis=-1)
+        for d, w in enumerate(win):
+            filt_shape = [1] * ndims + [1, 1]
+            filt_shape[d] = w
+            x = tf.nn.convolution(x, tf.ones(filt_shape, dtype=x.dtype), padding='VALID')
+
+        # and back to [batch_size, *vol_shape, n_chans]
+        x = tf.reshape(x, tf.concat([x_shape[:1], x_shape[-1:], tf.shape(x)[1:-1]], axis=0))
+        return tf.transpose(x, [0] + list(range(2, ndims + 2)) + [1])
+    else:
+        raise ValueError('Unknown box sum method {}'.format(method))
+
 
 class NCC():
     """
     local (over window) normalized cross correlation
     """
 
-    def __init__(self, win=None, eps=1e-2, n_chans=3):
+    def __init__(self, win=None, eps=1e-2, n_chans=3, method='cumsum'):
+        """
+        :param method: how to compute the local sums. 'cumsum' or 'separable' compute them for all channels at once
+            (see box_sum), 'conv' convolves each channel with a dense window
+        """
         # IMPORTANT: a higher eps (1e-2) makes training more stable
         self.win = win
         self.eps = eps
         self.n_chans = n_chans
+        self.method = method
 
-    def ncc(self, I, J):
-        # get dimension of volume
-        # assumes I, J are sized [batch_size, *vol_shape, nb_feats]
+    def _local_sums_conv(self, I, J):
         ndims = len(I.get_shape().as_list()) - 2
-        assert ndims in [1, 2, 3], "volumes should be 1 to 3 dimensions. found: %d" % ndims
-
         I_chans = tf.split(I, self.n_chans, axis=-1)
         J_chans = tf.split(J, self.n_chans, axis=-1)
 
-        # set window size
-        if self.win is None:
-            self.win = [9] * ndims
-        # compute cross correlation
-        win_size = float(np.prod(self.win))
-
         # get convolution function
         conv_fn = getattr(tf.nn, 'conv%dd' % ndims)
 
-        total_cc = 0.
+        # compute filters
+        sum_filt = tf.ones([*self.win, 1, 1])
+        strides = [1] * (ndims + 2)
+        padding = 'VALID'
+
+        sums = []
         for c in range(self.n_chans):
             I_chan = I_chans[c]
             J_chan = J_chans[c]
 
-            # compute CC squares
-            I2 = I_chan * I_chan
-            J2 = J_chan * J_chan
-            IJ = I_chan * J_chan
+            # compute local sums via convolution
+            sums.append([conv_fn(x, sum_filt, strides, padding)
+                         for x in [I_chan, J_chan, I_chan * I_chan, J_chan * J_chan, I_chan * J_chan]])
 
-            # compute filters
-            sum_filt = tf.ones([*self.win, 1, 1])
-            strides = [1] * (ndims + 2)
-            padding = 'VALID'
+        # concatenate channels for each of I, J, I2, J2, IJ
+        return [tf.concat([s[i] for s in sums], axis=-1) for i in range(5)]
 
-            # compute local sums via convolution
-            I_sum = conv_fn(I_chan, sum_filt, strides, padding)
-            J_sum = conv_fn(J_chan, sum_filt, strides, padding)
-            I2_sum = conv_fn(I2, sum_filt, strides, padding)
-            J2_sum = conv_fn(J2, sum_filt, strides, padding)
-            IJ_sum = conv_fn(IJ, sum_filt, strides, padding)
+    def ncc(self, I, J):
+        # get dimension of volume
+        # assumes I, J are sized [batch_size, *vol_shape, nb_feats]
+        ndims = len(I.get_shape().as_list()) - 2
+        assert ndims in [1, 2, 3], "volumes should be 1 to 3 dimensions. found: %d" % ndims
+
+        # set window size
+        if self.win is None:
+            self.win = [9] * ndims
+        # compute cross correlation
+        win_size = float(np.prod(self.win))
+
+        if self.method == 'conv':
+            I_sum, J_sum, I2_sum, J2_sum, IJ_sum = self._local_sums_conv(I, J)
+        else:
+            # all five local sums, for all channels, in one go
+            sums = box_sum(tf.concat([I, J, I * I, J * J, I * J], axis=-1), self.win, method=self.method)
+            I_sum, J_sum, I2_sum, J2_sum, IJ_sum = tf.split(sums, 5, axis=-1)
 
-            u_I = I_sum / win_size
-            u_J = J_sum / win_size
+        u_I = I_sum / win_size
+        u_J = J_sum / win_size
 
-            cross = IJ_sum - u_J * I_sum - u_I * J_sum + u_I * u_J * win_size
-            I_var = I2_sum - 2 * u_I * I_sum + u_I * u_I * win_size
-            J_var = J2_sum - 2 * u_J * J_sum + u_J * u_J * win_size
+        cross = IJ_sum - u_J * I_sum - u_I * J_sum + u_I * u_J * win_size
+        I_var = I2_sum - 2 * u_I * I_sum + u_I * u_I * win_size
+        J_var = J2_sum - 2 * u_J * J_sum + u_J * u_J * win_size
 
-            cc = cross * cross / (I_var * J_var + self.eps)
-            total_cc += tf.reduce_mean(cc)
-        # return negative cc.
-        return total_cc / float(self.n_chans)
+        cc = cross * cross / (I_var * J_var + self.eps)
+        # every channel has the same number of windows, so this is the mean over channels of the mean cc
+        return tf.reduce_mean(cc)
 
     def loss(self, I, J):
         return -self.ncc(I, J)
@@ -147,201 +197,241 @@ def vgg_preprocess_torch(arg):
     r = (z[:, :, :, 2] - 0.485) / 0.229
     return tf.stack([r, g, b], axis=3)
 
-from keras.applications.vgg16 import VGG16
-from keras.applications.vgg19 import VGG19
-from keras.layers import AveragePooling2D, Conv2D, Input, MaxPooling2D
-from keras.models import Model, load_model
-def vgg_isola_norm(shape=(64,64,3), normalized_inputs=False, do_preprocess=True):
-    img_input = Input(shape=shape)
-
-    if do_preprocess:
-        if normalized_inputs:
-            #vgg_model_file = '../evolving_wilds/cnn_utils/vgg16_normtorchtanh_ims{}-{}.h5'.format(shape[0], shape[1])
-            #img = Lambda(vgg_preprocess_torch,
-            #    name='lambda_preproc_torchnorm-11')(img_input)
-            vgg_model_file = '../evolving_wilds/cnn_utils/vgg16_normtanh_ims{}-{}.h5'.format(shape[0], shape[1])
-            img = Lambda(vgg_preprocess_norm,
-                name='lambda_preproc_norm-11')(img_input)
-        else:
-            vgg_model_file = '../evolving_wilds/cnn_utils/vgg16_01_ims{}-{}.h5'.format(shape[0], shape[1])
-            img = Lambda(vgg_preprocess,
-                name='lambda_preproc_clip01')(img_input)
-    else:
-        vgg_model_file = '../evolving_wilds/cnn_utils/vgg16_ims{}-{}.h5'.format(shape[0], shape[1])
-        img = img_input
-
-    if os.path.isfile(vgg_model_file):
-        print('Loading vgg model from {}'.format(vgg_model_file))
-        return load_model(vgg_model_file,
-            custom_objects={
-                'vgg_preprocess_norm': vgg_preprocess_norm, 
-                'vgg_preprocess': vgg_preprocess})
-    
-    # Block 1
-    x1 = Conv2D(64, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block1_conv1')(img)
-    x2 = Conv2D(64, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block1_conv2')(x1) # relu is layer 4 in torch implementation
-    x3 = MaxPooling2D((2, 2), strides=(2, 2), name='block1_pool')(x2)
-
-    # Block 2
-    x4 = Conv2D(128, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block2_conv1')(x3)
-    x5 = Conv2D(128, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block2_conv2')(x4) # relu is layer 9
-    x6 = MaxPooling2D((2, 2), strides=(2, 2), name='block2_pool')(x5)
-
-    # Block 3
-    x7 = Conv2D(256, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block3_conv1')(x6)
-    x8 = Conv2D(256, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block3_conv2')(x7)
-    x9 = Conv2D(256, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block3_conv3')(x8) # relu is layer 16
-    x10 = MaxPooling2D((2, 2), strides=(2, 2), name='block3_pool')(x9)
-
-    # Block 4
-    x11 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block4_conv1')(x10)
-    x12 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block4_conv2')(x11)
-    x13 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block4_conv3')(x12) # relu is layer 23 in torch
-    x14 = MaxPooling2D((2, 2), strides=(2, 2), name='block4_pool')(x13)
-
-    # Block 5
-    x15 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block5_conv1')(x14)
-    x16 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block5_conv2')(x15)
-    x17 = Conv2D(512, (3, 3),
-                      activation='relu',
-                      padding='same',
-                      name='block5_conv3')(x16) # relu is layer 30
-
-    # isola implementation uses layer outputs 4, 9, 16, 23, 30, but need to count activations
-    model = Model(inputs=[img_input], outputs=[x2, x5, x9, x13, x17])
-    model_orig = VGG16(weights='imagenet', input_shape=shape, include_top=False)
-
-    # ignore the lambda we put in for preprocessing
-    vgg_layers = [l for l in model.layers if not isinstance(l, Lambda)]
-    for li, l in enumerate(vgg_layers):
-        weights = model_orig.layers[li].get_weights()
-        l.set_weights(weights)
-        print('Copying imagenet weights for layer {}: {}'.format(li, l.name))
-        l.trainable = False
+# convs per block and filters per block of each architecture
+VGG_ARCHS = {
+    'vgg16': {'n_convs': [2, 2, 3, 3, 3], 'n_filters': [64, 128, 256, 512, 512], 'pool': 'max'},
+    'vgg19': {'n_convs': [2, 2, 4, 4, 4], 'n_filters': [64, 128, 256, 512, 512], 'pool': 'avg'},
+}
 
-    if not os.path.isfile(vgg_model_file):
-        model.save(vgg_model_file)
+# the outputs that the isola (lpips) and vgg_norm perceptual losses use
+VGG_DEFAULT_OUTPUT_LAYERS = ['block1_conv2', 'block2_conv2', 'block3_conv3', 'block4_conv3', 'block5_conv3']
 
-    return model
+# set this to a local copy of the imagenet weights (without the top), otherwise keras downloads them once
+# into ~/.keras/models
+VGG_WEIGHTS_FILES = {'vgg16': None, 'vgg19': None}
 
+# conv layers of each architecture, built and loaded once per process and shared by every feature extractor
+_vgg_layers = {}
+_vgg_feature_extractors = {}
+_vgg_graph = [None]
 
 
-def vgg_norm(shape=(64,64,3), normalized_inputs=False):
-    img_input = Input(shape=shape)
+def _check_vgg_graph():
+    # layers from a previous session (e.g. after K.clear_session) can't be used in the current graph
+    import tensorflow as tf
+    if _vgg_graph[0] is not tf.get_default_graph():
+        _vgg_layers.clear()
+        _vgg_feature_extractors.clear()
+        _vgg_graph[0] = tf.get_default_graph()
+
+
+def _get_vgg_weights_file(arch):
+    if VGG_WEIGHTS_FILES[arch] is not None:
+        return VGG_WEIGHTS_FILES[arch]
+    from keras.utils.data_utils import get_file
+    weights_name = '{}_weights_tf_dim_ordering_tf_kernels_notop.h5'.format(arch)
+    return get_file(
+        weights_name,
+        'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/' + weights_name,
+        cache_subdir='models')
+
+
+def _get_vgg_layers(arch):
+    from keras.layers import AveragePooling2D, Conv2D, Input, MaxPooling2D
+    from keras.models import Model
+
+    _check_vgg_graph()
+    if arch in _vgg_layers:
+        return _vgg_layers[arch]
+
+    arch_params = VGG_ARCHS[arch]
+    pool_layer = MaxPooling2D if arch_params['pool'] == 'max' else AveragePooling2D
+
+    layers = []
+    for bi, (n_convs, n_filters) in enumerate(zip(arch_params['n_convs'], arch_params['n_filters'])):
+        for ci in range(n_convs):
+            layers.append(Conv2D(n_filters, (3, 3), activation='relu', padding='same',
+                                 name='block{}_conv{}'.format(bi + 1, ci + 1)))
+        layers.append(pool_layer((2, 2), strides=(2, 2), name='block{}_pool'.format(bi + 1)))
+
+    # build the full network once so that we can load the weights by layer name
+    x = img_input = Input((None, None, 3))
+    for l in layers:
+        x = l(x)
+    full_model = Model(inputs=img_input, outputs=x, name='{}_full'.format(arch))
+    weights_file = _get_vgg_weights_file(arch)
+    print('Loading {} weights from {}'.format(arch, weights_file))
+    full_model.load_weights(weights_file, by_name=True)
+    for l in layers:
+        l.trainable = False
 
-    if normalized_inputs:
-        vgg_model_file = '../evolving_wilds/cnn_utils/vgg_normtanh_ims{}-{}.h5'.format(shape[0], shape[1])
-        img = Lambda(vgg_preprocess_norm,
-            name='lambda_preproc_norm-11')(img_input)
-    else:
-        vgg_model_file = '../evolving_wilds/cnn_utils/vgg_01_ims{}-{}.h5'.format(shape[0], shape[1])
-        img = Lambda(vgg_preprocess,
-            name='lambda_preproc_clip01')(img_input)
-
-    if os.path.isfile(vgg_model_file):
-        print('Loading vgg model from {}'.format(vgg_model_file))
-        return load_model(vgg_model_file,
-            custom_objects={
-                'vgg_preprocess_norm': vgg_preprocess_norm, 
-                'vgg_preprocess': vgg_preprocess})
-    
+    _vgg_layers[arch] = layers
+    return layers
 
-    #img = Lambda(lambda arg:vgg_preprocess(arg, normalized=normalized_inputs),
-    #    name='lambda_preproc_norm{}'.format(normalized_inputs))(img_input)
-
-    x1 = Conv2D(64, (3, 3), activation='relu', padding='same', name='block1_conv1')(img)
-    x2 = Conv2D(64, (3, 3), activation='relu', padding='same', name='block1_conv2')(x1)
-    x3 = AveragePooling2D((2, 2), name='block1_pool')(x2)
-
-    x4 = Conv2D(128, (3, 3), activation='relu', padding='same', name='block2_conv1')(x3)
-    x5 = Conv2D(128, (3, 3), activation='relu', padding='same', name='block2_conv2')(x4)
-    x6 = AveragePooling2D((2, 2), name='block2_pool')(x5)
-
-    x7 = Conv2D(256, (3, 3), activation='relu', padding='same', name='block3_conv1')(x6)
-    x8 = Conv2D(256, (3, 3), activation='relu', padding='same', name='block3_conv2')(x7)
-    x9 = Conv2D(256, (3, 3), activation='relu', padding='same', name='block3_conv3')(x8)
-    x10 = Conv2D(256, (3, 3), activation='relu', padding='same', name='block3_conv4')(x9)
-    x11 = AveragePooling2D((2, 2), name='block3_pool')(x10)
-
-    x12 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block4_conv1')(x11)
-    x13 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block4_conv2')(x12)
-    x14 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block4_conv3')(x13)
-    x15 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block4_conv4')(x14)
-    x16 = AveragePooling2D((2, 2), name='block4_pool')(x15)
-
-    x17 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block5_conv1')(x16)
-    x18 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block5_conv2')(x17)
-    x19 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block5_conv3')(x18)
-    x20 = Conv2D(512, (3, 3), activation='relu', padding='same', name='block5_conv4')(x19)
-    x21 = AveragePooling2D((2, 2), name='block5_pool')(x20)
-
-    model = Model(inputs=[img_input], outputs=[x2, x5, x9, x14, x19])
-    model_orig = VGG19(weights='imagenet', input_shape=shape, include_top=False)
-
-    # ignore the lambda we put in for preprocessing
-    vgg_layers = [l for l in model.layers if not isinstance(l, Lambda)]
-    for li, l in enumerate(vgg_layers):
-        weights = model_orig.layers[li].get_weights()
-        l.set_weights(weights)
-        print('Copying imagenet weights for layer {}: {}'.format(li, l.name))
-        l.trainable = False
 
-    if not os.path.isfile(vgg_model_file):
-        model.save(vgg_model_file)
+def vgg_feature_extractor(arch='vgg16', output_layers=None, preprocess='01'):
+    '''
+    Fully-convolutional VGG feature extractor that works on any image size. The conv weights are loaded once
+    per process and shared by all extractors, and each extractor stops at the deepest layer that it outputs.
+    Extractors are cached, so all losses that ask for the same one share a single model.
+
+    :param arch: 'vgg16' or 'vgg19'
+    :param output_layers: names of the layers to output, e.g. ['block1_conv2', 'block3_conv3']
+    :param preprocess: '01' for images in [0, 1], 'tanh' for images in [-1, 1], or None for inputs that are
+        already preprocessed
+    '''
+    from keras.layers import Input, Lambda
+    from keras.models import Model
+
+    if output_layers is None:
+        output_layers = VGG_DEFAULT_OUTPUT_LAYERS
+    key = (arch, tuple(output_layers), preprocess)
+    _check_vgg_graph()
+    if key in _vgg_feature_extractors:
+        return _vgg_feature_extractors[key]
+
+    layers = _get_vgg_layers(arch)
+    layer_names = [l.name for l in layers]
+    last_layer_idx = max([layer_names.index(n) for n in output_layers])
+
+    img_input = Input((None, None, 3))
+    if preprocess == 'tanh':
+        x = Lambda(vgg_preprocess_norm, name='lambda_preproc_norm-11')(img_input)
+    elif preprocess == '01':
+        x = Lambda(vgg_preprocess, name='lambda_preproc_clip01')(img_input)
+    else:
+        x = img_input
+
+    outputs = {}
+    for l in layers[:last_layer_idx + 1]:
+        x = l(x)
+        outputs[l.name] = x
 
+    model = Model(inputs=img_input, outputs=[outputs[n] for n in output_layers],
+                  name='{}_{}_to_{}'.format(arch, preprocess, layer_names[last_layer_idx]))
+    _vgg_feature_extractors[key] = model
     return model
 
 
-#from networks import affine_networks
-#from networks import transform_network_utils
-from keras.layers import Lambda
+def vgg_isola_norm(shape=None, normalized_inputs=False, do_preprocess=True, output_layers=None):
+    '''
+    VGG16 features used by the isola (lpips) perceptual loss. shape is ignored, the extractor works on any size
+    '''
+    if not do_preprocess:
+        preprocess = None
+    else:
+        preprocess = 'tanh' if normalized_inputs else '01'
+    return vgg_feature_extractor('vgg16', output_layers=output_layers, preprocess=preprocess)
+
+
+def vgg_norm(shape=None, normalized_inputs=False, output_layers=None):
+    '''
+    VGG19 features, with average pooling. shape is ignored, the extractor works on any size
+    '''
+    return vgg_feature_extractor(
+        'vgg19', output_layers=output_layers, preprocess='tanh' if normalized_inputs else '01')
+
+
 class VggFeatLoss(object):
-    def __init__(self, feat_net, dist='l2'):
+    def __init__(self, feat_net, dist='l2', single_pass=True, feature_cache=None):
+        '''
+        :param feat_net: model that maps images to a list of feature maps, e.g. from vgg_isola_norm
+        :param single_pass: run feat_net once on y_true and y_pred concatenated along the batch axis,
+            instead of once on each
+        :param feature_cache: optional data_cache_utils.FeatureCache of the target features of each dataset example,
+            filled with feat_net.predict. If given, y_true is ignored, and the target features of each batch have to
+            be fed in with feed_target_features before its step. experiment_engine.train_batch_by_batch does this
+            for training generators made with gen_batch(yield_idxs=True). Only valid if the targets are not augmented
+        '''
         self.feat_net = feat_net
         self.dist = dist
+        self.single_pass = single_pass
+        self.feature_cache = feature_cache
+
+        self._target_feats = None
+        self._fed_feats = None
+
+    @property
+    def fixed_resolution(self):
+        # the cached target features are those of the full resolution targets (see progressive_utils)
+        return self.feature_cache is not None
+
+    def _make_target_feats(self):
+        import tensorflow as tf
+        # the target features are fed in from the cache before each step
+        self._target_feats = []
+        self._target_phs = []
+        self._assign_ops = []
+        for shape in self.feat_net.output_shape if isinstance(self.feat_net.output_shape, list) \
+                else [self.feat_net.output_shape]:
+            ph = tf.placeholder(tf.float32, shape=(None,) + tuple(shape[1:]))
+            var = tf.Variable(tf.zeros([1] + [d if d is not None else 1 for d in shape[1:]]),
+                              trainable=False, validate_shape=False)
+            self._target_phs.append(ph)
+            self._assign_ops.append(tf.assign(var, ph, validate_shape=False))
+
+            feats = tf.identity(var)
+            feats.set_shape((None,) + tuple(shape[1:]))
+            self._target_feats.append(feats)
+
+    def _assign_target_features(self, feats):
+        import keras.backend as K
+        if self._target_feats is None:
+            self._make_target_feats()
+        K.get_session().run(self._assign_ops, feed_dict=dict(zip(self._target_phs, feats)))
+
+    def feed_target_features(self, idxs):
+        '''
+        Loads the cached target features of the examples at idxs, for the next step
+        '''
+        self._fed_feats = self.feature_cache.get(np.asarray(idxs))
+        self._assign_target_features(self._fed_feats)
+
+    def feed_micro_batch(self, start, end):
+        # grad_accum_utils.GradientAccumulator calls this before each micro-batch, so that the target features line
+        # up with the micro-batch's predictions
+        self._assign_target_features([f[start:end] for f in self._fed_feats])
+
+    def _features(self, y_true, y_pred):
+        import tensorflow as tf
+        if self.feature_cache is not None:
+            if self._target_feats is None:
+                self._make_target_feats()
+
+            # fail loudly rather than train against the features of some other batch
+            n_pred = tf.shape(y_pred)[0]
+            target_feats = []
+            for feats in self._target_feats:
+                check = tf.assert_equal(
+                    tf.shape(feats)[0], n_pred,
+                    message='VggFeatLoss: the fed target features do not match the batch, did you call '
+                            'feed_target_features before this step?')
+                with tf.control_dependencies([check]):
+                    target_feats.append(tf.identity(feats))
+
+            x2 = self.feat_net(y_pred)
+            return target_feats, x2 if isinstance(x2, list) else [x2]
+
+        if not self.single_pass:
+            x1 = self.feat_net(y_true)
+            x2 = self.feat_net(y_pred)
+        else:
+            # one forward pass (and one copy of the network in the graph) for both
+            n = tf.shape(y_true)[0]
+            x = self.feat_net(tf.concat([y_true, y_pred], axis=0))
+            if not isinstance(x, list):
+                x = [x]
+            x1 = [x_l[:n] for x_l in x]
+            x2 = [x_l[n:] for x_l in x]
+        if not isinstance(x1, list):
+            x1, x2 = [x1], [x2]
+        return x1, x2
 
     def compute_loss(self, y_true, y_pred):
         import tensorflow as tf
         # just preprocess as a part of the model
-        n_feature_layers = len(self.feat_net.outputs)
-        x1 = self.feat_net(y_true)
-        x2 = self.feat_net(y_pred)
+        x1, x2 = self._features(y_true, y_pred)
+        n_feature_layers = len(x1)
 
         loss = []
 
@@ -372,54 +462,104 @@ class VggFeatLoss(object):
                 loss = loss + d_mean
         return loss
 
+def gen_feeding_target_features(gen, losses):
+    '''
+    Wraps a batch generator that yields the dataset idxs of each batch last (e.g. gen_batch with yield_idxs=True),
+    feeding the cached target features of each batch to losses (e.g. VggFeatLoss with a feature_cache) as it is
+    drawn. The batch should be trained on before the next one is drawn.
+    '''
+    for batch in gen:
+        for loss in losses:
+            loss.feed_target_features(batch[-1])
+        yield batch
+
+
 class MinLossOverSamples(object):
+    # predictions are reshaped to pred_shape, so this can't be used at other resolutions (see progressive_utils)
+    fixed_resolution = True
+
     def __init__(self, n_samples, pred_shape,
                      loss_name=None,
                      loss_fn=None,
+                     samples_per_chunk=None,
                      ):
+        '''
+        :param samples_per_chunk: if set, evaluates the loss on this many samples at a time without gradients to
+            find the best sample, and then evaluates the loss of that sample again with gradients. The intermediate
+            tensors (including the ones kept for backprop) only grow with samples_per_chunk rather than n_samples
+        '''
         self.n_samples = n_samples
         self.loss_name = loss_name
         self.loss_fn = loss_fn
         self.pred_shape = pred_shape
+        self.samples_per_chunk = samples_per_chunk
 
-    def compute_loss(self, y_true, y_pred):
-        y_true_samples = tf.reshape(y_true, [-1, 1] + list(self.pred_shape))#, [1, self.n_samples] + [1] * len(self.pred_shape))
+    def _loss_per_sample(self, y_true_samples, y_pred_samples, n_samples):
+        # returns batch x n_samples
         if self.loss_name is not None:
-            y_pred_samples = tf.reshape(y_pred, [-1, self.n_samples] + list(self.pred_shape))
-            # average over every dimension except batch
+            # broadcast y_true over samples, and average over every dimension except batch and sample
             if 'l1' in self.loss_name:
                 loss_vals = tf.reduce_mean(tf.abs(y_pred_samples - y_true_samples), axis=list(range(2, len(self.pred_shape)+2)))
             else:
                 loss_vals = tf.reduce_mean(tf.square(y_pred_samples - y_true_samples), axis=list(range(2, len(self.pred_shape)+2)))
         else:
-            # tile y_true samples so that they are the same shape as y_pred
+            # loss_fn expects y_true to be the same shape as y_pred, so tile y_true over the samples in this chunk
             y_true = tf.reshape(
-                tf.tile(y_true_samples, [1, self.n_samples] + [1] * len(self.pred_shape)), [-1] + list(self.pred_shape))
+                tf.tile(y_true_samples, [1, n_samples] + [1] * len(self.pred_shape)), [-1] + list(self.pred_shape))
+            y_pred = tf.reshape(y_pred_samples, [-1] + list(self.pred_shape))
             loss_vals = self.loss_fn(y_true=y_true, y_pred=y_pred)
-        print('loss shape {}'.format(loss_vals.get_shape()))
-        # reshape to batch x n_samples
-        loss_per_sample = tf.reshape(loss_vals, [-1, self.n_samples], name='reshape_batches_samples')
-        min_loss = tf.reduce_min(loss_per_sample, axis=1)
-        return tf.reduce_mean(min_loss)
+        return tf.reshape(loss_vals, [-1, n_samples], name='reshape_batches_samples')
+
+    def compute_loss(self, y_true, y_pred):
+        y_true_samples = tf.reshape(y_true, [-1, 1] + list(self.pred_shape))
+        y_pred_samples = tf.reshape(y_pred, [-1, self.n_samples] + list(self.pred_shape))
+
+        if self.samples_per_chunk is None:
+            return tf.reduce_mean(tf.reduce_min(
+                self._loss_per_sample(y_true_samples, y_pred_samples, self.n_samples), axis=1))
+
+        # find the best sample of each example without building the backward pass of every sample
+        min_loss = None
+        for start in range(0, self.n_samples, self.samples_per_chunk):
+            end = min(start + self.samples_per_chunk, self.n_samples)
+            # don't start on this chunk until we are done with the last one, so that tf doesn't keep every
+            # chunk's intermediate tensors around at once
+            with tf.control_dependencies([min_loss] if min_loss is not None else []):
+                chunk_losses = self._loss_per_sample(
+                    tf.stop_gradient(y_true_samples), tf.stop_gradient(y_pred_samples[:, start:end]), end - start)
+            chunk_min = tf.reduce_min(chunk_losses, axis=1)
+            chunk_argmin = tf.argmin(chunk_losses, axis=1, output_type=tf.int32) + start
+            if min_loss is None:
+                min_loss, min_idx = chunk_min, chunk_argmin
+            else:
+                is_better = chunk_min < min_loss
+                min_loss = tf.where(is_better, chunk_min, min_loss)
+                min_idx = tf.where(is_better, chunk_argmin, min_idx)
+
+        # the gradient of the min is the gradient of the best sample's loss, so only backprop through that one
+        best_samples = tf.gather_nd(y_pred_samples, tf.stack([tf.range(tf.shape(min_idx)[0]), min_idx], axis=1))
+        return tf.reduce_mean(self._loss_per_sample(y_true_samples, best_samples[:, tf.newaxis], 1))
 
 
 
 class SoftSuperpixelLoss(object):
+    # the coordinate grid is built for img_shape, so this can't be used at other resolutions (see progressive_utils)
+    fixed_resolution = True
+
     def __init__(self, img_shape, lambdas=[1., 1., 1., 1., 1.], sigma_norm=0.2):
         h, w = img_shape[:2]
         n_dims = 5  # x y rgb
 
-        # to normalize space and color
-        self.lambdas_norm = tf.constant(
-            np.tile(np.reshape([1. / w, 1. / h, 1., 1., 1.], (1, 1, n_dims)), (1, h * w, 1)), dtype=tf.float32)
+        # to normalize space and color. These broadcast over the batch and pixels
+        self.lambdas_norm = tf.constant(np.reshape([1. / w, 1. / h, 1., 1., 1.], (1, 1, n_dims)), dtype=tf.float32)
 
-        xs, ys = np.meshgrid(np.linspace(0, w, w, endpoint=False).astype(int),
-                                    np.linspace(0, h, h, endpoint=False).astype(int))
-        xs = np.reshape(xs, (1, -1, 1))
-        ys = np.reshape(ys, (1, -1, 1))
+        coords = constant_utils.get_constant('coordinate_grid', shape=(h, w))
 
-        self.xs = tf.constant(xs, dtype=tf.int32)
-        self.ys = tf.constant(ys, dtype=tf.int32)
+        # pixel coordinates, 1 x h x w
+        self.xs = coords[..., 0]
+        self.ys = coords[..., 1]
+        # pixel coordinates, 1 x n_pixels x 2
+        self.xys = tf.reshape(coords, [1, h * w, 2])
         self.lambdas = tf.constant(lambdas / np.sum(lambdas), dtype=tf.float32)
         self.sigma_norm = sigma_norm
 
@@ -432,8 +572,8 @@ class SoftSuperpixelLoss(object):
         n_dims = 5
 
         # weighted center of mass
-        x = tf.cast(tf.tile(tf.reshape(self.xs, [1, h, w]), [batch_size, 1, 1]), tf.float32)
-        y = tf.cast(tf.tile(tf.reshape(self.ys, [1, h, w]), [batch_size, 1, 1]), tf.float32)
+        x = self.xs
+        y = self.ys
 
         eps = 1e-8
         # grayscale
@@ -473,23 +613,19 @@ class SoftSuperpixelLoss(object):
         # indices in batch, row, column format
         #y_pred_norm, center_x, center_y = self.compute_center_coords(y_pred)
         y_pred_norm, center_point_xyrgb = self.compute_center_coords(y_true, y_pred)
-        center_point_xyrgb = tf.tile(
-            tf.reshape(center_point_xyrgb, [batch_size, 1, n_dims]), (1, h * w, 1))
+        center_point_xyrgb = tf.reshape(center_point_xyrgb, [batch_size, 1, n_dims])
         #center_x = tf.reshape(center_x, [batch_size])
         #center_y = tf.reshape(center_y, [batch_size])
         # make a batch_size x 3 matrix so we can index into the batch, r, c dimensions
         #center_rgb = tf.gather_nd(y_true, center_point_bxy)  # should be batch_size x 3
         true_rgbs = tf.reshape(y_true, [batch_size, n_pixels, n_chans])
 
-        im_coords = tf.concat([
-            tf.cast(tf.tile(self.xs, [batch_size, 1, 1]), tf.float32),
-            tf.cast(tf.tile(self.ys, [batch_size, 1, 1]), tf.float32),
-            true_rgbs
-        ], axis=-1)
-
-        # compute normalized distance, and weight using lambdas
-        pixel_dists = ((im_coords - center_point_xyrgb) * self.lambdas_norm) ** 2 * self.lambdas
-        soft_pixel_affinities = (1. - tf.exp(tf.reduce_sum(-0.5 * pixel_dists / self.sigma_norm ** 2, axis=-1)))
+        # compute normalized distance, and weight using lambdas. Pixel coordinates are the same for every
+        # example, so compute the spatial and color distances separately and let them broadcast
+        xy_dists = ((self.xys - center_point_xyrgb[:, :, :2]) * self.lambdas_norm[:, :, :2]) ** 2 * self.lambdas[:2]
+        rgb_dists = ((true_rgbs - center_point_xyrgb[:, :, 2:]) * self.lambdas_norm[:, :, 2:]) ** 2 * self.lambdas[2:]
+        pixel_dists = tf.reduce_sum(xy_dists, axis=-1) + tf.reduce_sum(rgb_dists, axis=-1)
+        soft_pixel_affinities = (1. - tf.exp(-0.5 * pixel_dists / self.sigma_norm ** 2))
         soft_pixel_affinities = tf.reshape(soft_pixel_affinities, [batch_size, h, w])  # weight mask
 
         return soft_pixel_affinities * y_pred_norm
@@ -541,48 +677,105 @@ class TransformedLoss(object):
 
 
 class PatchLoss(object):
-    def __init__(self, n_patches, img_shape, patch_size, mask_output=None, agg_type='median', norm_type='l1'):
+    def __init__(self, n_patches, img_shape, patch_size, mask_output=None, agg_type='median', norm_type='l1',
+                 sample_patches=False, stride=None):
+        '''
+        Loss computed on square patches of 2D images, and then aggregated over the patches, e.g. with a median so
+        that a few badly matched patches don't dominate. The sum over each patch comes from box_sum of the
+        per-pixel error, so each patch adds O(1) work to computing the error over the full image.
+
+        :param n_patches: number of random patch locations per example, if sample_patches
+        :param mask_output: optional mask tensor. The loss of each patch is then normalized by the sum of the
+            mask over the patch, rather than the patch size
+        :param agg_type: 'median' over the patches of each example, 'median-nonzero' for the mean of the losses at
+            or below the median of the patches that have content, or 'mean'. Both medians are the upper median when
+            there is an even number of patches
+        :param sample_patches: evaluate n_patches random patch locations per step instead of a grid of patches
+        :param stride: spacing of the grid of patches. Defaults to patch_size, i.e. non-overlapping patches
+        '''
         self.n_patches = n_patches
         self.img_shape = img_shape
         self.patch_size = patch_size
         self.agg_type = agg_type
         self.norm_type = norm_type
         self.mask_output = mask_output
+        self.sample_patches = sample_patches
+        self.stride = stride if stride is not None else patch_size
+
+    @property
+    def fixed_resolution(self):
+        # sampled locations are bounded by img_shape, and mask_output is a full resolution tensor, so neither can be
+        # used at other resolutions (see progressive_utils)
+        return self.sample_patches or self.mask_output is not None
+
+    def _sample_locations(self, batch_size):
+        # random top-left corners for each example, batch_size x n_patches x 3 in batch, row, column order
+        max_y = self.img_shape[0] - self.patch_size + 1
+        max_x = self.img_shape[1] - self.patch_size + 1
+        ys = tf.random_uniform([batch_size, self.n_patches], 0, max_y, dtype=tf.int32)
+        xs = tf.random_uniform([batch_size, self.n_patches], 0, max_x, dtype=tf.int32)
+        bs = tf.tile(tf.expand_dims(tf.range(batch_size), axis=-1), [1, self.n_patches])
+        return tf.stack([bs, ys, xs], axis=-1)
+
+    def _patch_values(self, maps, locations=None, is_strided=False):
+        '''
+        :param maps: batch_size x rows x cols x n, holding the value of each patch at its top-left corner
+        :param locations: sampled corners from _sample_locations, or None for the grid of patches
+        :param is_strided: maps are already only computed on the grid of patches
+        :return: batch_size x n_patches x n
+        '''
+        if locations is not None:
+            return tf.gather_nd(maps, locations)
+        if not is_strided:
+            maps = maps[:, ::self.stride, ::self.stride]
+        return tf.reshape(maps, [tf.shape(maps)[0], -1, maps.get_shape().as_list()[-1]])
 
     def compute_loss(self, y_true, y_pred):
-        patches_true = affine_networks._get_patches(y_true, self.img_shape, self.patch_size)
-        patches_pred = affine_networks._get_patches(y_pred, self.img_shape, self.patch_size)
+        p = self.patch_size
+        if self.norm_type == 'l1':
+            errs = tf.abs(y_true - y_pred)
+        elif self.norm_type == 'l2':
+            errs = 0.5 * tf.square(y_true - y_pred)
+        else:
+            raise ValueError('Unknown norm type {}'.format(self.norm_type))
+
+        # sum over channels first, so that we only need one box sum for the error
+        maps = [tf.reduce_sum(errs, axis=-1, keepdims=True)]
+        if self.mask_output is not None:
+            maps.append(tf.reduce_sum(self.mask_output, axis=-1, keepdims=True))
+        patch_sums = box_sum(tf.concat(maps, axis=-1), [p, p])
 
+        locations = self._sample_locations(tf.shape(y_true)[0]) if self.sample_patches else None
+        patch_sums = self._patch_values(patch_sums, locations)
         if self.mask_output is not None:
-            patches_mask = affine_networks._get_patches(self.mask_output, self.img_shape, self.patch_size)
-
-            if self.norm_type == 'l1':
-                losses = tf.reduce_sum(tf.abs(patches_true - patches_pred), axis=[1, 2, 3])
-            elif self.norm_type == 'l2':
-                losses = 0.5 * tf.reduce_sum(tf.square(patches_true - patches_pred), axis=[1, 2, 3])
-
-            losses = losses / (1e-8 + tf.reduce_sum(patches_mask, axis=[1, 2, 3]))
-            patch_maxes = tf.reduce_max(patches_mask, axis=[1, 2, 3])
-        else:    
-            if self.norm_type == 'l1':
-                losses = tf.reduce_mean(tf.abs(patches_true - patches_pred), axis=[1, 2, 3])  # take the mean over everything but patches
-            elif self.norm_type == 'l2':
-                losses = 0.5 * tf.reduce_mean(tf.square(patches_true - patches_pred), axis=[1, 2, 3])
-            patch_maxes = tf.reduce_max(patches_true, axis=[1, 2, 3])  # make batch_size x n_patches
+            losses = patch_sums[:, :, 0] / (1e-8 + patch_sums[:, :, 1])
+        else:
+            # mean over each patch
+            losses = patch_sums[:, :, 0] / float(p * p * self.img_shape[-1])
 
         if self.agg_type == 'median':
-            med_num = tf.shape(losses)[-1] / 2
-            #med_num = len(losses) / 2
-            vals, idxs = tf.nn.top_k(losses, self.n_patches/2)
-            return vals[0]
+            # nth_element only partially sorts the losses. Element n // 2 is the upper median if n is even
+            n_losses = tf.shape(losses)[-1]
+            return tf.reduce_mean(tf.contrib.nn.nth_element(losses, n_losses // 2))
         elif self.agg_type == 'median-nonzero':
-            keep_patches = tf.greater(patch_maxes, 1e-2)
-            keep_losses = tf.boolean_mask(losses, keep_patches)
-            n_losses = tf.shape(keep_losses)[-1]
-            med_num = tf.shape(keep_losses)[-1] / 2
-            #med_num = len(losses) / 2
-            vals, idxs = tf.nn.top_k(keep_losses, n_losses)  # sort losses
-            return tf.reduce_mean(vals[-med_num:])  # take the bottom half (lowest) losses
+            content = self.mask_output if self.mask_output is not None else y_true
+            content = tf.reduce_max(content, axis=-1, keepdims=True)
+            if self.sample_patches:
+                patch_maxes = tf.nn.max_pool(content, [1, p, p, 1], [1, 1, 1, 1], padding='VALID')
+            else:
+                patch_maxes = tf.nn.max_pool(content, [1, p, p, 1], [1, self.stride, self.stride, 1], padding='VALID')
+            patch_maxes = self._patch_values(patch_maxes, locations, is_strided=True)[:, :, 0]
+
+            keep_losses = tf.boolean_mask(losses, tf.greater(patch_maxes, 1e-2))
+            n_keep = tf.shape(keep_losses)[0]
+
+            def _lower_half_mean():
+                med = tf.contrib.nn.nth_element(keep_losses, n_keep // 2)
+                # take the bottom half (lowest) losses
+                return tf.reduce_mean(tf.boolean_mask(keep_losses, tf.less_equal(keep_losses, med)))
+
+            # nth_element fails on an empty tensor, e.g. if every patch in the batch is blank
+            return tf.cond(n_keep > 0, _lower_half_mean, lambda: tf.zeros([], dtype=losses.dtype))
         else:
             print('Computing mean L1 over all patches')
             return tf.reduce_mean(losses)
@@ -636,17 +829,65 @@ class NegHistogramLoss(object):
         return -total_prob            
 
 
+def _fold_time_into_batch(x, time_axis, frame_idxs=None):
+    '''
+    Moves the time axis of x to the front and merges it into the batch, so that frame t of example b is at
+    index t * batch_size + b.
+
+    :param frame_idxs: frames to keep. Defaults to all of them
+    :return: the folded tensor, and the number of frames in it
+    '''
+    n_dims = len(x.get_shape().as_list())
+    time_axis = time_axis % n_dims
+    if frame_idxs is not None:
+        x = tf.gather(x, indices=frame_idxs, axis=time_axis)
+    n_frames = x.get_shape().as_list()[time_axis]
+
+    perm = [time_axis] + [i for i in range(n_dims) if i != time_axis]
+    x = tf.transpose(x, perm)
+    frame_shape = x.get_shape().as_list()[2:]
+    if None in frame_shape:
+        frame_shape = tf.shape(x)[2:]
+    # keep the static frame shape if we know it, since e.g. conv layers in loss_fn need the number of channels
+    return tf.reshape(x, tf.concat([[-1], frame_shape], axis=0)), n_frames
+
+
+def _sum_folded_loss(loss, n_frames, weights=None):
+    '''
+    Sums a loss computed on a time-folded batch over the frames.
+
+    :param loss: a scalar, or a tensor whose first dim is n_frames * batch_size
+    :param weights: optional n_frames x batch_size x ... weights for each frame
+    '''
+    if len(loss.get_shape().as_list()) == 0:
+        if weights is not None:
+            raise ValueError('Cannot weight the frames of a loss that is averaged over the batch')
+        # the loss is a mean over frames and examples
+        return loss * float(n_frames)
+
+    loss = tf.reshape(loss, tf.concat([[n_frames, -1], tf.shape(loss)[1:]], axis=0))
+    if weights is not None:
+        loss = loss * tf.expand_dims(weights, axis=-1)
+    return tf.reduce_sum(loss, axis=0)
+
+
 class TimeSliceLoss(object):
     def __init__(self, time_axis, loss_fn, 
             slice_idxs=[],
             n_frames=30,
-            compute_mean = True):
+            compute_mean = True,
+            fold_time=False):
+        '''
+        :param fold_time: fold the sliced frames into the batch and evaluate loss_fn on each frame in a single call,
+            rather than on the whole sliced video
+        '''
         self.time_axis = time_axis
         self.loss_fn = loss_fn
         self.compute_mean = compute_mean    
         self.n_frames = n_frames
         self.slice_len = len(slice_idxs)
         self.slice_idxs = tf.constant(slice_idxs, dtype=tf.int32)
+        self.fold_time = fold_time
         print(slice_idxs)
         print(self.slice_idxs)
 
@@ -656,9 +897,14 @@ class TimeSliceLoss(object):
         y_pred = tf.reshape(y_pred, [
             tf.shape(y_pred)[0], tf.shape(y_pred)[1], tf.shape(y_pred)[2], self.n_frames, 3])
 
-        y_true = tf.gather(y_true, indices=self.slice_idxs, axis=self.time_axis)
-        y_pred = tf.gather(y_pred, indices=self.slice_idxs, axis=self.time_axis)
-        total_loss = self.loss_fn(y_true, y_pred)
+        if self.fold_time:
+            y_true, _ = _fold_time_into_batch(y_true, self.time_axis, self.slice_idxs)
+            y_pred, _ = _fold_time_into_batch(y_pred, self.time_axis, self.slice_idxs)
+            total_loss = _sum_folded_loss(self.loss_fn(y_true, y_pred), self.slice_len)
+        else:
+            y_true = tf.gather(y_true, indices=self.slice_idxs, axis=self.time_axis)
+            y_pred = tf.gather(y_pred, indices=self.slice_idxs, axis=self.time_axis)
+            total_loss = self.loss_fn(y_true, y_pred)
         
         '''
         true_frames = tf.unstack(y_true, num=self.n_frames, axis=self.time_axis)
@@ -679,7 +925,12 @@ class TimeSummedLoss(object):
                      time_axis=-2, compute_mean=True, pad_amt=None,
                     do_reshape_to=None,
                      compute_over_frame_idxs=None,
+                     fold_time=False,
                      ):
+        '''
+        :param fold_time: fold the frames into the batch and call loss_fn once, instead of once per frame.
+            loss_fn should return a loss per example (or a scalar mean, if there are no weights)
+        '''
         self.time_axis = time_axis
         self.loss_fn = loss_fn
         self.weights_output = weights_output # in case we want to predict the weight for each time step
@@ -687,6 +938,7 @@ class TimeSummedLoss(object):
         self.pad_amt = pad_amt
         self.include_frames = compute_over_frame_idxs
         self.do_reshape_to = do_reshape_to
+        self.fold_time = fold_time
 
     def compute_loss(self, y_true, y_pred):
         if self.do_reshape_to is not None: # reshape a flattened video
@@ -703,7 +955,24 @@ class TimeSummedLoss(object):
         else:
             include_frames = self.include_frames
 
-        # TODO: switch to tf.map_fn?
+        if self.fold_time:
+            y_true, n_included = _fold_time_into_batch(y_true, self.time_axis, include_frames)
+            y_pred, _ = _fold_time_into_batch(y_pred, self.time_axis, include_frames)
+
+            if self.weights_output is not None:
+                # n_frames x batch_size x ...
+                weights = tf.gather(self.weights_output, indices=include_frames, axis=-1)
+                n_weight_dims = len(weights.get_shape().as_list())
+                weights = tf.transpose(weights, [n_weight_dims - 1] + list(range(n_weight_dims - 1)))
+            else:
+                weights = None
+
+            total_loss = _sum_folded_loss(
+                self.loss_fn(y_true=y_true, y_pred=y_pred), n_included, weights=weights)
+            if self.compute_mean:
+                total_loss /= float(n_frames)
+            return total_loss
+
         true_frames = tf.unstack(y_true, num=n_frames, axis=self.time_axis)
         pred_frames = tf.unstack(y_pred, num=n_frames, axis=self.time_axis)
 
@@ -745,20 +1014,9 @@ class VoxelmorphMetrics_bound(object):
         mean = self.flow_mean
         log_sigma = self.flow_logvar
         
-        # compute the degree matrix. If this has already happened
-        # should only compute this once!
-        # also need to check that this works!
-        # z = K.ones((1, ) + vol_size + (3, ))
+        # the degree matrix only depends on the shape, so it is computed once and shared
         sz = log_sigma.get_shape().as_list()[1:] 
-        z = K.ones([1] + sz)
-
-        filt = np.zeros((3,3,2,2))
-        for i in range(2):
-            filt[[0,2],1,i,i] = 1
-            filt[1,[0,2],i,i] = 1
-        filt_tf = tf.convert_to_tensor(filt,dtype=tf.float32)
-        D = tf.nn.conv2d(z, filt_tf, [1,1,1,1],"SAME")
-        D = K.expand_dims(D, 0)
+        D = constant_utils.get_constant('degree_map', shape=sz)
 
         sigma_terms = (self.alpha * D * tf.exp(log_sigma) - log_sigma)
 
@@ -776,20 +1034,9 @@ class VoxelmorphMetrics(object):
         mean = y_pred[:,:,:,0:2]
         log_sigma = y_pred[:,:,:,2:]
         
-        # compute the degree matrix. If this has already happened
-        # should only compute this once!
-        # also need to check that this works!
-        # z = K.ones((1, ) + vol_size + (3, ))
+        # the degree matrix only depends on the shape, so it is computed once and shared
         sz = log_sigma.get_shape().as_list()[1:] 
-        z = K.ones([1] + sz)
-
-        filt = np.zeros((3,3,2,2))
-        for i in range(2):
-            filt[[0,2],1,i,i] = 1
-            filt[1,[0,2],i,i] = 1
-        filt_tf = tf.convert_to_tensor(filt,dtype=tf.float32)
-        D = tf.nn.conv2d(z, filt_tf, [1,1,1,1],"SAME")
-        D = K.expand_dims(D, 0)
+        D = constant_utils.get_constant('degree_map', shape=sz)
 
         sigma_terms = (self.alpha * D * tf.exp(log_sigma) - log_sigma)
 
@@ -832,18 +1079,10 @@ class VoxelmorphMetrics(object):
             mu * P * mu = sum_i mu_i sum_j (mu_i - mu_j)
         where j are neighbors of i
         """
-        # i is at (x,y), j is at (x-1, y)
-        dy = (y_pred[:,1:,:,:] - y_true[:,1:,:,:]) * (y_pred[:,1:,:,:] - y_true[:,1:,:,:] - y_pred[:,:-1,:,:] + y_true[:,:-1,:,:])
-        # i is at (x,y), j is at (x, y-1)
-        dx = (y_pred[:,:,1:,:] - y_true[:,:,1:,:])  * (y_pred[:,:,1:,:] - y_true[:,:,1:,:] - y_pred[:,:,:-1,:] + y_true[:,:,:-1,:])
-
-        # i is at (x,y), j is at (x+1, y)
-        dy2 = (y_pred[:,:-1,:,:] - y_true[:,:-1,:,:]) * (y_pred[:,:-1,:,:] - y_true[:,:-1,:,:] - y_pred[:,1:,:,:] + y_true[:,1:,:,:])
-
-        # i is at (x,y), j is at (x, y+1)
-        dx2 = (y_pred[:,:,:-1,:] - y_true[:,:,:-1,:]) * (y_pred[:,:,:-1,:] - y_true[:,:,:-1,:] - y_pred[:,:,1:,:] + y_true[:,:,1:,:])
-
-        d = tf.reduce_mean(dx) + tf.reduce_mean(dy) + tf.reduce_mean(dy2) + tf.reduce_mean(dx2) 
+        # each pair of neighbors i, j contributes mu_i (mu_i - mu_j) + mu_j (mu_j - mu_i) = (mu_i - mu_j)^2,
+        # so the terms for (x-1, y) and (x+1, y) add up to the mean squared difference along y, and likewise for x
+        dy, dx = finite_diff_utils.spatial_diffs(y_pred - y_true, n_dims=2)
+        d = tf.reduce_mean(tf.square(dx)) + tf.reduce_mean(tf.square(dy))
         return d
 
     def kl_prec_term_manual(self,y_true,y_pred):
@@ -855,12 +1094,9 @@ class VoxelmorphMetrics(object):
             mu * P * mu = sum_i mu_i sum_j (mu_i - mu_j)
         where j are neighbors of i
         """
-        dy = y_pred[:,1:,:,:] * (y_pred[:,1:,:,:] - y_pred[:,:-1,:,:])
-        dx = y_pred[:,:,1:,:] * (y_pred[:,:,1:,:] - y_pred[:,:,:-1,:])
-        dy2 = y_pred[:,:-1,:,:] * (y_pred[:,:-1,:,:] - y_pred[:,1:,:,:])
-        dx2 = y_pred[:,:,:-1,:] * (y_pred[:,:,:-1,:] - y_pred[:,:,1:,:])
-
-        d = tf.reduce_mean(dx) + tf.reduce_mean(dy) + tf.reduce_mean(dy2) + tf.reduce_mean(dx2) 
+        # see prec_term_manual
+        dy, dx = finite_diff_utils.spatial_diffs(y_pred, n_dims=2)
+        d = tf.reduce_mean(tf.square(dx)) + tf.reduce_mean(tf.square(dy))
         return d
 
     def localNorm(I):
@@ -1090,13 +1326,10 @@ def gradient_loss_l2(n_dims):
 
     def compute_loss(y_true,y_pred):
         loss = 0.
-        for d in range(n_dims):
-            # we use x to indicate the current spatial dimension, not just the first
-            dydx = tf.abs(tf.gather(y_pred, tf.range(1, tf.shape(y_pred)[d + 1]), axis=d + 1) \
-                    - tf.gather(y_pred, tf.range(0, tf.shape(y_pred)[d + 1] - 1), axis=d + 1))
-
+        # we use x to indicate the current spatial dimension, not just the first
+        for dydx in finite_diff_utils.spatial_diffs(y_pred, n_dims):
             # average across spatial dims and color channels
-            loss += tf.reduce_mean(dydx * dydx)
+            loss += tf.reduce_mean(tf.square(dydx))
         return loss / float(n_dims)
     return compute_loss
     '''
@@ -1115,7 +1348,7 @@ def gradient_temporal_loss_l2(n_chans=3, norm=2):
         #y_true = tf.reshape(y_true, [tf.shape(y_true)[0], tf.shape(y_true)[1], tf.shape(y_true)[2], -1, n_chans)
         y_pred = tf.reshape(y_pred, [tf.shape(y_pred)[0], tf.shape(y_pred)[1], tf.shape(y_pred)[2], -1, n_chans])
 
-        dt = tf.abs(y_pred[:,:,:,1:] - y_pred[:,:,:,:-1])    
+        dt = tf.abs(finite_diff_utils.forward_diff(y_pred, axis=3))
         if norm == 2:
             dt2 = dt * dt
         else:
@@ -1128,11 +1361,7 @@ def gradient_temporal_loss_l2(n_chans=3, norm=2):
 class laplacian_reg(object):
     def __init__(self, n_chans):
         self.n_chans = n_chans
-        laplacian_filter = tf.constant([[0, -1, 0],
-                                                  [-1, 4, -1],
-                                                  [0, -1, 0],
-                                                  ], dtype=tf.float32)
-        self.laplacian_filter = tf.expand_dims(tf.expand_dims(laplacian_filter, -1), -1)
+        self.laplacian_filter = constant_utils.get_constant('laplacian_kernel')
 
     def compute_laplacian_l2(self, y_true, y_pred):
         # roll any dims after 3 into the channels dimension
@@ -1162,13 +1391,10 @@ class SpatialSegmentSmoothness(object):
         loss = 0
         segments_mask = 1. - self.warped_contours_layer_output
 
-        for d in range(self.n_dims):
-            # we use x to indicate the current spatial dimension, not just the first
-            dCdx = tf.gather(y_pred, tf.range(1, tf.shape(y_pred)[d + 1]), axis=d + 1) \
-                     - tf.gather(y_pred, tf.range(0, tf.shape(y_pred)[d + 1] - 1), axis=d + 1)
-
+        # we use x to indicate the current spatial dimension, not just the first
+        for d, dCdx in enumerate(finite_diff_utils.spatial_diffs(y_pred, self.n_dims)):
             # average across spatial dims and color channels
-            loss += tf.reduce_mean(tf.abs(dCdx * tf.gather(segments_mask, tf.range(1, tf.shape(y_pred)[d+1]), axis=d+1)))
+            loss += tf.reduce_mean(tf.abs(dCdx * finite_diff_utils.trim(segments_mask, axis=d + 1)))
         return loss
 
 
@@ -1186,19 +1412,15 @@ class SpatialIntensitySmoothness(object):
     def compute_loss(self, y_true, y_pred):
         loss = 0
 
-        for d in range(self.n_dims):
-            # we use x to indicate the current spatial dimension, not just the first
-            dCdx = tf.gather(y_pred, tf.range(1, tf.shape(y_pred)[d + 1]), axis=d + 1) \
-                     - tf.gather(y_pred, tf.range(0, tf.shape(y_pred)[d + 1] - 1), axis=d + 1)
-
-            if self.use_true_gradients:
-                dIdx = tf.abs(tf.gather(y_true, tf.range(1, tf.shape(y_true)[d + 1]), axis=d + 1) \
-                        - tf.gather(y_true, tf.range(0, tf.shape(y_true)[d + 1] - 1), axis=d + 1))
-
-            else:
-                dIdx = self.lambda_i * tf.abs(tf.gather(self.pred_image_output, tf.range(1, tf.shape(y_true)[d + 1]), axis=d + 1) \
-                        - tf.gather(self.pred_image_output, tf.range(0, tf.shape(y_true)[d + 1] - 1), axis=d + 1))
+        # we use x to indicate the current spatial dimension, not just the first
+        dCdxs = finite_diff_utils.spatial_diffs(y_pred, self.n_dims)
+        if self.use_true_gradients:
+            dIdxs = [tf.abs(dIdx) for dIdx in finite_diff_utils.spatial_diffs(y_true, self.n_dims)]
+        else:
+            dIdxs = [self.lambda_i * tf.abs(dIdx)
+                     for dIdx in finite_diff_utils.spatial_diffs(self.pred_image_output, self.n_dims)]
 
+        for dCdx, dIdx in zip(dCdxs, dIdxs):
             # average across spatial dims and color channels
             loss += tf.reduce_mean(tf.abs(dCdx * tf.exp(-dIdx)))
         return loss
@@ -145,10 +145,11 @@ class LogLosses(callbacks.Callback):
 
 
 class TensorBoard_ScalarLosses(callbacks.Callback):
-    def __init__(self, tensorboard_writer, loss_names=None, start_iter=0):
+    def __init__(self, tensorboard_writer, loss_names=None, start_iter=0, telemetry=None):
         self.tbw = tensorboard_writer
         self.iter_count = start_iter
         self.loss_names = loss_names
+        self.telemetry = telemetry  # buffered writer from telemetry_utils
 
     def on_train_begin(self, logs={}):
         self.metric_names = self.params.get('metrics')
@@ -160,6 +161,10 @@ class TensorBoard_ScalarLosses(callbacks.Callback):
         else:
             metric_names = self.loss_names
         metrics = [logs.get(m) for m in self.metric_names if m in logs]
+        if self.telemetry is not None:
+            self.telemetry.add_scalars(metric_names, metrics, self.iter_count)
+            return
+
         for i in range(len(metrics)):
             self.tbw.add_summary(tf.Summary(
                     value=[tf.Summary.Value(tag=metric_names[i], simple_value=metrics[i]), ]
@@ -170,8 +175,10 @@ class TensorBoard_ScalarLosses(callbacks.Callback):
 class ProgbarWrapper(callbacks.Callback):
     def __init__(self, loss_names, n_batch_per_epoch,
             model_name=None, start_epoch=0, end_epoch=None,
+            telemetry=None,
         ):
         self.loss_names = loss_names
+        self.telemetry = telemetry  # throttles redraws if specified
         self.n_batch_per_epoch = n_batch_per_epoch
         self.progbar = keras_generic_utils.Progbar(self.n_batch_per_epoch)
         self.model_name = model_name
@@ -193,5 +200,76 @@ class ProgbarWrapper(callbacks.Callback):
         else:
             loss_names = self.loss_names
         metrics = [logs.get(m) for m in self.metric_names if m in logs]
-        self.progbar.add(1, values=[(loss_names[i], metrics[i]) for i in range(len(metrics))])
+        if self.telemetry is not None:
+            self.telemetry.update_progbar(self.progbar, loss_names, metrics)
+        else:
+            self.progbar.add(1, values=[(loss_names[i], metrics[i]) for i in range(len(metrics))])
+
+
+
+class PhaseTiming(callbacks.Callback):
+    '''
+    Times each training step and the gap between steps (waiting for data, plus any other callbacks)
+    using a timing_utils.PhaseTimer, and writes the percentiles to tensorboard every epoch.
+    '''
+    def __init__(self, phase_timer, telemetry=None, start_iter=0):
+        self.phase_timer = phase_timer
+        self.telemetry = telemetry
+        self.iter_count = start_iter
+        self.batch_start_time = None
+        self.batch_end_time = None
+
+    def on_batch_begin(self, batch, logs={}):
+        self.batch_start_time = time.perf_counter()
+        if self.batch_end_time is not None:
+            self.phase_timer.record('data_wait', self.batch_end_time, self.batch_start_time)
+
+    def on_batch_end(self, batch, logs={}):
+        self.iter_count += 1
+        self.batch_end_time = time.perf_counter()
+        if self.batch_start_time is not None:
+            self.phase_timer.record('train_step', self.batch_start_time, self.batch_end_time)
+
+    def on_epoch_end(self, epoch, logs={}):
+        # don't count the end-of-epoch callbacks as waiting for data
+        self.batch_end_time = None
+        if self.telemetry is not None:
+            timing_names, timing_vals = self.phase_timer.scalars()
+            self.telemetry.add_scalars(timing_names, timing_vals, self.iter_count)
+
+
+class OpProfiling(callbacks.Callback):
+    '''
+    Drives a profiling_utils.SampledOpProfiler from fit_generator, and writes its report every epoch.
+    '''
+    def __init__(self, op_profiler, start_iter=0, logger=None):
+        self.op_profiler = op_profiler
+        self.iter_count = start_iter
+        self.logger = logger
+
+    def on_batch_begin(self, batch, logs={}):
+        self.op_profiler.before_step(self.iter_count)
+
+    def on_batch_end(self, batch, logs={}):
+        self.op_profiler.collect(self.iter_count)
+        self.op_profiler.after_step(self.iter_count)
+        self.iter_count += 1
+
+    def on_epoch_end(self, epoch, logs={}):
+        op_report = self.op_profiler.write_report()
+        if op_report is not None and self.logger is not None:
+            self.logger.debug(op_report)
+
+
+class TrainingStateSnapshot(callbacks.Callback):
+    '''
+    Snapshots the full training state (see state_utils) at the end of an epoch, if enough time has passed
+    since the last snapshot. Includes the counters of the other callbacks so that they resume in sync.
+    '''
+    def __init__(self, state_snapshotter, tracked_callbacks):
+        self.state_snapshotter = state_snapshotter
+        self.tracked_callbacks = tracked_callbacks
 
+    def on_epoch_end(self, epoch, logs={}):
+        self.state_snapshotter.maybe_save(
+            trainer_state={'epoch': epoch + 1}, callbacks=self.tracked_callbacks)
@@ -0,0 +1,384 @@
+'''
+Data-parallel training with one worker process per NUMA node on a single machine.
+
+Each worker builds its own copy of the experiment, pinned to the cores of its node, and trains on its own shard
+of the data (see Experiment.data_rank and batch_utils.gen_batch). The gradients of exp.trainer_model are averaged
+across workers through shared memory every step. Alternatively, each worker can take local steps and the weights
+are averaged every k steps. Only rank 0 writes checkpoints, images and logs.
+'''
+import copy
+import glob
+import os
+
+import numpy as np
+
+
+def numa_nodes():
+    '''
+    :return: list of lists of cores, one per NUMA node
+    '''
+    available = set(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else set(range(os.cpu_count()))
+    nodes = []
+    for cpulist_file in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        with open(cpulist_file, 'r') as f:
+            cpulist = f.read().strip()
+        cores = []
+        for r in cpulist.split(','):
+            if '-' in r:
+                start, end = r.split('-')
+                cores += list(range(int(start), int(end) + 1))
+            elif len(r) > 0:
+                cores.append(int(r))
+        cores = [c for c in cores if c in available]
+        if len(cores) > 0:
+            nodes.append(cores)
+    if len(nodes) == 0:
+        nodes = [sorted(available)]
+    return nodes
+
+
+def split_cores(n_workers):
+    # one group of cores per worker, following NUMA nodes where possible
+    nodes = numa_nodes()
+    if len(nodes) >= n_workers:
+        return nodes[:n_workers]
+    all_cores = [c for node in nodes for c in node]
+    if len(all_cores) < n_workers:
+        # more workers than cores, so they have to share
+        return [[all_cores[i % len(all_cores)]] for i in range(n_workers)]
+    return [[int(c) for c in cs] for cs in np.array_split(all_cores, n_workers)]
+
+
+class SharedMemoryAllReduce(object):
+    def __init__(self, rank, n_workers, barrier, shm_name, timeout=600.):
+        '''
+        Averages flat float32 vectors across worker processes. There is one shared buffer for each vector size,
+        which rank 0 allocates the first time a vector of that size is reduced, so every worker must make the same
+        sequence of calls with vectors of the same sizes.
+
+        :param barrier: multiprocessing.Barrier shared by all workers
+        :param shm_name: prefix of the names of the shared memory blocks. Must be the same for all workers
+        :param timeout: seconds to wait for the other workers before giving up (e.g. if one of them crashed)
+        '''
+        self.rank = rank
+        self.n_workers = n_workers
+        self.barrier = barrier
+        self.shm_name = shm_name
+        self.timeout = timeout
+
+        # vector size -> (shared memory block, buffer, slice of the vector that we average)
+        self._buffers = {}
+
+    def _wait(self):
+        self.barrier.wait(self.timeout)
+
+    def _get_buffer(self, n):
+        if n in self._buffers:
+            return self._buffers[n][1:]
+
+        from multiprocessing import shared_memory
+
+        # one row per worker, and one row for the result
+        name = '{}_{}'.format(self.shm_name, n)
+        n_bytes = (self.n_workers + 1) * n * 4
+        if self.rank == 0:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=n_bytes)
+            self._wait()
+        else:
+            self._wait()
+            shm = shared_memory.SharedMemory(name=name)
+        buf = np.ndarray((self.n_workers + 1, n), dtype=np.float32, buffer=shm.buf)
+
+        # each worker averages its own slice of the vector
+        bounds = np.linspace(0, n, self.n_workers + 1).astype(int)
+        my_slice = slice(bounds[self.rank], bounds[self.rank + 1])
+        self._buffers[n] = (shm, buf, my_slice)
+        return buf, my_slice
+
+    def allreduce_mean(self, vec):
+        buf, my_slice = self._get_buffer(vec.shape[0])
+
+        buf[self.rank] = vec
+        self._wait()
+        buf[-1, my_slice] = np.mean(buf[:-1, my_slice], axis=0)
+        self._wait()
+        # the result row isn't written again until everyone has passed the first barrier of the next call
+        return buf[-1].copy()
+
+    def broadcast(self, vec, root=0):
+        buf, _ = self._get_buffer(vec.shape[0])
+
+        if self.rank == root:
+            buf[-1] = vec
+        self._wait()
+        out = buf[-1].copy()
+        self._wait()
+        return out
+
+    def close(self):
+        # drop our views of the buffers before closing the blocks that they point into
+        blocks = [shm for shm, _, _ in self._buffers.values()]
+        self._buffers = {}
+        for shm in blocks:
+            shm.close()
+            if self.rank == 0:
+                shm.unlink()
+
+
+class DataParallelTrainer(object):
+    def __init__(self, model, allreducer, sync_every_n_steps=1):
+        '''
+        Replaces model.train_on_batch so that experiments don't need to change how they train.
+
+        :param model: compiled keras model, e.g. exp.trainer_model
+        :param allreducer: SharedMemoryAllReduce
+        :param sync_every_n_steps: if 1, gradients are averaged every step, so all workers take identical steps.
+            Otherwise, each worker takes local steps and the weights are averaged every this many steps
+        '''
+        self.model = model
+        self.allreducer = allreducer
+        self.sync_every_n_steps = sync_every_n_steps
+        self.n_steps = 0
+
+        self._orig_train_on_batch = model.train_on_batch
+        self.weights = model._collected_trainable_weights if hasattr(model, '_collected_trainable_weights') \
+            else model.trainable_weights
+
+        if sync_every_n_steps == 1:
+            self._build_functions()
+
+        # make sure every worker starts from the same weights
+        self._set_flat_weights(self.allreducer.broadcast(self._get_flat_weights()))
+
+        model.train_on_batch = self.train_on_batch
+
+    def _build_functions(self):
+        import keras.backend as K
+        from cnn_utils import grad_accum_utils
+
+        model = self.model
+
+        inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+        self.uses_learning_phase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        if self.uses_learning_phase:
+            inputs += [K.learning_phase()]
+
+        grads = model.optimizer.get_gradients(model.total_loss, self.weights)
+        self.loss_tensors = [model.total_loss] + list(getattr(model, 'metrics_tensors', []))
+        # state updates (e.g. batchnorm statistics) are applied locally on each worker
+        self.grad_fn = K.function(inputs, grads + self.loss_tensors, updates=model.state_updates
+                                  if hasattr(model, 'state_updates') else [])
+
+        # build the optimizer's update ops on placeholders, so that we can feed in the averaged gradients
+        self.grad_placeholders = [K.placeholder(shape=K.int_shape(w)) for w in self.weights]
+        self.apply_fn = grad_accum_utils.make_apply_gradients_function(
+            model, self.weights, self.grad_placeholders, inputs=self.grad_placeholders)
+
+    def _get_flat_weights(self):
+        import keras.backend as K
+        return np.concatenate([w.ravel() for w in K.batch_get_value(self.weights)]).astype(np.float32)
+
+    def _set_flat_weights(self, flat_weights):
+        import keras.backend as K
+        K.batch_set_value(list(zip(self.weights, self._unflatten(flat_weights))))
+
+    def _unflatten(self, flat):
+        import keras.backend as K
+        arrs = []
+        offset = 0
+        for w in self.weights:
+            shape = K.int_shape(w)
+            n = int(np.prod(shape))
+            arrs.append(np.reshape(flat[offset:offset + n], shape))
+            offset += n
+        return arrs
+
+    def train_on_batch(self, x, y, sample_weight=None, class_weight=None):
+        self.n_steps += 1
+        if self.sync_every_n_steps != 1:
+            outs = self._orig_train_on_batch(x, y, sample_weight=sample_weight, class_weight=class_weight)
+            if self.n_steps % self.sync_every_n_steps == 0:
+                self._set_flat_weights(self.allreducer.allreduce_mean(self._get_flat_weights()))
+            return outs
+
+        x, y, sample_weights = self.model._standardize_user_data(
+            x, y, sample_weight=sample_weight, class_weight=class_weight)
+        ins = x + y + sample_weights
+        if self.uses_learning_phase:
+            ins += [1.]
+
+        outs = self.grad_fn(ins)
+        n_weights = len(self.weights)
+
+        # average gradients and losses in one go
+        flat = np.concatenate([g.ravel() for g in outs[:n_weights]]
+                              + [np.reshape(l, (1,)) for l in outs[n_weights:]]).astype(np.float32)
+        flat = self.allreducer.allreduce_mean(flat)
+
+        n_grad_vals = flat.shape[0] - len(self.loss_tensors)
+        self.apply_fn(self._unflatten(flat[:n_grad_vals]))
+
+        losses = [float(l) for l in flat[n_grad_vals:]]
+        if len(losses) == 1:
+            return losses[0]
+        return losses
+
+
+def _data_parallel_worker(rank, n_workers, cores, barrier, shm_name,
+                          exp_class, data_params, arch_params, run_args,
+                          end_epoch, save_every_n_epochs, test_every_n_epochs):
+    from cnn_utils import experiment_engine
+
+    model_cores = cores[1:] if len(cores) > 1 else cores
+    experiment_engine.configure_cpus(model_cores=model_cores, loader_cores=cores[:1])
+
+    # different data order on each worker
+    np.random.seed((getattr(run_args, 'seed', None) or 17) + rank)
+
+    exp = exp_class(
+        data_params=data_params, arch_params=arch_params,
+        prompt_delete_existing=False, prompt_update_name=False,
+        do_logging=rank == 0)
+    exp.data_rank = rank
+    exp.data_world_size = n_workers
+
+    run_args = copy.copy(run_args)
+    run_args.rank = rank
+    run_args.allreducer = SharedMemoryAllReduce(rank, n_workers, barrier, shm_name)
+    try:
+        experiment_engine.run_experiment(
+            exp, run_args,
+            end_epoch=end_epoch,
+            save_every_n_epochs=save_every_n_epochs,
+            test_every_n_epochs=test_every_n_epochs)
+    finally:
+        run_args.allreducer.close()
+
+
+def run_data_parallel(exp_class, data_params, arch_params, run_args,
+                      end_epoch, save_every_n_epochs, test_every_n_epochs,
+                      n_workers=None):
+    '''
+    Trains an experiment with one worker per NUMA node (or n_workers workers). Blocks until training is done.
+    The experiment must shard its training data by self.data_rank and self.data_world_size.
+    '''
+    import multiprocessing
+
+    if n_workers is None:
+        n_workers = len(numa_nodes())
+    worker_cores = split_cores(n_workers)
+
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(n_workers)
+    shm_name = 'cnn_utils_allreduce_{}'.format(os.getpid())
+
+    workers = []
+    for rank in range(n_workers):
+        p = ctx.Process(
+            target=_data_parallel_worker,
+            args=(rank, n_workers, worker_cores[rank], barrier, shm_name,
+                  exp_class, data_params, arch_params, run_args,
+                  end_epoch, save_every_n_epochs, test_every_n_epochs),
+            name='data_parallel_worker_{}'.format(rank))
+        p.start()
+        workers.append(p)
+
+    # rank 0 decides when training is over (e.g. early stopping), so stop the rest when it exits
+    workers[0].join()
+    barrier.abort()
+    for p in workers[1:]:
+        p.join(timeout=60)
+        if p.is_alive():
+            p.terminate()
+    return workers[0].exitcode
+
+
+def _allreduce_test_worker(rank, n_workers, barrier, shm_name, result_queue):
+    allreducer = SharedMemoryAllReduce(rank, n_workers, barrier, shm_name, timeout=30)
+    try:
+        bcast = allreducer.broadcast(np.full(10, rank + 5., dtype=np.float32))
+        # like DataParallelTrainer, which broadcasts its weights and then reduces the gradients and the losses
+        means = [allreducer.allreduce_mean(np.full(10 + step, rank * (step + 1), dtype=np.float32))
+                 for step in range(3)]
+        result_queue.put((rank, bcast, means))
+    finally:
+        allreducer.close()
+
+
+def _test_shared_memory_allreduce():
+    import multiprocessing
+    n_workers = 2
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(n_workers)
+    result_queue = ctx.Queue()
+    shm_name = 'cnn_utils_allreduce_test_{}'.format(os.getpid())
+    workers = [ctx.Process(target=_allreduce_test_worker, args=(r, n_workers, barrier, shm_name, result_queue))
+               for r in range(n_workers)]
+    for p in workers:
+        p.start()
+    results = [result_queue.get(timeout=60) for _ in range(n_workers)]
+    for p in workers:
+        p.join()
+
+    for rank, bcast, means in results:
+        assert np.all(bcast == 5.)  # everyone gets rank 0's vector
+        for step, m in enumerate(means):
+            assert m.shape == (10 + step,)
+            assert np.allclose(m, np.mean([r * (step + 1) for r in range(n_workers)]))
+    print('SharedMemoryAllReduce test: PASSED')
+
+
+def _trainer_test_worker(rank, n_workers, barrier, shm_name, sync_every_n_steps, result_queue):
+    from keras.layers import Dense
+    from keras.models import Sequential
+
+    allreducer = SharedMemoryAllReduce(rank, n_workers, barrier, shm_name, timeout=60)
+    try:
+        model = Sequential([Dense(4, input_shape=(3,)), Dense(1)])
+        model.compile(optimizer='adam', loss='mse', metrics=['mae'])
+        trainer = DataParallelTrainer(model, allreducer, sync_every_n_steps=sync_every_n_steps)
+
+        # each worker trains on different data
+        np.random.seed(rank)
+        losses = [model.train_on_batch(np.random.rand(8, 3), np.random.rand(8, 1)) for _ in range(4)]
+        result_queue.put((rank, trainer._get_flat_weights(), losses))
+    finally:
+        allreducer.close()
+
+
+def _test_data_parallel_trainer():
+    import multiprocessing
+    try:
+        import keras
+    except ImportError:
+        print('DataParallelTrainer test: SKIPPED, keras is not installed')
+        return
+
+    n_workers = 2
+    ctx = multiprocessing.get_context('spawn')
+    for sync_every_n_steps in [1, 2]:
+        barrier = ctx.Barrier(n_workers)
+        result_queue = ctx.Queue()
+        shm_name = 'cnn_utils_trainer_test_{}_{}'.format(os.getpid(), sync_every_n_steps)
+        workers = [ctx.Process(target=_trainer_test_worker,
+                               args=(r, n_workers, barrier, shm_name, sync_every_n_steps, result_queue))
+                   for r in range(n_workers)]
+        for p in workers:
+            p.start()
+        results = sorted([result_queue.get(timeout=300) for _ in range(n_workers)], key=lambda r: r[0])
+        for p in workers:
+            p.join()
+
+        # the weights are averaged after the last of the 4 steps in both modes, so every worker ends up the same
+        assert np.allclose(results[0][1], results[1][1])
+        for _, _, losses in results:
+            assert len(losses) == 4 and all([np.all(np.isfinite(l)) for l in losses])
+        if sync_every_n_steps == 1:
+            # the losses are averaged along with the gradients
+            assert np.allclose(results[0][2], results[1][2])
+    print('DataParallelTrainer test: PASSED')
+
+
+if __name__ == '__main__':
+    _test_shared_memory_allreduce()
+    _test_data_parallel_trainer()
@@ -1,11 +1,13 @@
 import cv2
 
-from matplotlib import offsetbox
-import matplotlib.pyplot as plt
-import matplotlib.lines as lines
-
 import numpy as np
 
+from cnn_utils.lazy_utils import LazyModule, lazy_pyplot
+
+offsetbox = LazyModule('matplotlib.offsetbox')
+plt = lazy_pyplot()
+lines = LazyModule('matplotlib.lines')
+
 def visualize_embedding(embeddings, ims, labels,
                         title,
                         ax=None, x_lims=None, y_lims=None):
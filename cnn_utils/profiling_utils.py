@@ -0,0 +1,230 @@
+'''
+Sampled op-level profiling of tensorflow session runs.
+
+Instead of running every step with a FULL_TRACE, we trace one step every N steps, and aggregate the
+step_stats of the sampled steps into cost tables per op type and per layer. Layers are also grouped by
+the naming scheme used in basic_networks (e.g. unet_enc_conv2D_0_1 and unet_enc_conv2D_1_1 are both
+counted in unet_enc_conv2D_*), so that we can see which part of an architecture is expensive.
+'''
+import json
+import os
+import re
+
+import numpy as np
+
+
+def _op_type(node_stats):
+    # timeline labels look like "layer/op_name = OpType(input1, input2)"
+    m = re.search(r'=\s*([\w:]+)\(', node_stats.timeline_label)
+    if m is not None:
+        return m.group(1)
+    return node_stats.node_name.split(':')[0]
+
+
+def node_name_to_layer(node_name):
+    '''
+    Returns the keras layer that a tf node belongs to, and whether the node is part of the backward pass.
+    e.g. training/Adam/gradients/unet_enc_conv2D_0_1/convolution_grad/Conv2DBackpropInput
+        -> unet_enc_conv2D_0_1, True
+    '''
+    is_backward = False
+    if '/gradients/' in node_name or node_name.startswith('gradients/'):
+        is_backward = True
+        node_name = node_name.split('gradients/', 1)[1]
+    return node_name.split('/')[0].split(':')[0], is_backward
+
+
+def layer_to_group(layer_name):
+    # unet_enc_conv2D_0_1 -> unet_enc_conv2D_*, leaky_re_lu_12 -> leaky_re_lu_*
+    return re.sub(r'(_[0-9]+)+$', '_*', layer_name)
+
+
+class SampledOpProfiler(object):
+    def __init__(self, out_dir, sample_every_n_steps=100, max_merged_traces=10, skip_first_n_steps=2):
+        '''
+        :param out_dir: directory to write the report and merged traces to
+        :param sample_every_n_steps: trace one out of every this many steps
+        :param max_merged_traces: number of most recent sampled steps to keep in the merged chrome trace
+        :param skip_first_n_steps: the first few steps include graph optimizations and allocations, so
+            don't sample them
+        '''
+        import tensorflow as tf
+        self.out_dir = out_dir
+        self.sample_every_n_steps = sample_every_n_steps
+        self.max_merged_traces = max_merged_traces
+        self.skip_first_n_steps = skip_first_n_steps
+
+        # pass these to exp.compile_models. We toggle the trace level in place on sampled steps
+        self.run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
+        self.run_metadata = tf.RunMetadata()
+
+        self.watched_models = []
+        self.is_sampling = False
+        self.n_sampled_steps = 0
+
+        # each table maps a key to [total micros, total output bytes, number of nodes]
+        self.op_type_costs = {}
+        self.layer_costs = {}
+        self.layer_group_costs = {}
+
+        self.traces = []
+
+    def watch_models(self, models):
+        '''
+        Models whose compiled functions get the run options. Newer versions of keras bake the run options
+        into a session callable, so we need to reset those when we change the trace level.
+        '''
+        self.watched_models = [m for m in models if m is not None]
+
+    def _set_trace_level(self, trace_level):
+        if self.run_options.trace_level == trace_level:
+            return
+        self.run_options.trace_level = trace_level
+        for m in self.watched_models:
+            for fn_name in ['train_function', 'test_function', 'predict_function']:
+                fn = getattr(m, fn_name, None)
+                if fn is not None and hasattr(fn, '_callable_fn'):
+                    fn._callable_fn = None
+
+    def before_step(self, step):
+        import tensorflow as tf
+        self.is_sampling = step >= self.skip_first_n_steps and step % self.sample_every_n_steps == 0
+        if self.is_sampling:
+            self.run_metadata.Clear()
+            self._set_trace_level(tf.RunOptions.FULL_TRACE)
+
+    def collect(self, step, run_name=None):
+        '''
+        Aggregate the step_stats of the last session run. Call this after each session run within a
+        sampled step, since each run overwrites the run metadata.
+        '''
+        if not self.is_sampling or len(self.run_metadata.step_stats.dev_stats) == 0:
+            return
+
+        step_stats = self.run_metadata.step_stats
+        self._aggregate(step_stats)
+
+        from tensorflow.python.client import timeline
+        trace = json.loads(timeline.Timeline(step_stats=step_stats).generate_chrome_trace_format())
+        self.traces.append((step, run_name, trace['traceEvents']))
+        self.traces = self.traces[-self.max_merged_traces:]
+
+        self.run_metadata.Clear()
+
+    def after_step(self, step):
+        import tensorflow as tf
+        if self.is_sampling:
+            self.n_sampled_steps += 1
+            self._set_trace_level(tf.RunOptions.NO_TRACE)
+        self.is_sampling = False
+
+    def _aggregate(self, step_stats):
+        device_names = [d.device for d in step_stats.dev_stats]
+        # on gpus, kernels show up on the stream devices as well as the gpu device that launched them.
+        # count kernel times from stream:all only so that we don't double count
+        has_stream_all = np.any([d.endswith('/stream:all') for d in device_names])
+
+        for dev_stats in step_stats.dev_stats:
+            device = dev_stats.device
+            if '/stream:' in device and not device.endswith('/stream:all'):
+                continue
+            if 'memcpy' in device:
+                continue
+            if has_stream_all and 'GPU' in device.upper() and '/stream:' not in device:
+                continue
+
+            for ns in dev_stats.node_stats:
+                micros = ns.all_end_rel_micros
+                out_bytes = sum([o.tensor_description.allocation_description.requested_bytes for o in ns.output])
+
+                layer, is_backward = node_name_to_layer(ns.node_name)
+                direction = 'bwd' if is_backward else 'fwd'
+                for table, key in [
+                    (self.op_type_costs, _op_type(ns)),
+                    (self.layer_costs, (layer, direction)),
+                    (self.layer_group_costs, (layer_to_group(layer), direction)),
+                ]:
+                    if key not in table:
+                        table[key] = [0, 0, 0]
+                    table[key][0] += micros
+                    table[key][1] += out_bytes
+                    table[key][2] += 1
+
+    def _format_table(self, title, table, top_n):
+        total_micros = max(1, sum([c[0] for c in table.values()]))
+        lines = [title, '{:<60}{:>14}{:>8}{:>14}{:>10}'.format(
+            'name', 'ms/step', '%', 'MB/step', 'nodes')]
+        for key in sorted(table.keys(), key=lambda k: -table[k][0])[:top_n]:
+            micros, out_bytes, n_nodes = table[key]
+            name = key if isinstance(key, str) else '{} ({})'.format(*key)
+            lines.append('{:<60}{:>14.2f}{:>8.1f}{:>14.2f}{:>10}'.format(
+                name[:59],
+                micros / 1000. / max(1, self.n_sampled_steps),
+                100. * micros / total_micros,
+                out_bytes / 2. ** 20 / max(1, self.n_sampled_steps),
+                n_nodes // max(1, self.n_sampled_steps)))
+        return '\n'.join(lines)
+
+    def write_report(self, top_n=30):
+        if self.n_sampled_steps == 0:
+            return None
+
+        report = '\n\n'.join([
+            'Op costs averaged over {} sampled steps (1 in every {})'.format(
+                self.n_sampled_steps, self.sample_every_n_steps),
+            self._format_table('By op type', self.op_type_costs, top_n),
+            self._format_table('By layer group', self.layer_group_costs, top_n),
+            self._format_table('By layer', self.layer_costs, top_n),
+        ])
+
+        with open(os.path.join(self.out_dir, 'tf_op_profile.txt'), 'w') as f:
+            f.write(report)
+
+        with open(os.path.join(self.out_dir, 'tf_op_profile.json'), 'w') as f:
+            json.dump({
+                'n_sampled_steps': self.n_sampled_steps,
+                'op_types': {k: v for k, v in self.op_type_costs.items()},
+                'layers': {'{}/{}'.format(*k): v for k, v in self.layer_costs.items()},
+                'layer_groups': {'{}/{}'.format(*k): v for k, v in self.layer_group_costs.items()},
+            }, f, indent=2)
+
+        self._write_merged_trace()
+        return report
+
+    def _write_merged_trace(self):
+        # lay the sampled runs out one after another on a single timeline
+        merged_events = []
+        offset = 0
+        for step, run_name, events in self.traces:
+            timed_events = [ev for ev in events if 'ts' in ev]
+            if len(timed_events) == 0:
+                continue
+            start = min([ev['ts'] for ev in timed_events])
+            end = max([ev['ts'] + ev.get('dur', 0) for ev in timed_events])
+
+            for ev in events:
+                ev = dict(ev)
+                if 'ts' in ev:
+                    ev['ts'] = ev['ts'] - start + offset
+                ev.setdefault('args', {})
+                ev['args']['step'] = step
+                if run_name is not None:
+                    ev['args']['run'] = run_name
+                merged_events.append(ev)
+            offset += end - start + 1000  # leave a 1ms gap between runs
+
+        with open(os.path.join(self.out_dir, 'tf_timeline_merged.ctf.json'), 'w') as f:
+            json.dump({'traceEvents': merged_events}, f)
+
+
+def _test_node_name_to_layer():
+    assert node_name_to_layer('training/Adam/gradients/unet_enc_conv2D_0_1/convolution_grad/Conv2DBackpropInput') \
+        == ('unet_enc_conv2D_0_1', True)
+    assert node_name_to_layer('unet_enc_conv2D_0_1/convolution') == ('unet_enc_conv2D_0_1', False)
+    assert layer_to_group('unet_enc_conv2D_0_1') == 'unet_enc_conv2D_*'
+    assert layer_to_group('vte_enc_conv2D__last') == 'vte_enc_conv2D__last'
+    print('node_name_to_layer test: PASSED')
+
+
+if __name__ == '__main__':
+    _test_node_name_to_layer()
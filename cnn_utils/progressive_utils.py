@@ -0,0 +1,199 @@
+'''
+Progressive-resolution training: train the early epochs on downsampled batches, where each step is much cheaper,
+and switch to higher resolutions at configured epochs.
+
+    schedule = parse_resolution_schedule('0:0.25,10:0.5,30:1')
+
+trains at 1/4 resolution for epochs 0-9, 1/2 resolution for epochs 10-29, and full resolution after that.
+
+This only works for fully-convolutional models. resize_model calls the full resolution model on smaller inputs,
+so the low resolution model shares its weights and there is nothing to transfer when we switch back.
+
+The same goes for losses. Loss objects that are built for a fixed input shape (e.g. metrics.SoftSuperpixelLoss,
+or metrics.PatchLoss with sample_patches) set fixed_resolution = True. fixed_resolution_losses finds them, so that
+we can refuse to train at other resolutions instead of failing at the first switch.
+'''
+import numpy as np
+
+
+def parse_resolution_schedule(schedule_str):
+    '''
+    :param schedule_str: comma-separated list of start_epoch:scale, e.g. '0:0.25,10:0.5,30:1'
+    :return: list of (start_epoch, scale) sorted by epoch, or None if schedule_str is empty
+    '''
+    if not schedule_str:
+        return None
+
+    schedule = []
+    for s in schedule_str.split(','):
+        epoch, scale = s.split(':')
+        schedule.append((int(epoch), float(scale)))
+    return sorted(schedule)
+
+
+def scale_at_epoch(schedule, epoch):
+    # use full resolution before the first entry in the schedule
+    scale = 1.
+    for start_epoch, s in schedule:
+        if epoch >= start_epoch:
+            scale = s
+    return scale
+
+
+def scale_shape(shape, scale):
+    # scales the spatial dims of a channels-last shape, e.g. (h, w, c) or (h, w, d, c). Rounds down, like
+    # averaging blocks of voxels does. The epsilon keeps e.g. 100 * 0.29 from flooring to 28
+    return tuple([int(np.floor(d * scale + 1e-6)) if d is not None else None for d in shape[:-1]]) + (shape[-1],)
+
+
+def resize_image_batch(X, scale):
+    '''
+    Resizes a batch of images (n, h, w, c) with batch_utils.resize_batch, or a batch of volumes (n, h, w, d, c)
+    by averaging blocks of voxels, in which case 1 / scale must be an integer. The output has the spatial shape
+    given by scale_shape, the same as the inputs of resize_model.
+    '''
+    spatial = scale_shape(X.shape[1:], scale)[:-1]
+    if X.ndim == 4:
+        import cv2
+        from cnn_utils import batch_utils
+        # cv2 rounds the output size, so give it the exact factors that produce our size.
+        # Area interpolation doesn't alias when downsampling
+        h, w = X.shape[1:3]
+        return batch_utils.resize_batch(
+            X, (spatial[1] / float(w), spatial[0] / float(h)),
+            interp=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR).astype(X.dtype)
+
+    factor = int(round(1. / scale))
+    if not np.isclose(factor * scale, 1.):
+        raise ValueError('Can only downsample volumes by integer factors, got scale {}'.format(scale))
+    n, c = X.shape[0], X.shape[-1]
+    X = X[tuple([slice(None)] + [slice(0, d * factor) for d in spatial])]
+    blocks_shape = [n]
+    for d in spatial:
+        blocks_shape += [d, factor]
+    X = np.reshape(X, blocks_shape + [c])
+    return np.mean(X, axis=tuple(range(2, 2 * len(spatial) + 1, 2))).astype(X.dtype)
+
+
+class ImagePyramid(object):
+    def __init__(self, X, max_cached=4):
+        '''
+        Caches downsampled copies of a dataset, so that generators can draw low resolution batches without
+        resizing every batch.
+
+        :param X: array of images or volumes, e.g. exp.X_train
+        :param max_cached: max number of scales to keep
+        '''
+        self.X = X
+        self.max_cached = max_cached
+        self._levels = {}
+
+    def get(self, scale):
+        if scale == 1:
+            return self.X
+
+        if scale not in self._levels:
+            if len(self._levels) >= self.max_cached:
+                # schedules only go up in resolution, so the smallest scale is the one we won't need again
+                del self._levels[min(self._levels.keys())]
+
+            # resize in chunks so that we never convert the whole dataset to float at once
+            chunk_size = 256
+            self._levels[scale] = np.concatenate([
+                resize_image_batch(self.X[i:i + chunk_size], scale)
+                for i in range(0, self.X.shape[0], chunk_size)], axis=0)
+        return self._levels[scale]
+
+
+def gen_resized_batches(gen, scale, full_res_shape):
+    '''
+    Wraps a batch generator, resizing any images or volumes in each batch that are at full resolution.
+    Other outputs (e.g. class labels or transform params) are passed through as is.
+
+    :param full_res_shape: spatial shape of the full resolution inputs, e.g. (160, 192)
+    '''
+    full_res_shape = tuple(full_res_shape)
+    for batch in gen:
+        is_tuple = isinstance(batch, tuple)
+        if not is_tuple:
+            batch = (batch,)
+
+        batch = tuple([
+            resize_image_batch(x, scale)
+            if isinstance(x, np.ndarray) and x.ndim == len(full_res_shape) + 2 and x.shape[1:-1] == full_res_shape
+            else x for x in batch])
+        yield batch if is_tuple else batch[0]
+
+
+def resize_model(model, scale, name=None):
+    '''
+    Calls a fully-convolutional model on inputs whose spatial dims are scaled by scale. The returned model shares
+    all of its weights with model. Inputs with no spatial dims (e.g. transform params) keep their shape.
+
+    :return: an uncompiled model
+    '''
+    from keras.layers import Input
+    from keras.models import Model
+    import keras.backend as K
+
+    new_inputs = []
+    for x in model.inputs:
+        shape = K.int_shape(x)[1:]
+        if len(shape) >= 3:
+            shape = scale_shape(shape, scale)
+        new_inputs.append(Input(shape, dtype=K.dtype(x)))
+
+    try:
+        outputs = model(new_inputs if len(new_inputs) > 1 else new_inputs[0])
+    except Exception as e:
+        raise ValueError('Could not resize {}, is it fully convolutional? {}'.format(model.name, e))
+
+    if name is None:
+        name = '{}_scale{}'.format(model.name, int(round(scale * 100)))
+    return Model(inputs=new_inputs, outputs=outputs, name=name)
+
+
+def _loss_objects(loss):
+    # the objects behind a model's loss functions (e.g. metrics.PatchLoss for PatchLoss().compute_loss), including
+    # the ones wrapped by other losses (e.g. metrics.SummedLosses)
+    if isinstance(loss, dict):
+        loss = list(loss.values())
+    if isinstance(loss, (list, tuple)):
+        return [o for l in loss for o in _loss_objects(l)]
+
+    obj = getattr(loss, '__self__', None)
+    if obj is None:
+        return []
+    objs = [obj]
+    for wrapped in list(getattr(obj, 'loss_fns', None) or []) + [getattr(obj, 'loss_fn', None)]:
+        if wrapped is not None:
+            objs += _loss_objects(wrapped)
+    return objs
+
+
+def fixed_resolution_losses(model):
+    '''
+    :return: list of the loss objects of a compiled model that can only be used at the resolution that they were
+        built for, i.e. that set fixed_resolution
+    '''
+    return [o for o in _loss_objects(getattr(model, 'loss', None)) if getattr(o, 'fixed_resolution', False)]
+
+
+def compile_like(new_model, model):
+    '''
+    Compiles new_model with the same losses and loss weights as model, and a new optimizer with the same config
+    as model's. Keras optimizers replace their slots (e.g. Adam moments) whenever they build updates for a model,
+    so sharing model's optimizer would clobber the slots that model trains and saves with. The new optimizer's
+    slots start over.
+    '''
+    loss = model.loss
+    loss_weights = model.loss_weights
+    # resize_model's outputs have different names, so match up dicts by output order instead
+    if isinstance(loss, dict):
+        loss = [loss.get(n) for n in model.output_names]
+    if isinstance(loss_weights, dict):
+        loss_weights = [loss_weights.get(n, 1.) for n in model.output_names]
+    optimizer = model.optimizer.__class__.from_config(model.optimizer.get_config())
+    new_model.compile(optimizer=optimizer, loss=loss, loss_weights=loss_weights,
+                      **getattr(model, '_function_kwargs', {}))
+    return new_model
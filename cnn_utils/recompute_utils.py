@@ -0,0 +1,192 @@
+'''
+Gradient checkpointing: trade extra compute for activation memory by only keeping some activations from the forward
+pass, and recomputing the rest during backprop.
+
+Builders in basic_networks mark the output of each stage with a RecomputeCheckpoint layer when called with
+checkpoint_stages=True. use_recompute_gradients(model) then makes model's optimizer compute gradients segment by
+segment: the activations inside a stage are recomputed from the checkpoint before it, instead of being kept
+around from the forward pass. This typically costs about one extra forward pass (~30% more compute per step).
+
+Based on the approach of Chen et al. (2016), Training Deep Nets with Sublinear Memory Cost, and uses
+tf.contrib.graph_editor to copy the forward ops of each segment.
+'''
+import numpy as np
+import tensorflow as tf
+from keras.layers import Layer
+import keras.backend as K
+
+CHECKPOINTS_COLLECTION = 'recompute_checkpoints'
+
+
+class RecomputeCheckpoint(Layer):
+    '''
+    Identity layer that marks its output as a checkpoint. The output is added to CHECKPOINTS_COLLECTION every time
+    the layer is called, including when its model is called on new inputs (e.g. inside a trainer model).
+    '''
+    def call(self, x):
+        y = tf.identity(x)
+        tf.add_to_collection(CHECKPOINTS_COLLECTION, y)
+        return y
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
+def checkpoint(x, name=None):
+    return RecomputeCheckpoint(name=name)(x)
+
+
+def _backward_ops(seed_ops, stop_at_ts, within_ops):
+    # ops that seed_ops depend on, without going past stop_at_ts. Stateful ops (e.g. the random ops in dropout)
+    # would give different outputs if we ran them again, so we leave them out and the copies keep using their
+    # outputs from the forward pass
+    from tensorflow.contrib import graph_editor as ge
+    ops = ge.get_backward_walk_ops(seed_ops, stop_at_ts=stop_at_ts, inclusive=True)
+    return [op for op in ops if op in within_ops and not op.op_def.is_stateful]
+
+
+def recompute_gradients(ys, xs, checkpoints=None, grad_ys=None):
+    '''
+    Drop-in for tf.gradients that only keeps the checkpoint tensors from the forward pass.
+
+    :param checkpoints: tensors to keep. Defaults to everything in CHECKPOINTS_COLLECTION that lies between
+        xs and ys. If there are none, this is just tf.gradients
+    '''
+    from tensorflow.contrib import graph_editor as ge
+
+    if not isinstance(ys, list):
+        ys = [ys]
+    if not isinstance(xs, list):
+        xs = [xs]
+
+    # ops on the path from xs to ys. Leave out ops without inputs (e.g. the variables themselves), since
+    # copying those would make new variables
+    bwd_ops = ge.get_backward_walk_ops([y.op for y in ys], inclusive=True)
+    fwd_ops = set([op for op in ge.get_forward_walk_ops([x.op for x in xs], inclusive=True, within_ops=bwd_ops)
+                   if len(op.inputs) > 0])
+
+    if checkpoints is None:
+        checkpoints = tf.get_collection(CHECKPOINTS_COLLECTION)
+    checkpoints = [c for c in checkpoints if c.op in fwd_ops and c not in ys]
+    if len(checkpoints) == 0:
+        return tf.gradients(ys, xs, grad_ys=grad_ys)
+
+    # the graph only lets ops take inputs from ops that already exist, so creation order is a topological order
+    op_order = {op: i for i, op in enumerate(tf.get_default_graph().get_operations())}
+    checkpoints = sorted(checkpoints, key=lambda c: op_order[c.op])
+
+    # copies of the checkpoints that gradients won't flow through, so that each segment stops at them
+    disconnected = {c: tf.stop_gradient(c) for c in checkpoints}
+
+    # last segment: from the checkpoints to ys
+    ops_to_copy = _backward_ops([y.op for y in ys], stop_at_ts=checkpoints, within_ops=fwd_ops)
+    _, info = ge.copy_with_input_replacements(ge.sgv(ops_to_copy), {})
+    ge.reroute_ts(list(disconnected.values()), list(disconnected.keys()), can_modify=info.transformed(ops_to_copy))
+    copied_ys = [info.transformed(y.op).outputs[y.value_index] for y in ys]
+    dv = tf.gradients(copied_ys, [disconnected[c] for c in checkpoints] + xs, grad_ys=grad_ys)
+    d_checkpoints = dict(zip(checkpoints, dv[:len(checkpoints)]))
+    d_xs = dv[len(checkpoints):]
+
+    # walk back through the checkpoints, recomputing the segment that ends at each one
+    for ci in reversed(range(len(checkpoints))):
+        c = checkpoints[ci]
+        if d_checkpoints[c] is None:
+            continue
+        other = checkpoints[:ci]
+        ops_to_copy = _backward_ops([c.op], stop_at_ts=other, within_ops=fwd_ops)
+        if len(ops_to_copy) == 0:
+            continue
+
+        _, info = ge.copy_with_input_replacements(ge.sgv(ops_to_copy), {})
+        copied_ops = info.transformed(ops_to_copy)
+        ge.reroute_ts([disconnected[o] for o in other], other, can_modify=copied_ops)
+        copied_c = info.transformed(c.op).outputs[c.value_index]
+
+        # only recompute the segment once backprop has reached it. Otherwise tf might schedule all of the
+        # recomputation up front, and we would be back to keeping every activation around
+        for op in copied_ops:
+            ge.add_control_inputs(op, [d_checkpoints[c].op])
+        dv = tf.gradients([copied_c], [disconnected[o] for o in other] + xs, grad_ys=[d_checkpoints[c]])
+
+        for o, d in zip(other, dv[:len(other)]):
+            if d is not None:
+                d_checkpoints[o] = d if d_checkpoints[o] is None else d_checkpoints[o] + d
+        d_xs = [d if dx is None else (dx if d is None else dx + d) for dx, d in zip(d_xs, dv[len(other):])]
+    return d_xs
+
+
+def use_recompute_gradients(model, checkpoints=None):
+    '''
+    Makes model's optimizer compute gradients with recompute_gradients. Call this after compiling the model,
+    before it trains (and before wrapping it in e.g. grad_accum_utils.GradientAccumulator).
+    '''
+    from keras import optimizers
+
+    optimizer = model.optimizer
+
+    def get_gradients(loss, params):
+        grads = recompute_gradients([loss], params, checkpoints=checkpoints)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. Please make sure that all of your ops have a '
+                             'gradient defined (i.e. are differentiable).')
+        # the same clipping as keras.optimizers.Optimizer.get_gradients
+        if getattr(optimizer, 'clipnorm', 0) > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [optimizers.clip_norm(g, optimizer.clipnorm, norm) for g in grads]
+        if getattr(optimizer, 'clipvalue', 0) > 0:
+            grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) for g in grads]
+        return grads
+
+    optimizer.get_gradients = get_gradients
+    return model
+
+
+def _flatten_layers(model):
+    layers = []
+    for l in model.layers:
+        if hasattr(l, 'layers'):
+            layers += _flatten_layers(l)
+        else:
+            layers.append(l)
+    return layers
+
+
+def estimate_activation_memory(model, batch_size=1, bytes_per_value=4):
+    '''
+    Rough estimate of the activation memory needed for backprop, with and without recomputation.
+    Without recomputation, we keep the output of every layer. With it, we keep the checkpoints, plus
+    the activations of the largest segment while we recompute it.
+
+    :return: dict of bytes: 'full', 'recompute', and the number of checkpoints
+    '''
+    def _n_bytes(layer):
+        shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        return sum([int(np.prod([d for d in s[1:] if d is not None])) for s in shapes]) \
+            * batch_size * bytes_per_value
+
+    total = 0
+    checkpoint_bytes = 0
+    segment_bytes = 0
+    max_segment_bytes = 0
+    n_checkpoints = 0
+    for l in _flatten_layers(model):
+        n_bytes = _n_bytes(l)
+        total += n_bytes
+        if isinstance(l, RecomputeCheckpoint):
+            checkpoint_bytes += n_bytes
+            n_checkpoints += 1
+            max_segment_bytes = max(max_segment_bytes, segment_bytes)
+            segment_bytes = 0
+        else:
+            segment_bytes += n_bytes
+    max_segment_bytes = max(max_segment_bytes, segment_bytes)
+
+    return {
+        'full': total,
+        'recompute': checkpoint_bytes + max_segment_bytes if n_checkpoints > 0 else total,
+        'n_checkpoints': n_checkpoints,
+    }
+
+
+def has_checkpoints(model):
+    return any([isinstance(l, RecomputeCheckpoint) for l in _flatten_layers(model)])
@@ -0,0 +1,164 @@
+'''
+Snapshots of the full training state, so that a preempted run can pick up exactly where it left off.
+
+load_models only restores model weights. A snapshot also holds the optimizer slots, the numpy and python RNG
+states, the position of each batch generator (see batch_utils.gen_batch's state argument), the epoch/batch
+counters and any trainer or callback counters. Snapshots are written atomically, so a run that is killed while
+writing one still has the previous one.
+
+Ops with tf-level random seeds (e.g. dropout, or sampling inside a model) are not restored, so resuming is only
+bit-for-bit for models that don't draw random numbers in the graph.
+'''
+import os
+import pickle
+import random
+import time
+
+import numpy as np
+
+STATE_FILE = 'training_state.pkl'
+
+
+def get_rng_states():
+    return {'numpy': np.random.get_state(), 'python': random.getstate()}
+
+
+def set_rng_states(rng_states):
+    np.random.set_state(rng_states['numpy'])
+    random.setstate(rng_states['python'])
+
+
+def get_compiled_models(exp):
+    # any model that the experiment holds on to, and which has been compiled with an optimizer
+    models = [m for m in list(vars(exp).values()) + list(getattr(exp, 'models', []))
+              if getattr(m, 'optimizer', None) is not None and hasattr(m, 'train_function')]
+    unique_models = []
+    for m in models:
+        if not any([m is um for um in unique_models]):
+            unique_models.append(m)
+    return unique_models
+
+
+def get_counters(obj):
+    # int/float attributes, e.g. the epoch_count and iter_count of our callbacks
+    return {k: v for k, v in vars(obj).items()
+            if isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool)}
+
+
+def set_counters(obj, counters):
+    for k, v in counters.items():
+        setattr(obj, k, v)
+
+
+class TrainingStateSnapshotter(object):
+    def __init__(self, exp, out_dir=None, save_every_n_seconds=300.):
+        self.exp = exp
+        self.out_dir = out_dir if out_dir is not None else exp.exp_dir
+        self.save_every_n_seconds = save_every_n_seconds
+        self.last_save_time = time.time()
+
+    @property
+    def state_file(self):
+        return os.path.join(self.out_dir, STATE_FILE)
+
+    def _get_model_states(self):
+        import keras.backend as K
+
+        # models can share layers (e.g. a trainer model wraps the models that we save), so collect weights by name
+        weights = {}
+        for m in list(getattr(self.exp, 'models', [])) + get_compiled_models(self.exp):
+            for w in m.weights:
+                weights[w.name] = w
+        weight_names = sorted(weights.keys())
+
+        optimizer_weights = {}
+        for m in get_compiled_models(self.exp):
+            # optimizer weights (including the iteration count) only exist once the train function has been built
+            if len(m.optimizer.weights) > 0:
+                optimizer_weights[m.name] = m.optimizer.weights
+
+        # fetch everything in one session run
+        values = K.batch_get_value([weights[n] for n in weight_names]
+                                   + [w for ow in optimizer_weights.values() for w in ow])
+        model_weights = dict(zip(weight_names, values[:len(weight_names)]))
+        values = values[len(weight_names):]
+
+        optimizer_values = {}
+        for model_name, ow in optimizer_weights.items():
+            optimizer_values[model_name] = values[:len(ow)]
+            values = values[len(ow):]
+        return model_weights, optimizer_values
+
+    def save(self, trainer_state=None, callbacks=None):
+        '''
+        :param trainer_state: dict of the trainer's own counters, e.g. epoch, next batch, adaptive intervals
+        :param callbacks: list of callbacks whose counters we should save
+        '''
+        model_weights, optimizer_values = self._get_model_states()
+        state = {
+            'time': time.time(),
+            'trainer': trainer_state if trainer_state is not None else {},
+            'rng': get_rng_states(),
+            'data': self.exp.get_data_state(),
+            'model_weights': model_weights,
+            'optimizer_weights': optimizer_values,
+            'callbacks': [get_counters(c) for c in callbacks] if callbacks is not None else None,
+        }
+
+        # write to a temp file first so that we never leave a partial snapshot behind
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.state_file)
+        self.last_save_time = time.time()
+
+    def maybe_save(self, trainer_state=None, callbacks=None):
+        if self.save_every_n_seconds is not None and time.time() - self.last_save_time >= self.save_every_n_seconds:
+            self.save(trainer_state, callbacks)
+            return True
+        return False
+
+    def load(self):
+        if not os.path.isfile(self.state_file):
+            return None
+        with open(self.state_file, 'rb') as f:
+            return pickle.load(f)
+
+    def restore(self, state=None, callbacks=None):
+        '''
+        Restores a snapshot into the experiment. Call this after the models are compiled and the generators
+        are created, right before training.
+        :return: the trainer state dict that was saved, or None if there is no snapshot
+        '''
+        import keras.backend as K
+
+        if state is None:
+            state = self.load()
+        if state is None:
+            return None
+
+        weight_value_pairs = []
+        all_models = list(getattr(self.exp, 'models', [])) + get_compiled_models(self.exp)
+        for m in all_models:
+            for w in m.weights:
+                if w.name in state['model_weights']:
+                    weight_value_pairs.append((w, state['model_weights'][w.name]))
+
+        for m in get_compiled_models(self.exp):
+            if m.name not in state['optimizer_weights']:
+                continue
+            if len(m.optimizer.weights) == 0 and hasattr(m, '_make_train_function'):
+                # build the optimizer's slots so that we have somewhere to put the saved values
+                m._make_train_function()
+            weight_value_pairs += list(zip(m.optimizer.weights, state['optimizer_weights'][m.name]))
+        K.batch_set_value(weight_value_pairs)
+
+        self.exp.set_data_state(state['data'])
+        set_rng_states(state['rng'])
+
+        if callbacks is not None and state['callbacks'] is not None:
+            for c, counters in zip(callbacks, state['callbacks']):
+                set_counters(c, counters)
+
+        self.last_save_time = time.time()
+        return state['trainer']
@@ -0,0 +1,374 @@
+'''
+Runs a sweep of experiments concurrently on one machine.
+
+Each job is estimated to need some number of cores and some amount of memory, and jobs are packed into the
+machine so that neither is oversubscribed. Each job runs in its own process, pinned to its own cores with
+tf thread pools sized to match (see experiment_engine.configure_cpus). Jobs that crash are restarted from their
+latest checkpoint.
+
+SuccessiveHalvingRunner stops most jobs early: every job is trained for a small number of epochs, and only the
+best jobs are resumed from their checkpoints for longer.
+
+Jobs can share read-only data (e.g. a preprocessed dataset) through load_shared_array, which caches arrays in
+run_args.data_cache_dir and memory maps them, so that all jobs share the same pages.
+'''
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import numpy as np
+
+
+def load_shared_array(cache_dir, key, make_fn):
+    '''
+    Loads an array from the shared cache, or computes it with make_fn and caches it if no other job has yet.
+    The returned array is a read-only memory map.
+    '''
+    if cache_dir is None:
+        return make_fn()
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, '{}.npy'.format(key))
+    lock_file = cache_file + '.lock'
+
+    while not os.path.isfile(cache_file):
+        try:
+            # only one job computes each array, the others wait for it
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            time.sleep(1.)
+            continue
+
+        try:
+            tmp_file = cache_file + '.tmp.npy'
+            np.save(tmp_file, make_fn())
+            os.replace(tmp_file, cache_file)  # so that other jobs never see a partial file
+        finally:
+            os.close(fd)
+            os.remove(lock_file)
+    return np.load(cache_file, mmap_mode='r')
+
+
+def available_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2. ** 30
+    except (ValueError, OSError, AttributeError):
+        return 16.
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class SweepJob(object):
+    def __init__(self, exp_class, data_params, arch_params, run_args,
+                 end_epoch, save_every_n_epochs=10, test_every_n_epochs=10,
+                 n_cores=None, mem_gb=None, job_id=None):
+        '''
+        :param exp_class, data_params, arch_params: used to construct the experiment
+        :param run_args: argparse namespace for experiment_engine.run_experiment
+        :param n_cores: number of cores to reserve. Estimated from run_args if not specified
+        :param mem_gb: memory to reserve. Estimated from the params if not specified
+        '''
+        self.exp_class = exp_class
+        self.data_params = data_params
+        self.arch_params = arch_params
+        self.run_args = run_args
+        self.end_epoch = end_epoch
+        self.save_every_n_epochs = save_every_n_epochs
+        self.test_every_n_epochs = test_every_n_epochs
+        self.job_id = job_id
+
+        if n_cores is None:
+            # one core for the data pipeline, and the rest for tf
+            intra_op_threads = getattr(run_args, 'intra_op_threads', None) or 2
+            n_cores = intra_op_threads + 1
+        self.n_cores = n_cores
+
+        if mem_gb is None:
+            mem_gb = self._estimate_mem_gb()
+        self.mem_gb = mem_gb
+
+        # filled in by the runner
+        self.exp_dir = None
+        self.n_attempts = 0
+
+    def _estimate_mem_gb(self):
+        # a rough guess: a fixed overhead for tf and the dataset, plus activations that scale with the batch
+        img_shape = self.arch_params.get('img_shape', self.data_params.get('img_shape', None)) \
+            if isinstance(self.arch_params, dict) and isinstance(self.data_params, dict) else None
+        if img_shape is None:
+            return 4.
+        batch_size = getattr(self.run_args, 'batch_size', None) or 8
+        n_bytes_per_example = np.prod(img_shape) * 4
+        return 3. + batch_size * n_bytes_per_example * 500 / 2. ** 30  # assume ~500 feature maps worth of activations
+
+
+def _run_sweep_job(job, cores, result_queue, resume_from=None):
+    from cnn_utils import experiment_engine
+
+    # leave one core for the data pipeline if we can
+    model_cores = cores[1:] if len(cores) > 1 else cores
+    experiment_engine.configure_cpus(model_cores=model_cores, loader_cores=cores[:1])
+
+    run_args = copy.copy(job.run_args)
+    if resume_from is not None:
+        exp, _ = experiment_engine.load_experiment_from_dir(
+            resume_from, job.exp_class,
+            do_logging=True, prompt_update_name=False, verbose=False,
+            do_load_models=False, do_load_data=False)
+        run_args.epoch = 'latest'
+        run_args.resume_state = True  # also restore the optimizer, rngs and data order if we have a snapshot
+    else:
+        exp = job.exp_class(
+            data_params=job.data_params, arch_params=job.arch_params,
+            prompt_delete_existing=False, prompt_update_name=False)
+    result_queue.put((job.job_id, 'started', exp.exp_dir))
+
+    experiment_engine.run_experiment(
+        exp, run_args,
+        end_epoch=job.end_epoch,
+        save_every_n_epochs=job.save_every_n_epochs,
+        test_every_n_epochs=job.test_every_n_epochs)
+
+    test_loss, test_loss_names = exp.test_joint()
+    if not isinstance(test_loss, list):
+        test_loss = [test_loss]
+    result = {'loss_names': list(test_loss_names), 'losses': [float(l) for l in test_loss]}
+    with open(os.path.join(exp.exp_dir, 'sweep_result.json'), 'w') as f:
+        json.dump(result, f)
+    result_queue.put((job.job_id, 'done', result))
+
+
+class SweepRunner(object):
+    def __init__(self, jobs, cores=None, total_mem_gb=None, max_retries=2, data_cache_dir=None,
+                 poll_every_n_seconds=5., logger=None):
+        '''
+        :param jobs: list of SweepJobs
+        :param cores: cores that the sweep may use. Defaults to all available cores
+        :param total_mem_gb: memory that the sweep may use. Defaults to 90% of physical memory
+        :param max_retries: number of times to restart a crashed job from its latest checkpoint
+        :param data_cache_dir: shared read-only data cache, passed to each job as run_args.data_cache_dir
+        '''
+        self.cores = cores if cores is not None else available_cores()
+        self.total_mem_gb = total_mem_gb if total_mem_gb is not None else 0.9 * available_memory_gb()
+        self.max_retries = max_retries
+        self.data_cache_dir = data_cache_dir
+        self.poll_every_n_seconds = poll_every_n_seconds
+
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            if len(logger.handlers) == 0:
+                logger.addHandler(logging.StreamHandler(sys.stdout))
+                logger.setLevel(logging.DEBUG)
+        self.logger = logger
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._results = self._ctx.Queue()
+
+        self.pending = []
+        self.running = {}  # job_id -> (job, process, cores)
+        self.results = {}  # job_id -> result dict, or None if the job failed
+        self.n_jobs_started = 0
+        self._next_job_id = 0
+        for job in jobs:
+            self.add_job(job)
+
+    def add_job(self, job, front=False):
+        if job.job_id is None:
+            job.job_id = self._next_job_id
+            self._next_job_id += 1
+        if job.n_cores > len(self.cores) or job.mem_gb > self.total_mem_gb:
+            raise ValueError('Job {} needs {} cores and {:.1f}GB, but the sweep only has {} cores and {:.1f}GB'.format(
+                job.job_id, job.n_cores, job.mem_gb, len(self.cores), self.total_mem_gb))
+
+        if self.data_cache_dir is not None:
+            job.run_args = copy.copy(job.run_args)
+            job.run_args.data_cache_dir = self.data_cache_dir
+
+        if front:
+            self.pending.insert(0, job)
+        else:
+            self.pending.append(job)
+
+    def _free_resources(self):
+        used_cores = set([c for _, _, cores in self.running.values() for c in cores])
+        free_cores = [c for c in self.cores if c not in used_cores]
+        free_mem_gb = self.total_mem_gb - sum([job.mem_gb for job, _, _ in self.running.values()])
+        return free_cores, free_mem_gb
+
+    def _launch_jobs(self):
+        free_cores, free_mem_gb = self._free_resources()
+        # first fit, in order of priority
+        for job in list(self.pending):
+            if job.n_cores > len(free_cores) or job.mem_gb > free_mem_gb:
+                continue
+
+            job_cores = free_cores[:job.n_cores]
+            free_cores = free_cores[job.n_cores:]
+            free_mem_gb -= job.mem_gb
+
+            resume_from = job.exp_dir if job.exp_dir is not None and os.path.isdir(job.exp_dir) else None
+            p = self._ctx.Process(
+                target=_run_sweep_job, args=(job, job_cores, self._results),
+                kwargs={'resume_from': resume_from},
+                name='sweep_job_{}'.format(job.job_id))
+            p.start()
+
+            job.n_attempts += 1
+            self.n_jobs_started += 1
+            self.results.pop(job.job_id, None)
+            self.pending.remove(job)
+            self.running[job.job_id] = (job, p, job_cores)
+            self.logger.debug('Started job {} on cores {} ({}){}'.format(
+                job.job_id, job_cores, job.exp_class.__name__,
+                ', resuming from {}'.format(resume_from) if resume_from else ''))
+
+    def _read_results(self):
+        while True:
+            try:
+                job_id, status, info = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if job_id not in self.running:
+                continue
+            job = self.running[job_id][0]
+            if status == 'started':
+                job.exp_dir = info
+            elif status == 'done':
+                self.results[job_id] = info
+
+    def _reap_jobs(self):
+        finished_job_ids = [job_id for job_id, (_, p, _) in self.running.items() if not p.is_alive()]
+        # read results after checking for finished processes, so that we don't miss their last messages
+        self._read_results()
+
+        for job_id in finished_job_ids:
+            job, p, _ = self.running.pop(job_id)
+            p.join()
+
+            if p.exitcode != 0 and job.n_attempts <= self.max_retries:
+                self.logger.debug('Job {} exited with code {}, restarting from its latest checkpoint'.format(
+                    job_id, p.exitcode))
+                self.add_job(job, front=True)
+                continue
+            elif p.exitcode != 0:
+                self.logger.debug('Job {} failed {} times, giving up'.format(job_id, job.n_attempts))
+                self.results[job_id] = None
+            elif job_id not in self.results:
+                # exited early without reporting test losses, e.g. from early stopping
+                self.results[job_id] = {}
+            self.on_job_done(job, self.results[job_id])
+
+    def on_job_done(self, job, result):
+        self.logger.debug('Job {} done: {}'.format(job.job_id, result))
+
+    def run(self):
+        while len(self.pending) > 0 or len(self.running) > 0:
+            self._reap_jobs()
+            self._launch_jobs()
+            time.sleep(self.poll_every_n_seconds)
+        return self.results
+
+
+class SuccessiveHalvingRunner(SweepRunner):
+    def __init__(self, jobs, min_epochs, max_epochs, eta=3, metric_name=None,
+                 ledger_file='sweep_ledger.jsonl', **kwargs):
+        '''
+        Asynchronous successive halving (ASHA). Each job is trained for min_epochs. Whenever a job finishes
+        a rung, the top 1/eta of the jobs that have finished that rung so far are resumed from their
+        checkpoints and trained for eta times as many epochs, up to max_epochs. The rest are parked,
+        i.e. their checkpoints are kept but they are not trained any further.
+
+        :param metric_name: name of the test loss to compare jobs on (lower is better). Defaults to the first
+        :param ledger_file: every promotion and parking decision is appended here
+        '''
+        self.eta = eta
+        self.metric_name = metric_name
+        self.ledger_file = ledger_file
+
+        self.budgets = []
+        budget = min_epochs
+        while budget < max_epochs:
+            self.budgets.append(budget)
+            budget *= eta
+        self.budgets.append(max_epochs)
+
+        # for each rung, job_id -> metric of each job that has finished that rung
+        self.rung_metrics = [{} for _ in self.budgets]
+        self.promoted = [set() for _ in self.budgets]
+        self.jobs_by_id = {}
+
+        for job in jobs:
+            job.rung = 0
+            job.end_epoch = self.budgets[0]
+        super(SuccessiveHalvingRunner, self).__init__(jobs, **kwargs)
+        for job in self.pending:
+            self.jobs_by_id[job.job_id] = job
+
+    def _get_metric(self, result):
+        if not result:  # failed, or stopped early without reporting losses
+            return None
+        if self.metric_name is None:
+            metric = result['losses'][0]
+        elif self.metric_name in result['loss_names']:
+            metric = result['losses'][result['loss_names'].index(self.metric_name)]
+        else:
+            return None
+        return None if np.isnan(metric) else metric
+
+    def _log_decision(self, job, decision, metric=None):
+        entry = {
+            'time': time.time(),
+            'job_id': job.job_id,
+            'exp_dir': job.exp_dir,
+            'rung': job.rung,
+            'epochs': self.budgets[job.rung],
+            'metric': metric,
+            'decision': decision,
+        }
+        self.logger.debug('Job {} rung {} ({} epochs): {} (metric {})'.format(
+            job.job_id, job.rung, self.budgets[job.rung], decision, metric))
+        with open(self.ledger_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def on_job_done(self, job, result):
+        metric = self._get_metric(result)
+        self.rung_metrics[job.rung][job.job_id] = metric
+        self._log_decision(job, 'finished', metric)
+        self._promote_jobs()
+
+    def _promote_jobs(self):
+        # check the highest rungs first, so that the most promising jobs get resources first
+        for rung in reversed(range(len(self.budgets) - 1)):
+            finished = sorted([(m, job_id) for job_id, m in self.rung_metrics[rung].items() if m is not None])
+            n_promote = len(finished) // self.eta
+            for metric, job_id in finished[:n_promote]:
+                if job_id in self.promoted[rung]:
+                    continue
+                self.promoted[rung].add(job_id)
+
+                job = self.jobs_by_id[job_id]
+                self._log_decision(job, 'promoted', metric)
+                job.rung = rung + 1
+                job.end_epoch = self.budgets[job.rung]
+                job.n_attempts = 0
+                self.add_job(job, front=True)  # resumes from job.exp_dir
+
+    def run(self):
+        results = super(SuccessiveHalvingRunner, self).run()
+
+        # anything that finished a rung without being promoted stays parked
+        for rung in range(len(self.budgets) - 1):
+            for job_id, metric in self.rung_metrics[rung].items():
+                if job_id not in self.promoted[rung]:
+                    self._log_decision(self.jobs_by_id[job_id], 'parked', metric)
+        return results
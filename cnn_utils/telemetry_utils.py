@@ -0,0 +1,241 @@
+'''
+Buffered sink for scalar training telemetry (losses, timings).
+
+Scalars are recorded into preallocated numpy arrays and written to tensorboard in batches
+from a background thread, either when the buffer fills up or every flush_every_n_seconds.
+Progress bar redraws are throttled so that per-batch logging is cheap.
+'''
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def flush_logger(logger):
+    # flush all handlers of a python logger to disk, without closing and reopening the files
+    if logger is None:
+        return
+    for h in logger.handlers:
+        h.flush()
+
+
+class ScalarTelemetry(object):
+    def __init__(self, tensorboard_writer=None,
+                 capacity=1024, max_n_tags=32,
+                 flush_every_n_seconds=10.,
+                 progbar_max_hz=4.,
+                 ):
+        '''
+        :param tensorboard_writer: tf.summary.FileWriter to write scalars to, or None
+        :param capacity: number of steps to buffer before forcing a write
+        :param max_n_tags: initial number of distinct scalar names to allocate space for.
+            The buffer grows if more names are logged.
+        :param flush_every_n_seconds: write buffered scalars at least this often
+        :param progbar_max_hz: max number of progress bar redraws per second
+        '''
+        self.tbw = tensorboard_writer
+        self.capacity = capacity
+        self.flush_every_n_seconds = flush_every_n_seconds
+        self.progbar_min_interval = 1. / progbar_max_hz if progbar_max_hz else 0.
+
+        self._lock = threading.Lock()
+        self._tag_idxs = {}
+        self._tags = []
+        self._steps = np.zeros(capacity, dtype=np.int64)
+        self._vals = np.full((capacity, max_n_tags), np.nan, dtype=np.float32)
+        self._n = 0
+
+        # progress bar state, keyed by the progress bar we are currently drawing
+        self._progbar = None
+        self._progbar_sums = {}
+        self._progbar_n_pending = 0
+        self._progbar_last_draw = 0.
+
+        self._chunks = queue.Queue()
+        self._stop = threading.Event()
+        self._writer_thread = None
+        if self.tbw is not None:
+            self._writer_thread = threading.Thread(target=self._writer_loop, name='telemetry_writer')
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
+    def _get_tag_idx(self, tag):
+        ti = self._tag_idxs.get(tag)
+        if ti is None:
+            ti = len(self._tags)
+            if ti >= self._vals.shape[1]:
+                # grow the buffer to fit more tags. this should only happen a few times per run
+                self._vals = np.concatenate([
+                    self._vals, np.full(self._vals.shape, np.nan, dtype=np.float32)], axis=1)
+            self._tag_idxs[tag] = ti
+            self._tags.append(tag)
+        return ti
+
+    def _take_chunk(self):
+        # must be called with the lock held
+        chunk = (self._steps[:self._n].copy(), self._vals[:self._n, :len(self._tags)].copy(), list(self._tags))
+        self._vals[:self._n] = np.nan
+        self._n = 0
+        return chunk
+
+    def add_scalars(self, loss_names, loss_vals, iter_count):
+        if self.tbw is None:
+            return
+
+        if not isinstance(loss_vals, list):  # occurs when model only has one loss
+            loss_vals = [loss_vals]
+
+        with self._lock:
+            row = self._n
+            self._steps[row] = iter_count
+            for i in range(min(len(loss_names), len(loss_vals))):
+                ti = self._get_tag_idx(loss_names[i])  # might grow self._vals
+                self._vals[row, ti] = loss_vals[i]
+            self._n += 1
+
+            if self._n == self.capacity:
+                # hand the full buffer to the writer thread and keep going
+                self._chunks.put((self._take_chunk(), None))
+
+    def update_progbar(self, progbar, loss_names, loss_vals):
+        '''
+        Adds a batch to a keras Progbar, but only redraws it a few times per second.
+        Losses from the skipped batches are averaged in, so the displayed running means are unchanged.
+        '''
+        if progbar is None:
+            return
+
+        if not isinstance(loss_vals, list):
+            loss_vals = [loss_vals]
+
+        if progbar is not self._progbar:
+            self._progbar = progbar
+            self._progbar_sums = {}
+            self._progbar_n_pending = 0
+            self._progbar_last_draw = 0.
+
+        for i in range(min(len(loss_names), len(loss_vals))):
+            self._progbar_sums[loss_names[i]] = self._progbar_sums.get(loss_names[i], 0.) + loss_vals[i]
+        self._progbar_n_pending += 1
+
+        now = time.time()
+        # older versions of keras do not make seen_so_far private
+        seen_so_far = getattr(progbar, '_seen_so_far', getattr(progbar, 'seen_so_far', 0))
+        is_last = progbar.target is not None and seen_so_far + self._progbar_n_pending >= progbar.target
+        if is_last or now - self._progbar_last_draw >= self.progbar_min_interval:
+            self._draw_progbar()
+            self._progbar_last_draw = now
+
+    def _draw_progbar(self):
+        n = self._progbar_n_pending
+        if n == 0:
+            return
+        # Progbar.add weights each value by n, so adding the mean of the pending batches is exact
+        self._progbar.add(n, values=[(k, v / float(n)) for k, v in self._progbar_sums.items()])
+        self._progbar_sums = {}
+        self._progbar_n_pending = 0
+
+    def log_losses(self, progressBar, logger, loss_names, loss_vals, iter_count, write_tensorboard=True):
+        '''
+        Drop-in replacement for experiment_engine.log_losses that buffers tensorboard writes
+        and throttles the progress bar.
+        '''
+        if not isinstance(loss_vals, list):  # occurs when model only has one loss
+            loss_vals = [loss_vals]
+
+        self.update_progbar(progressBar, loss_names, loss_vals)
+
+        # the file logger is only used once in a while, so just write to it directly
+        if logger is not None:
+            logger.debug(', '.join(['{}: {}'.format(loss_names[i], loss_vals[i]) for i in range(len(loss_vals))]))
+
+        if write_tensorboard:
+            self.add_scalars(loss_names, loss_vals, iter_count)
+
+    def _write_chunk(self, chunk):
+        import tensorflow as tf
+        steps, vals, tags = chunk
+        for ri in range(steps.shape[0]):
+            valid_idxs = np.where(~np.isnan(vals[ri]))[0]
+            if len(valid_idxs) == 0:
+                continue
+            self.tbw.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag=tags[ti], simple_value=float(vals[ri, ti])) for ti in valid_idxs]),
+                int(steps[ri]))
+
+    def _writer_loop(self):
+        # each item in the queue is a chunk (or None, to just wake us up) and an optional event to set once the chunk
+        # is on disk. Once we are stopped, keep going until everything that was queued before that is written
+        while not (self._stop.is_set() and self._chunks.empty()):
+            try:
+                chunk, done = self._chunks.get(timeout=self.flush_every_n_seconds)
+            except queue.Empty:
+                chunk, done = None, None
+
+            if chunk is None:
+                # time trigger, or woken up to stop
+                with self._lock:
+                    if self._n > 0:
+                        chunk = self._take_chunk()
+            try:
+                if chunk is not None:
+                    self._write_chunk(chunk)
+                    self.tbw.flush()
+            except Exception as e:
+                logging.getLogger(__name__).warning('Failed to write telemetry: {}'.format(e))
+            finally:
+                if done is not None:
+                    done.set()
+
+    def flush(self, timeout=60.):
+        '''
+        Writes all buffered scalars to disk. Blocks until the writer thread is done.
+        '''
+        if self._progbar is not None:
+            self._draw_progbar()
+
+        if self._writer_thread is None:
+            return
+
+        # chunks are written in order, so once ours is written, so is everything that was queued before it
+        done = threading.Event()
+        with self._lock:
+            self._chunks.put((self._take_chunk(), done))
+        done.wait(timeout)
+
+    def close(self):
+        self.flush()
+        self._stop.set()
+        if self._writer_thread is not None:
+            self._chunks.put((None, None))  # wake up the writer
+            self._writer_thread.join()
+            self._writer_thread = None
+
+
+def _test_flush_and_close():
+    class FakeWriter(object):
+        def flush(self):
+            pass
+
+    written_steps = []
+
+    def slow_write_chunk(chunk):
+        time.sleep(0.01)  # give flush a chance to race with the writer
+        written_steps.extend([int(step) for step in chunk[0]])
+
+    telemetry = ScalarTelemetry(FakeWriter(), capacity=10, flush_every_n_seconds=0.001)
+    telemetry._write_chunk = slow_write_chunk
+    for i in range(95):
+        telemetry.add_scalars(['loss'], [float(i)], i)
+        if i % 30 == 0:
+            telemetry.flush()
+            assert written_steps == list(range(i + 1))
+    telemetry.close()
+    assert written_steps == list(range(95))
+    print('ScalarTelemetry flush test: PASSED')
+
+
+if __name__ == '__main__':
+    _test_flush_and_close()
@@ -0,0 +1,229 @@
+'''
+Lightweight, always-on timers for the phases of a training step (data fetch, training, logging, etc).
+
+Each phase keeps a rolling window of its durations so we can report percentiles, and the most recent
+events are kept in a ring buffer so they can be exported as a Chrome trace (chrome://tracing).
+Nested phases are supported: percentiles are computed on exclusive (self) time, so e.g. the time spent
+fetching data inside train_joint is not counted twice.
+'''
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# used to classify a run as data-, compute- or I/O-bound
+PHASE_GROUPS = {
+    'data_fetch': 'data',
+    'data_wait': 'data',
+    'train_discriminator': 'compute',
+    'train_joint': 'compute',
+    'train_step': 'compute',
+    'test_joint': 'compute',
+    'log_losses': 'io',
+    'render_results': 'io',
+    'checkpoint': 'io',
+    # launch phases, see experiment_engine.run_experiment
+    'load_data': 'data',
+    'create_generators': 'data',
+    'create_models': 'build',
+    'compile_models': 'build',
+    'load_models': 'io',
+    'init_weights': 'io',
+    'set_resolution': 'build',
+}
+
+
+class PhaseTimer(object):
+    def __init__(self, window=500, max_trace_events=50000):
+        '''
+        :param window: number of most recent durations to keep per phase, for computing percentiles
+        :param max_trace_events: number of most recent events to keep for the chrome trace
+        '''
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+
+        # rolling window of exclusive durations (in seconds) for each phase
+        self._durations = {}
+        self._counts = {}
+        self._totals = {}
+
+        # ring buffer of trace events
+        self._phase_names = []
+        self._phase_ids = {}
+        self._trace_phase = np.zeros(max_trace_events, dtype=np.int32)
+        self._trace_tid = np.zeros(max_trace_events, dtype=np.int64)
+        self._trace_start = np.zeros(max_trace_events, dtype=np.float64)
+        self._trace_dur = np.zeros(max_trace_events, dtype=np.float64)
+        self._n_trace_events = 0
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._get_stack()
+        # [name, start time, time spent in child phases]
+        stack.append([name, time.perf_counter(), 0.])
+        try:
+            yield
+        finally:
+            _, start, child_time = stack.pop()
+            end = time.perf_counter()
+            if len(stack) > 0:
+                stack[-1][2] += end - start
+            self.record(name, start, end, exclusive_dur=end - start - child_time)
+
+    def record(self, name, start, end, exclusive_dur=None):
+        if exclusive_dur is None:
+            exclusive_dur = end - start
+
+        with self._lock:
+            if name not in self._durations:
+                self._durations[name] = np.zeros(self.window, dtype=np.float64)
+                self._counts[name] = 0
+                self._totals[name] = 0.
+                self._phase_ids[name] = len(self._phase_names)
+                self._phase_names.append(name)
+
+            self._durations[name][self._counts[name] % self.window] = exclusive_dur
+            self._counts[name] += 1
+            self._totals[name] += exclusive_dur
+
+            ei = self._n_trace_events % self._trace_phase.shape[0]
+            self._trace_phase[ei] = self._phase_ids[name]
+            self._trace_tid[ei] = threading.get_ident()
+            self._trace_start[ei] = start - self._t0
+            self._trace_dur[ei] = end - start
+            self._n_trace_events += 1
+
+    def wrap_generator(self, gen, name='data_fetch'):
+        '''
+        Times each next() call on a generator, e.g. exp.train_gen
+        '''
+        while True:
+            with self.phase(name):
+                try:
+                    batch = next(gen)
+                except StopIteration:
+                    return
+            yield batch
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        :return: dict of phase name to stats over the rolling window. Times are in seconds.
+        '''
+        stats = {}
+        with self._lock:
+            for name in self._phase_names:
+                n = min(self._counts[name], self.window)
+                durs = self._durations[name][:n]
+                stats[name] = {
+                    'count': self._counts[name],
+                    'total': self._totals[name],
+                    'mean': float(np.mean(durs)),
+                }
+                for p, v in zip(percentiles, np.percentile(durs, percentiles)):
+                    stats[name]['p{}'.format(p)] = float(v)
+        return stats
+
+    def group_fractions(self):
+        '''
+        Fraction of the total timed wall clock spent in each group of phases (data, compute, io, other)
+        '''
+        with self._lock:
+            group_totals = {}
+            for name in self._phase_names:
+                group = PHASE_GROUPS.get(name, 'other')
+                group_totals[group] = group_totals.get(group, 0.) + self._totals[name]
+        total = sum(group_totals.values())
+        if total == 0:
+            return {}
+        return {g: t / total for g, t in group_totals.items()}
+
+    def bottleneck(self):
+        fractions = self.group_fractions()
+        if len(fractions) == 0:
+            return None
+        return max(fractions.keys(), key=lambda g: fractions[g])
+
+    def report(self, logger=None, title='Step phase timings'):
+        stats = self.summary()
+        lines = ['{:<22}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('phase', 'count', 'mean (ms)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)')]
+        for name in sorted(stats.keys(), key=lambda n: -stats[n]['total']):
+            s = stats[name]
+            lines.append('{:<22}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+                name, s['count'], s['mean'] * 1000, s['p50'] * 1000, s['p90'] * 1000, s['p99'] * 1000))
+
+        fractions = self.group_fractions()
+        if len(fractions) > 0:
+            lines.append('Time spent: {} -- {}-bound'.format(
+                ', '.join(['{} {:.0f}%'.format(g, f * 100) for g, f in sorted(fractions.items())]),
+                self.bottleneck()))
+
+        report_str = '\n'.join(lines)
+        if logger is not None:
+            logger.debug('{}:\n{}'.format(title, report_str))
+        return report_str
+
+    def scalars(self, prefix='timing_'):
+        '''
+        :return: loss_names, loss_vals for logging median and p90 phase times (ms) to tensorboard
+        '''
+        names = []
+        vals = []
+        for name, s in self.summary().items():
+            names += ['{}{}_p50_ms'.format(prefix, name), '{}{}_p90_ms'.format(prefix, name)]
+            vals += [s['p50'] * 1000, s['p90'] * 1000]
+        for group, f in self.group_fractions().items():
+            names.append('{}frac_{}'.format(prefix, group))
+            vals.append(f)
+        return names, vals
+
+    def export_chrome_trace(self, out_file):
+        with self._lock:
+            n_events = min(self._n_trace_events, self._trace_phase.shape[0])
+            events = [{
+                'name': self._phase_names[self._trace_phase[ei]],
+                'cat': PHASE_GROUPS.get(self._phase_names[self._trace_phase[ei]], 'other'),
+                'ph': 'X',
+                'pid': os.getpid(),
+                'tid': int(self._trace_tid[ei]),
+                'ts': self._trace_start[ei] * 1e6,  # chrome expects microseconds
+                'dur': self._trace_dur[ei] * 1e6,
+            } for ei in range(n_events)]
+
+        with open(out_file, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def save(self, out_file):
+        # save summary stats so that later runs can use them (e.g. to decide how to allocate cpus)
+        with open(out_file, 'w') as f:
+            json.dump({'phases': self.summary(), 'group_fractions': self.group_fractions()}, f, indent=2)
+
+
+def _test_phase_timer():
+    timer = PhaseTimer(window=10, max_trace_events=5)
+    for i in range(20):
+        with timer.phase('train_joint'):
+            with timer.phase('data_fetch'):
+                time.sleep(0.002)
+            time.sleep(0.001)
+    stats = timer.summary()
+    assert stats['train_joint']['count'] == 20
+    # exclusive time of the parent should not include the child
+    assert stats['train_joint']['p50'] < stats['data_fetch']['p50']
+    assert timer.bottleneck() == 'data'
+    print(timer.report())
+    print('PhaseTimer test: PASSED')
+
+
+if __name__ == '__main__':
+    _test_phase_timer()
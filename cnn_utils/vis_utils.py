@@ -7,13 +7,14 @@ import cv2
 
 import textwrap
 from cnn_utils import image_utils, classification_utils
-import PIL
-from PIL import Image, ImageDraw, ImageFont
-import matplotlib as mpl
-
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-import scipy.misc as spm
+from cnn_utils.lazy_utils import LazyModule, lazy_pyplot
+
+# these are slow to import, and only some functions need them
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+plt = lazy_pyplot()
+spm = LazyModule('scipy.misc')
 
 
 def label_ims(ims_batch, labels=None,
@@ -0,0 +1,75 @@
+'''
+Import-time regression benchmark. Imports each module in a fresh interpreter, and checks that it loads within
+the target time and without pulling in heavy dependencies that it doesn't need.
+
+Exits with a nonzero status if any module is over its target, so this can be run as a check.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# modules that should be quick to import, since scripts use them without training anything
+FAST_MODULES = [
+    'cnn_utils.image_utils',
+    'cnn_utils.file_utils',
+    'cnn_utils.batch_utils',
+    'cnn_utils.vis_utils',
+]
+
+# modules that we only want to load when they are actually used
+HEAVY_MODULES = ['tensorflow', 'keras', 'matplotlib', 'scipy', 'PIL']
+
+_IMPORT_SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'heavy': [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+
+def time_import(module, n_repeats=3, cwd=None):
+    '''
+    :return: best import time (in seconds) over n_repeats fresh interpreters, and the heavy modules it loaded
+    '''
+    best_seconds = None
+    heavy = []
+    for _ in range(n_repeats):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=cwd)
+        result = json.loads(out.decode('utf-8').strip().split('\n')[-1])
+        if best_seconds is None or result['seconds'] < best_seconds:
+            best_seconds = result['seconds']
+        heavy = result['heavy']
+    return best_seconds, heavy
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('modules', nargs='*', default=FAST_MODULES, help='Modules to time')
+    ap.add_argument('-t', '--target_ms', type=float, default=200., help='Max import time in ms')
+    ap.add_argument('-n', '--n_repeats', type=int, default=3)
+    args = ap.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    n_failed = 0
+    for module in args.modules:
+        try:
+            seconds, heavy = time_import(module, n_repeats=args.n_repeats, cwd=repo_root)
+        except subprocess.CalledProcessError:
+            print('{:<30} FAILED TO IMPORT'.format(module))
+            n_failed += 1
+            continue
+
+        is_ok = seconds * 1000 <= args.target_ms and len(heavy) == 0
+        if not is_ok:
+            n_failed += 1
+        print('{:<30}{:>10.1f} ms  {}{}'.format(
+            module, seconds * 1000, 'OK' if is_ok else 'SLOW',
+            '  (loaded {})'.format(', '.join(heavy)) if len(heavy) > 0 else ''))
+
+    sys.exit(1 if n_failed > 0 else 0)
@@ -0,0 +1,70 @@
+'''
+Benchmark of the local sum methods in metrics.NCC, across 2D/3D shapes and window sizes.
+
+For each configuration, checks that the 'cumsum' and 'separable' methods match the dense 'conv' method, and reports
+the time per evaluation of the loss and its gradient. Exits with a nonzero status if any method doesn't match.
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cnn_utils import metrics
+from benchmark_utils import exit_with_status, format_time, time_loss
+
+CONFIGS = [
+    # (vol shape, n_chans, window)
+    ((160, 160), 3, 5),
+    ((160, 160), 3, 9),
+    ((160, 160), 3, 15),
+    ((64, 64, 64), 1, 5),
+    ((64, 64, 64), 1, 9),
+    ((64, 64, 64), 1, 15),
+]
+
+METHODS = ['conv', 'separable', 'cumsum']
+
+
+def time_method(sess, I, J, vol_shape, n_chans, win, method, batch_size, n_repeats):
+    import tensorflow as tf
+
+    ndims = len(vol_shape)
+    I_ph = tf.placeholder(tf.float32, (None,) + vol_shape + (n_chans,))
+    J_ph = tf.placeholder(tf.float32, (None,) + vol_shape + (n_chans,))
+    loss = metrics.NCC(win=[win] * ndims, n_chans=n_chans, method=method).loss(I_ph, J_ph)
+    return time_loss(sess, loss, J_ph, {I_ph: I, J_ph: J}, n_repeats)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-bs', '--batch_size', type=int, default=4)
+    ap.add_argument('-n', '--n_repeats', type=int, default=10)
+    ap.add_argument('--tol', type=float, default=1e-4, help='Max allowed difference in loss from the conv method')
+    args = ap.parse_args()
+
+    import tensorflow as tf
+
+    n_failed = 0
+    print('{:<16}{:>6}{:>6}  {}'.format('shape', 'chans', 'win', '  '.join(['{:>12}'.format(m) for m in METHODS])))
+    for vol_shape, n_chans, win in CONFIGS:
+        tf.reset_default_graph()
+        I = np.random.rand(args.batch_size, *vol_shape, n_chans).astype(np.float32)
+        J = np.clip(I + 0.1 * np.random.randn(*I.shape), 0, 1).astype(np.float32)
+
+        with tf.Session() as sess:
+            results = [time_method(sess, I, J, vol_shape, n_chans, win, m, args.batch_size, args.n_repeats)
+                       for m in METHODS]
+
+        ref_loss = results[0][0]
+        cols = []
+        for m, (loss_val, seconds) in zip(METHODS, results):
+            is_match = abs(loss_val - ref_loss) <= args.tol
+            if not is_match:
+                n_failed += 1
+            cols.append(format_time(seconds, is_match))
+        print('{:<16}{:>6}{:>6}  {}'.format(str(vol_shape), n_chans, win, '  '.join(cols)))
+
+    exit_with_status(n_failed, 'the conv method')
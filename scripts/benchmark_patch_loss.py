@@ -0,0 +1,87 @@
+'''
+Benchmark of metrics.PatchLoss against the full-image L1 loss, across image sizes, patch sizes and aggregations.
+
+Reports the time per evaluation of each loss and its gradient. Also checks that the mean over a grid of
+non-overlapping patches matches the full-image L1, and that the median matches a numpy reference. Exits with a
+nonzero status if either doesn't match.
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cnn_utils import metrics
+from benchmark_utils import exit_with_status, format_time, time_loss
+
+CONFIGS = [
+    # (img shape, patch size, n sampled patches or None for the full grid)
+    ((128, 128, 3), 8, None),
+    ((128, 128, 3), 16, None),
+    ((128, 128, 3), 16, 32),
+    ((256, 256, 3), 16, None),
+    ((256, 256, 3), 16, 64),
+    ((256, 256, 3), 32, 16),
+]
+
+AGG_TYPES = ['mean', 'median']
+
+
+def numpy_patch_median(I, J, patch_size):
+    # median over the grid of non-overlapping patches of the mean L1 in each patch, averaged over the batch
+    n, h, w, c = I.shape
+    errs = np.abs(I - J)[:, :h // patch_size * patch_size, :w // patch_size * patch_size]
+    errs = np.reshape(errs, (n, h // patch_size, patch_size, w // patch_size, patch_size, c))
+    losses = np.reshape(np.mean(errs, axis=(2, 4, 5)), (n, -1))
+    # element n // 2 of the sorted losses, i.e. the upper median for an even number of patches, like PatchLoss
+    return np.mean(np.sort(losses, axis=-1)[:, losses.shape[-1] // 2])
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-bs', '--batch_size', type=int, default=8)
+    ap.add_argument('-n', '--n_repeats', type=int, default=10)
+    ap.add_argument('--tol', type=float, default=1e-4, help='Max allowed difference from the reference losses')
+    args = ap.parse_args()
+
+    import tensorflow as tf
+
+    n_failed = 0
+    print('{:<16}{:>6}{:>9}  {:>12}  {}'.format(
+        'shape', 'patch', 'sampled', 'full l1', '  '.join(['{:>12}'.format(a) for a in AGG_TYPES])))
+    for img_shape, patch_size, n_sampled in CONFIGS:
+        tf.reset_default_graph()
+        I = np.random.rand(args.batch_size, *img_shape).astype(np.float32)
+        J = np.clip(I + 0.1 * np.random.randn(*I.shape), 0, 1).astype(np.float32)
+
+        I_ph = tf.placeholder(tf.float32, (None,) + img_shape)
+        J_ph = tf.placeholder(tf.float32, (None,) + img_shape)
+        feed_dict = {I_ph: I, J_ph: J}
+
+        with tf.Session() as sess:
+            l1_val, l1_seconds = time_loss(sess, tf.reduce_mean(tf.abs(I_ph - J_ph)), J_ph, feed_dict, args.n_repeats)
+
+            cols = []
+            for agg_type in AGG_TYPES:
+                patch_loss = metrics.PatchLoss(
+                    n_patches=n_sampled, img_shape=img_shape, patch_size=patch_size, agg_type=agg_type,
+                    sample_patches=n_sampled is not None)
+                loss_val, seconds = time_loss(
+                    sess, patch_loss.compute_loss(I_ph, J_ph), J_ph, feed_dict, args.n_repeats)
+
+                # sampled patches are random, so we can only check the grid of patches
+                is_match = True
+                if n_sampled is None and agg_type == 'mean':
+                    is_match = abs(loss_val - l1_val) <= args.tol
+                elif n_sampled is None and agg_type == 'median':
+                    is_match = abs(loss_val - numpy_patch_median(I, J, patch_size)) <= args.tol
+                if not is_match:
+                    n_failed += 1
+                cols.append(format_time(seconds, is_match))
+
+        print('{:<16}{:>6}{:>9}  {}  {}'.format(
+            str(img_shape), patch_size, str(n_sampled), format_time(l1_seconds), '  '.join(cols)))
+
+    exit_with_status(n_failed, 'the reference')
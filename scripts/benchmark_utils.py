@@ -0,0 +1,32 @@
+'''
+Helpers shared by the loss benchmarks (benchmark_ncc.py, benchmark_patch_loss.py): timing a loss and its gradient,
+and reporting results that don't match a reference.
+'''
+import sys
+import time
+
+
+def time_loss(sess, loss, wrt, feed_dict, n_repeats):
+    '''
+    :param wrt: tensor (e.g. the prediction placeholder) to also compute the gradient of loss with respect to
+    :return: the value of loss, and the mean time in seconds per evaluation of the loss and its gradient
+    '''
+    import tensorflow as tf
+    grad = tf.gradients(loss, wrt)[0]
+    loss_val, _ = sess.run([loss, grad], feed_dict=feed_dict)  # warm up
+
+    start = time.time()
+    for _ in range(n_repeats):
+        sess.run([loss, grad], feed_dict=feed_dict)
+    return loss_val, (time.time() - start) / n_repeats
+
+
+def format_time(seconds, is_match=True):
+    # results that don't match the reference are marked with a !
+    return '{:>10.1f}ms{}'.format(seconds * 1000, '' if is_match else '!')
+
+
+def exit_with_status(n_failed, reference_name):
+    if n_failed > 0:
+        print('{} results did not match {} (marked with !)'.format(n_failed, reference_name))
+    sys.exit(1 if n_failed > 0 else 0)